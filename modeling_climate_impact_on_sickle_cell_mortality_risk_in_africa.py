@@ -6,25 +6,288 @@
 
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-import statsmodels.api as sm
-from scipy.optimize import minimize
-from sklearn.linear_model import LinearRegression
-from scipy.stats import skew
-from statsmodels.tsa.vector_ar.var_model import VAR
+import argparse
+import glob
+import hashlib
+import inspect
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import traceback
-from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
-from scipy.cluster.hierarchy import linkage, fcluster, dendrogram
-from scipy.spatial.distance import squareform
-from statsmodels.stats.outliers_influence import variance_inflation_factor
-from statsmodels.tools.tools import add_constant
-from sklearn.feature_selection import VarianceThreshold
-import xgboost as xgb
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
-import shap
+import tracemalloc
+import urllib.parse
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import cached_property, lru_cache, wraps
+from threadpoolctl import threadpool_limits
+
+try:
+    import pyarrow as pa
+    from pyarrow import dataset as pa_dataset, feather, parquet as pq
+except ImportError:  # the loader falls back to parsing the CSV on every run
+    pa = pa_dataset = feather = pq = None
+
+"""# **Profiling**"""
+
+# Yields a temporary path next to `path` for the caller to write and moves it over `path` once the
+# block succeeds, so readers never see a partly written file; on failure the temporary file is removed
+@contextmanager
+def _atomic_write(path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _cpu_seconds():
+    # This process and its children that have been waited for (finished pool workers)
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+def _peak_rss_mb(children=False):
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _row_count(data):
+    if hasattr(data, 'num_row'):  # xgboost DMatrix
+        return data.num_row()
+    return len(data) if isinstance(data, (pd.DataFrame, pd.Series, np.ndarray)) else None
+
+# Run instrumentation. section(name) wraps a stage or a hot loop and records its wall time, CPU
+# time, the process's peak RSS so far, the tracemalloc peak above the section's starting memory
+# (with trace_memory) and the rows it processed; sections with the same name are aggregated into
+# calls and totals. count(name) keeps event counters such as optimizer fallbacks. Records made in
+# worker processes stay there unless the worker returns records() for the parent to merge().
+class RunProfile:
+    def __init__(self):
+        self.configure()
+
+    # trace_memory starts tracemalloc, which slows allocation-heavy code noticeably. With a
+    # profile_dir, sections opened with profile=True also run under cProfile (a .prof file per
+    # section) or pyinstrument (an .html file per section).
+    def configure(self, trace_memory=False, profile_dir=None, profiler='cprofile'):
+        if profiler not in ('cprofile', 'pyinstrument'):
+            raise ValueError(f'Unknown profiler: {profiler}')
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.profiler = profiler
+        self.sections = {}
+        self.counters = {}
+        self._stack = []
+        self._start = (time.strftime('%Y-%m-%dT%H:%M:%S'), time.perf_counter(), _cpu_seconds())
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _start_profiler(self):
+        if self.profiler == 'pyinstrument':
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+            return profiler
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def _stop_profiler(self, profiler, name):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        name = name.replace(':', '_')
+        if self.profiler == 'pyinstrument':
+            profiler.stop()
+            with open(os.path.join(self.profile_dir, f'{name}.html'), 'w') as f:
+                f.write(profiler.output_html())
+        else:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(self.profile_dir, f'{name}.prof'))
+
+    # The yielded entry can be given its 'rows' inside the block; after the block it also holds
+    # the section's own measurements
+    @contextmanager
+    def section(self, name, rows=None, profile=False):
+        entry = {'rows': rows, 'tracemalloc_peak': 0, 'tracemalloc_base': 0}
+        if self.trace_memory:
+            if self._stack:
+                # Keep the enclosing section's peak before resetting it for this one
+                parent = self._stack[-1]
+                parent['tracemalloc_peak'] = max(parent['tracemalloc_peak'], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            entry['tracemalloc_base'] = tracemalloc.get_traced_memory()[0]
+        profiler = self._start_profiler() if profile and self.profile_dir else None
+        self._stack.append(entry)
+        wall, cpu = time.perf_counter(), _cpu_seconds()
+        try:
+            yield entry
+        finally:
+            entry['wall_seconds'] = time.perf_counter() - wall
+            entry['cpu_seconds'] = _cpu_seconds() - cpu
+            self._stack.pop()
+            if profiler is not None:
+                self._stop_profiler(profiler, name)
+            entry['tracemalloc_peak_mb'] = None
+            if self.trace_memory:
+                peak = max(entry['tracemalloc_peak'], tracemalloc.get_traced_memory()[1])
+                if self._stack:
+                    self._stack[-1]['tracemalloc_peak'] = max(self._stack[-1]['tracemalloc_peak'], peak)
+                entry['tracemalloc_peak_mb'] = (peak - entry['tracemalloc_base']) / 2 ** 20
+            entry['peak_rss_mb'] = _peak_rss_mb()
+            self._record(name, {'calls': 1, **{key: entry[key] for key in
+                                ('wall_seconds', 'cpu_seconds', 'rows', 'peak_rss_mb', 'tracemalloc_peak_mb')}})
+
+    def _record(self, name, values):
+        record = self.sections.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'rows': None,
+                                                 'peak_rss_mb': None, 'tracemalloc_peak_mb': None})
+        for key in ('calls', 'wall_seconds', 'cpu_seconds', 'rows'):
+            if values[key] is not None:
+                record[key] = (record[key] or 0) + values[key]
+        for key in ('peak_rss_mb', 'tracemalloc_peak_mb'):
+            if values[key] is not None:
+                record[key] = max(record[key] or 0, values[key])
+
+    # Decorator form of section(); rows are counted from the first argument (a frame, array or
+    # DMatrix), which is how the data functions of this module take their input
+    def profiled(self, name=None):
+        def decorate(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.section(name or fn.__name__, rows=_row_count(args[0]) if args else None):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def records(self):
+        return {'sections': {name: dict(record) for name, record in self.sections.items()},
+                'counters': dict(self.counters)}
+
+    def merge(self, records):
+        for name, values in records['sections'].items():
+            self._record(name, values)
+        for name, n in records['counters'].items():
+            self.count(name, n)
+
+    def report(self):
+        started, wall, cpu = self._start
+        sections = []
+        for name, record in self.sections.items():
+            rows_per_sec = record['rows'] / record['wall_seconds'] if record['rows'] and record['wall_seconds'] else None
+            sections.append({'section': name, **record, 'rows_per_sec': rows_per_sec})
+        return {
+            'started': started,
+            'wall_seconds': time.perf_counter() - wall,
+            'cpu_seconds': _cpu_seconds() - cpu,
+            'peak_rss_mb': _peak_rss_mb(),
+            'children_peak_rss_mb': _peak_rss_mb(children=True),
+            'counters': dict(self.counters),
+            'sections': sections
+        }
+
+    # JSON run report; extra keys (the command, the stage table) are stored alongside
+    def write(self, path, **extra):
+        with _atomic_write(path) as tmp_path, open(tmp_path, 'w') as f:
+            json.dump({**self.report(), **extra}, f, indent=2, default=str)
+
+run_profile = RunProfile()
+
+"""# **Data Loading**"""
+
+DATA_URL = 'https://raw.githubusercontent.com/ElishamaYomi/CAN2025_NG/main/Preprocessed%20and%20Merged%20Climate%20and%20SCA%20data.csv'
+
+# Directory of this module (the working directory when run as a notebook)
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__)) if '__file__' in globals() else os.getcwd()
+
+# Bundled CSV (or any local copy) and the directory holding its columnar cache, next to the module
+# unless set in the environment
+DATA_PATH = os.environ.get('SCA_DATA_PATH',
+                           os.path.join(MODULE_DIR, 'Preprocessed and Merged Climate and SCA data.csv'))
+CACHE_DIR = os.environ.get('SCA_CACHE_DIR', os.path.join(MODULE_DIR, '.cache'))
+
+CATEGORICAL_COLUMNS = ['country_code', 'region', 'Location']
+CLIMATE_COLUMNS = [
+    'tavg_temperature', 'tmed_temperature', 'tmin_temperature', 'tmax_temperature',
+    'avg_precipitation', 'med_precipitation', 'min_precipitation', 'max_precipitation',
+    'avg_aod', 'med_aod', 'min_aod', 'max_aod',
+    'yearly_avg_temperature', 'yearly_avg_precipitation'
+]
+
+def _file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Categorical identifiers, int16 year, int8 month and float32 climate columns
+def _compact_dtypes(data):
+    for col in CATEGORICAL_COLUMNS:
+        data[col] = data[col].astype('category')
+    data['year'] = data['year'].astype('int16')
+    data['month_number'] = data['month_number'].astype('int8')
+    climate_cols = [col for col in CLIMATE_COLUMNS if col in data.columns]
+    data[climate_cols] = data[climate_cols].astype('float32')
+    return data
+
+# Local-first loader: the CSV is parsed once and stored as an uncompressed Feather file keyed by
+# the CSV's hash, which later runs read instead of parsing the text again. The columns are
+# converted to the usual pandas dtypes, so the frame is a copy of the file's contents.
+# Falls back to the copy at url (GitHub) when no local file exists.
+def load_merged_data(path=DATA_PATH, cache_dir=CACHE_DIR, use_cache=True, url=DATA_URL):
+    if not os.path.exists(path):
+        return _compact_dtypes(pd.read_csv(url))
+    if not use_cache or feather is None:
+        return _compact_dtypes(pd.read_csv(path))
+
+    cache_path = os.path.join(cache_dir, f'merged_data_{_file_hash(path)[:16]}.feather')
+    if os.path.exists(cache_path):
+        return feather.read_feather(cache_path)
+
+    data = _compact_dtypes(pd.read_csv(path))
+    with _atomic_write(cache_path) as tmp_path:
+        feather.write_feather(data, tmp_path, compression='uncompressed')
+    return data
+
+def _loader_benchmark_worker(loader, path, cache_dir):
+    import resource
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    start = time.perf_counter()
+    data = pd.read_csv(path) if loader == 'csv' else load_merged_data(path, cache_dir)
+    seconds = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {
+        'loader': loader,
+        'seconds': seconds,
+        'peak_rss_mb': peak_rss,
+        'rss_growth_mb': peak_rss - baseline_rss,
+        'frame_mb': data.memory_usage(deep=True).sum() / 1e6
+    }
+
+# Load time and memory of the plain CSV read against a cold and a warm cache. Every loader runs in
+# a fresh spawned process; peak_rss_mb is that process's peak RSS and rss_growth_mb its growth
+# over the RSS after the imports, next to the in-memory size of the frame (frame_mb).
+def compare_data_loaders(path=DATA_PATH):
+    results = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for loader in ('csv', 'cache_cold', 'cache_warm'):
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                results.append(pool.submit(_loader_benchmark_worker, loader, path, cache_dir).result())
+    return pd.DataFrame(results)
 
 """# **Data Augmentation**"""
 
@@ -35,6 +298,8 @@ def denton_disaggregate(yearly_total, indicator_series, smooth_order=2):
     indicators = indicators / indicators.sum()
     initial = yearly_total * indicators
 
+    from scipy.optimize import minimize
+
     def objective(x):
         return np.sum(np.diff(x, n=smooth_order) ** 2)
 
@@ -44,47 +309,170 @@ def denton_disaggregate(yearly_total, indicator_series, smooth_order=2):
     res = minimize(objective, initial, method='SLSQP', bounds=bounds, constraints=constraints)
 
     if not res.success:
+        run_profile.count('denton_fallbacks')
         return np.round(initial).astype(int)
 
-    raw = res.x
+    return round_to_totals(res.x[np.newaxis, :], np.array([yearly_total]))[0]
+
+# Integer rounding with largest-remainder redistribution, one row per country-year
+def round_to_totals(raw, yearly_totals):
     floored = np.floor(raw).astype(int)
-    diff = int(round(yearly_total)) - floored.sum()
+    diff = np.round(yearly_totals).astype(int) - floored.sum(axis=1)
 
-    if diff > 0:
-        for i in np.argsort(raw - floored)[-diff:]:
-            floored[i] += 1
-    elif diff < 0:
-        for i in np.argsort(floored - raw)[:abs(diff)]:
-            floored[i] -= 1
+    # Position of every month in the per-row argsort, so the months that receive (or give up)
+    # a unit are the same ones the per-row argsort loop would pick
+    positions = np.arange(raw.shape[1])
+    up_rank = np.empty_like(floored)
+    np.put_along_axis(up_rank, np.argsort(raw - floored, axis=1), positions[np.newaxis, :], axis=1)
+    down_rank = np.empty_like(floored)
+    np.put_along_axis(down_rank, np.argsort(floored - raw, axis=1), positions[np.newaxis, :], axis=1)
+
+    floored += up_rank >= raw.shape[1] - diff[:, np.newaxis]
+    floored -= down_rank < -diff[:, np.newaxis]
 
     return np.maximum(floored, 0)
 
+# Precomputed KKT operator for the batched Denton solve.
+# The smoothness penalty is zero for every polynomial of degree < smooth_order, so its minimum over
+# the annual-sum constraint is not unique. The batched solve takes the minimum-norm correction of
+# the indicator-based starting allocation: the zero-penalty allocation with the yearly total that is
+# closest to `initial`. SLSQP stops at some other nearly zero-penalty point, so after rounding the
+# months can differ from the SLSQP solver's by one death; the annual totals are the same. The KKT
+# system of that problem does not depend on the data, so it is inverted once and every
+# country-year is solved as x = operator @ initial + constraint * yearly_total.
+@lru_cache(maxsize=None)
+def denton_kkt_operator(n_periods=12, smooth_order=2):
+    difference = np.diff(np.eye(n_periods), n=smooth_order, axis=0)
+    constraints = np.vstack([difference, np.ones((1, n_periods))])
+    n_constraints = constraints.shape[0]
+
+    kkt = np.zeros((n_periods + n_constraints, n_periods + n_constraints))
+    kkt[:n_periods, :n_periods] = np.eye(n_periods)
+    kkt[:n_periods, n_periods:] = constraints.T
+    kkt[n_periods:, :n_periods] = constraints
+
+    kkt_inv = np.linalg.inv(kkt)
+    return kkt_inv[:n_periods, :n_periods], kkt_inv[:n_periods, -1]
+
+# Batched Denton disaggregation of all country-years at once
+def denton_disaggregate_batched(yearly_totals, indicator_matrix, smooth_order=2):
+    yearly_totals = np.asarray(yearly_totals, dtype=float)
+    indicator_matrix = np.asarray(indicator_matrix, dtype=float)
+
+    indicators = np.maximum(indicator_matrix, 0.01)
+    indicators = indicators / indicators.sum(axis=1, keepdims=True)
+    initial = yearly_totals[:, np.newaxis] * indicators
+
+    operator, constraint = denton_kkt_operator(indicator_matrix.shape[1], smooth_order)
+    raw = initial @ operator.T + yearly_totals[:, np.newaxis] * constraint
+
+    # Rows where the unconstrained solution goes negative (or the inputs are not finite) need the
+    # bounded QP, so they fall back to the SLSQP solver
+    fallback = ~np.isfinite(raw).all(axis=1) | (raw < 0).any(axis=1)
+    monthly = np.zeros(raw.shape, dtype=int)
+    monthly[~fallback] = round_to_totals(raw[~fallback], yearly_totals[~fallback])
+    for i in np.flatnonzero(fallback):
+        monthly[i] = denton_disaggregate(yearly_totals[i], indicator_matrix[i], smooth_order)
+
+    return monthly
+
+# Whole-series (proportional) Denton-Cholette disaggregation for one country.
+# The monthly values are x = indicator * ratio, where the benchmark-to-indicator ratio minimises
+# its squared smooth_order differences over the whole series subject to the annual sums, so there
+# is no break at the December->January boundaries. The banded difference operator and the
+# annual-sum constraints give a sparse KKT system that is solved in O(n).
+def denton_cholette_series(yearly_totals, indicator_series, smooth_order=2):
+    from scipy import sparse
+    from scipy.sparse.linalg import spsolve
+
+    yearly_totals = np.asarray(yearly_totals, dtype=float)
+    indicators = np.maximum(np.asarray(indicator_series, dtype=float), 0.01)
+    n_periods = len(indicators)
+
+    difference = sparse.identity(n_periods, format='csr')
+    for _ in range(smooth_order):
+        rows = difference.shape[0] - 1
+        step = sparse.diags([-np.ones(rows), np.ones(rows)], [0, 1], shape=(rows, rows + 1), format='csr')
+        difference = step @ difference
+
+    annual_sums = sparse.kron(sparse.identity(len(yearly_totals)), np.ones((1, 12)))
+    constraints = annual_sums @ sparse.diags(indicators)
+
+    kkt = sparse.bmat([[difference.T @ difference, constraints.T], [constraints, None]], format='csc')
+    rhs = np.concatenate([np.zeros(n_periods), yearly_totals])
+    ratio = spsolve(kkt, rhs)[:n_periods]
+
+    return indicators * ratio
+
 # Estimating country-specific weights
-def get_country_climate_weights(final_data, Value):
-    weights = {}
+# One least-squares fit per country, solved for all countries at once on a
+# (country x year x feature) array padded to the longest year coverage and masked.
+# Countries with fewer than 2 years or an all-NaN/constant target are skipped.
+# as_frame=True returns the coefficients as a DataFrame indexed by country_code
+# instead of a dict of tuples.
+def get_country_climate_weights(final_data, Value, as_frame=False):
     features = ['yearly_avg_temperature', 'yearly_avg_precipitation']
 
-    for country, group in final_data.groupby('country_code'):
-        group_yearly = group.drop_duplicates(subset='year')
-        if len(group_yearly) < 2:
-            continue
-
-        X = group_yearly[features].values
-        y = group_yearly[Value].values
-
-        if np.all(np.isnan(y)) or np.all(y == y[0]):
-            continue
-
-        model = LinearRegression().fit(X, y)
-        weights[country] = tuple(model.coef_)
-
-    return weights
+    yearly = final_data.drop_duplicates(subset=['country_code', 'year'])
+    yearly = yearly[yearly['country_code'].notna()]
+    country_idx, countries = pd.factorize(yearly['country_code'], sort=True)
+    year_idx = yearly.groupby('country_code', observed=True).cumcount().to_numpy()
+
+    n_countries = len(countries)
+    n_years = year_idx.max() + 1 if len(yearly) else 0
+    X = np.zeros((n_countries, n_years, len(features)))
+    y = np.zeros((n_countries, n_years))
+    mask = np.zeros((n_countries, n_years), dtype=bool)
+    X[country_idx, year_idx] = yearly[features].to_numpy(dtype=float)
+    y[country_idx, year_idx] = yearly[Value].to_numpy(dtype=float)
+    mask[country_idx, year_idx] = True
+
+    # Skip rules
+    count = mask.sum(axis=1)
+    valid = mask & np.isfinite(y) & np.isfinite(X).all(axis=2)
+    y_first = y[np.arange(n_countries), valid.argmax(axis=1)]
+    constant = np.all((y == y_first[:, np.newaxis]) | ~valid, axis=1)
+    fitted = (count >= 2) & valid.any(axis=1) & ~constant
+
+    # Centering on the masked means absorbs the intercept
+    X = np.where(valid[..., np.newaxis], X, 0.0)
+    y = np.where(valid, y, 0.0)
+    n_valid = np.maximum(valid.sum(axis=1), 1)
+    X_centered = (X - X.sum(axis=1, keepdims=True) / n_valid[:, np.newaxis, np.newaxis]) * valid[..., np.newaxis]
+    y_centered = (y - y.sum(axis=1, keepdims=True) / n_valid[:, np.newaxis]) * valid
+
+    gram = np.einsum('cyf,cyg->cfg', X_centered, X_centered)
+    moment = np.einsum('cyf,cy->cf', X_centered, y_centered)
+    coef = np.einsum('cfg,cg->cf', np.linalg.pinv(gram), moment)
+
+    weights = pd.DataFrame(coef[fitted], index=pd.Index(countries[fitted], name='country_code'), columns=features)
+    if as_frame:
+        return weights
+    return dict(zip(weights.index, weights.itertuples(index=False, name=None)))
 
 # Applying Denton disaggregation
-def disaggregate_monthly(final_data, Value, weights_by_country):
+# mode='per_year' smooths each calendar year on its own, mode='series' solves one Denton-Cholette
+# problem per country across all of its consecutive years.
+# In per-year mode solver='kkt' solves every complete country-year in one batched matrix
+# operation, solver='slsqp' runs the original per country-year optimizer
+@run_profile.profiled()
+def disaggregate_monthly(final_data, Value, weights_by_country, solver='kkt', mode='per_year'):
     output_col = f'monthly_{Value}'
     final_data[output_col] = np.nan
 
+    if mode == 'series':
+        return _disaggregate_monthly_series(final_data, Value, weights_by_country, output_col)
+    if mode != 'per_year':
+        raise ValueError(f"Unknown mode: {mode}")
+
+    if solver == 'kkt':
+        return _disaggregate_monthly_batched(final_data, Value, weights_by_country, output_col)
+    if solver != 'slsqp':
+        raise ValueError(f"Unknown solver: {solver}")
+    if isinstance(weights_by_country, pd.DataFrame):
+        weights_by_country = dict(zip(weights_by_country.index,
+                                      weights_by_country.itertuples(index=False, name=None)))
+
     for (country, year), group in final_data.groupby(['country_code', 'year']):
         if len(group) != 12 or pd.isna(group[Value].iloc[0]):
             continue
@@ -101,119 +489,453 @@ def disaggregate_monthly(final_data, Value, weights_by_country):
     final_data[output_col] = final_data[output_col].astype("Int64")
     return final_data
 
-merged_data = pd.read_csv('https://raw.githubusercontent.com/ElishamaYomi/CAN2025_NG/main/Preprocessed%20and%20Merged%20Climate%20and%20SCA%20data.csv')
-
-final_aug_data = disaggregate_monthly(merged_data, 'Value', get_country_climate_weights(merged_data, 'Value'))
-
-# imputation for missing mortality values
-def impute_monthly_mortality(df, monthly_col, yearly_col):
-    df = df.copy()
-
-    for (country, year), group in df.groupby(["country_code", "year"]):
-        if pd.isna(year) or pd.isna(country):
-            continue
-
-        yearly_total = group[yearly_col].iloc[0]
-        if pd.isna(yearly_total):
-            continue
-
-        indices = group.index
-        monthly_vals = df.loc[indices, monthly_col].values
-
-        known_mask = ~pd.isna(monthly_vals)
-        known_sum = round(monthly_vals[known_mask].sum()) if known_mask.any() else 0
-        count_known = known_mask.sum()
-        missing_mask = pd.isna(monthly_vals)
-        count_missing = 12 - count_known
+# (country-year x 12) matrix of row positions for every complete country-year with a known
+# yearly value, keeping each group's row order, plus the matching yearly totals
+def _country_year_positions(final_data, Value):
+    grouped = final_data.groupby(['country_code', 'year'], observed=True)
+    group_id = grouped.ngroup().fillna(-1).astype(int).to_numpy()
+    month_pos = grouped.cumcount().fillna(-1).astype(int).to_numpy()
+    group_size = grouped[Value].transform('size').to_numpy()
+
+    complete = (group_id >= 0) & (group_size == 12)
+    first_rows = np.flatnonzero(complete & (month_pos == 0))
+    first_rows = first_rows[final_data[Value].notna().to_numpy()[first_rows]]
+    first_rows = first_rows[np.argsort(group_id[first_rows], kind='stable')]
+    row_of_group = np.full(group_id.max() + 1, -1)
+    row_of_group[group_id[first_rows]] = np.arange(len(first_rows))
+
+    keep = complete & (row_of_group[group_id] >= 0)
+    positions = np.empty((len(first_rows), 12), dtype=int)
+    positions[row_of_group[group_id[keep]], month_pos[keep]] = np.flatnonzero(keep)
+
+    return positions, final_data[Value].to_numpy()[first_rows]
+
+# Climate indicator per row from the country weights, (0.5, 0.5) for countries without weights
+def _monthly_indicators(final_data, weights_by_country):
+    if not isinstance(weights_by_country, pd.DataFrame):
+        weights_by_country = pd.DataFrame.from_dict(weights_by_country, orient='index', columns=['temp', 'precip'])
+    weights = weights_by_country.reindex(final_data['country_code']).fillna(0.5).to_numpy()
+
+    return (weights[:, 0] * final_data['tavg_temperature'].to_numpy()
+            + weights[:, 1] * final_data['avg_precipitation'].to_numpy())
+
+def _write_monthly(final_data, output_col, positions, monthly):
+    output = np.full(len(final_data), np.nan)
+    output[positions.ravel()] = monthly.ravel()
+    final_data[output_col] = pd.array(output).astype("Int64")
+    return final_data
 
-        # Handle edge case: more than 12 or fewer than 12 months in data
-        if count_missing <= 0:
-            df.loc[indices[missing_mask], monthly_col] = 0
+def _disaggregate_monthly_batched(final_data, Value, weights_by_country, output_col):
+    positions, yearly_totals = _country_year_positions(final_data, Value)
+    indicators = _monthly_indicators(final_data, weights_by_country)
+
+    monthly = denton_disaggregate_batched(yearly_totals, indicators[positions])
+    return _write_monthly(final_data, output_col, positions, monthly)
+
+def _disaggregate_monthly_series(final_data, Value, weights_by_country, output_col, smooth_order=2):
+    positions, yearly_totals = _country_year_positions(final_data, Value)
+    indicators = _monthly_indicators(final_data, weights_by_country)
+
+    # Months in calendar order; country-years are already sorted by country and year
+    month_order = np.argsort(final_data['month_number'].to_numpy()[positions], axis=1, kind='stable')
+    positions = np.take_along_axis(positions, month_order, axis=1)
+    countries = final_data['country_code'].to_numpy()[positions[:, 0]]
+    years = final_data['year'].to_numpy()[positions[:, 0]]
+    indicators = indicators[positions]
+
+    # One series per run of consecutive complete years within a country
+    new_run = np.r_[True, (countries[1:] != countries[:-1]) | (np.diff(years) != 1)]
+    runs = np.split(np.arange(len(positions)), np.flatnonzero(new_run)[1:])
+
+    monthly = np.zeros(positions.shape, dtype=int)
+    per_year = np.zeros(len(positions), dtype=bool)
+    for run in runs:
+        if len(run) < smooth_order:
+            per_year[run] = True
             continue
 
-        if known_sum >= round(yearly_total):
-            df.loc[indices[missing_mask], monthly_col] = 0
-        else:
-            residual = round(yearly_total) - known_sum
-            per_month_value = round(residual / count_missing)
-            df.loc[indices[missing_mask], monthly_col] = per_month_value
-
-    df[monthly_col] = df[monthly_col].astype("Int64")
-    return df
-
-final_filled_data = impute_monthly_mortality(final_aug_data, 'monthly_Value', 'Value')
+        raw = denton_cholette_series(yearly_totals[run], indicators[run].ravel(), smooth_order)
+        raw = raw.reshape(len(run), 12)
 
-"""# **Feature Generation**"""
+        # Years where the series solution goes negative keep the per-year bounded solution
+        negative = ~np.isfinite(raw).all(axis=1) | (raw < 0).any(axis=1)
+        monthly[run[~negative]] = round_to_totals(raw[~negative], yearly_totals[run[~negative]])
+        per_year[run[negative]] = True
 
-df = final_filled_data
+    if per_year.any():
+        monthly[per_year] = denton_disaggregate_batched(yearly_totals[per_year], indicators[per_year],
+                                                        smooth_order)
 
-# dropping yearly values used previously to aid augmentation
-df = df.drop(columns=['Value', 'yearly_avg_temperature', 'yearly_avg_precipitation'])
-df.rename(columns={'monthly_Value': 'Value'}, inplace=True)
+    return _write_monthly(final_data, output_col, positions, monthly)
 
-#round death values
-df['Value'] = df['Value'].round(0).clip(lower=0)
+# Timing and smoothness of the per-year and whole-series disaggregation modes.
+# dec_jan_jump is the mean absolute December->January change, within_year_step the mean absolute
+# change between other consecutive months and roughness the mean squared second difference.
+def compare_disaggregation_modes(final_data, Value, weights_by_country, modes=('per_year', 'series')):
+    output_col = f'monthly_{Value}'
+    results = []
 
-#Creating Composite features
-# Range-based interaction terms
-df['temp_range'] = df['tmax_temperature'] - df['tmin_temperature']
-df['precip_range'] = df['max_precipitation'] - df['min_precipitation']
-df['aod_range'] = df['max_aod'] - df['min_aod']
+    for mode in modes:
+        start = time.perf_counter()
+        monthly = disaggregate_monthly(final_data.copy(), Value, weights_by_country, mode=mode)
+        seconds = time.perf_counter() - start
 
-# Interaction terms
-df['aridity_index'] = df['avg_precipitation']//(df['tavg_temperature'] + 10) # De Martonne aridity index
+        monthly = monthly.sort_values(['country_code', 'year', 'month_number'])
+        values = monthly[output_col].astype(float)
+        step = values.groupby(monthly['country_code'], observed=True).diff()
+        curvature = step.groupby(monthly['country_code'], observed=True).diff()
+        january = monthly['month_number'] == 1
 
-# Skewness Evaluation
-dfX = df
-
-# Identifying mean vs median feature columns
-mean_cols = [col for col in dfX.columns if 'avg_' in col]
-median_cols = [col for col in dfX.columns if 'med_' in col]
-
-# Filtering only numeric columns to avoid dtype issues
-mean_cols = [col for col in mean_cols if pd.api.types.is_numeric_dtype(dfX[col])]
-median_cols = [col for col in median_cols if pd.api.types.is_numeric_dtype(dfX[col])]
-
-# Evaluating skewness for each pair
-results = []
-for mean_col in mean_cols:
-    # Infer corresponding median col
-    med_col = mean_col.replace('avg_', 'med_')
-    if med_col in median_cols:
-        mean_skew = skew(dfX[mean_col].dropna())
-        med_skew = skew(dfX[med_col].dropna())
-        decision = 'drop_median' if abs(mean_skew) < abs(med_skew) else 'drop_mean'
         results.append({
-            'feature_pair': (mean_col, med_col),
-            'mean_skew': mean_skew,
-            'median_skew': med_skew,
-            'drop': decision
+            'mode': mode,
+            'seconds': seconds,
+            'dec_jan_jump': step[january].abs().mean(),
+            'within_year_step': step[~january].abs().mean(),
+            'roughness': (curvature ** 2).mean()
         })
 
-# Creating DataFrame with results
-skewness_dfX = pd.DataFrame(results)
-skewness_dfX = skewness_dfX.sort_values(by='drop')
-
-# Visualising results of Fisher-Pearson coefficient of skewness.
-for row in results:
-    sns.kdeplot(dfX[row['feature_pair'][0]].dropna(), label='Mean')
-    sns.kdeplot(dfX[row['feature_pair'][1]].dropna(), label='Median')
-    plt.title(f"{row['feature_pair'][0]} vs {row['feature_pair'][1]}")
-    plt.legend()
-    plt.show()
-
-skewness_dfX
+    return pd.DataFrame(results)
 
-# Dropping columns with higher absolute skew toward better stability for modeling.
-df = df.drop(columns=['tavg_temperature', 'avg_precipitation', 'med_aod'])
+# imputation for missing mortality values
+# Each country-year is one row of a padded (country-year x month) array: missing months get an
+# equal share of the residual of the yearly total, or 0 once the known months already reach it.
+# inplace=True fills the frame passed in instead of a copy.
+@run_profile.profiled()
+def impute_monthly_mortality(df, monthly_col, yearly_col, inplace=False):
+    if not inplace:
+        df = df.copy()
+
+    grouped = df.groupby(["country_code", "year"], observed=True)
+    group_id = grouped.ngroup().fillna(-1).astype(int).to_numpy()
+    month_pos = grouped.cumcount().fillna(-1).astype(int).to_numpy()
+    in_group = group_id >= 0
+    rows = group_id[in_group], month_pos[in_group]
+
+    monthly = df[monthly_col].to_numpy(dtype=float, na_value=np.nan, copy=True)
+    n_groups = grouped.ngroups
+    width = month_pos[in_group].max() + 1 if in_group.any() else 0
+
+    values = np.full((n_groups, width), np.nan)
+    values[rows] = monthly[in_group]
+    known = np.zeros((n_groups, width), dtype=bool)
+    known[rows] = ~np.isnan(monthly[in_group])
+
+    first = in_group & (month_pos == 0)
+    yearly_total = np.full(n_groups, np.nan)
+    yearly_total[group_id[first]] = df[yearly_col].to_numpy(dtype=float, na_value=np.nan)[first]
+
+    known_sum = np.round(np.where(known, values, 0).sum(axis=1))
+    count_missing = 12 - known.sum(axis=1)
+    target = np.round(yearly_total)
+
+    # Handle edge case: more than 12 or fewer than 12 months in data
+    fill = np.where(
+        (count_missing <= 0) | (known_sum >= target),
+        0,
+        np.round((target - known_sum) / np.maximum(count_missing, 1))
+    )
+    fill[np.isnan(yearly_total)] = np.nan
+
+    row_fill = np.full(len(df), np.nan)
+    row_fill[in_group] = fill[group_id[in_group]]
+    missing = np.isnan(monthly) & ~np.isnan(row_fill)
+    monthly[missing] = row_fill[missing]
+
+    df[monthly_col] = pd.array(monthly).astype("Int64")
+    return df
 
-# Dropping columns based on results from EDA and granger causality testing
-df = df.drop(columns=['min_aod', 'avg_aod', 'aod_range'])
+"""# **Feature Generation**"""
 
-# Adding lag features and rolling average features to capture delayed health effects of climate stressors.
+# Panel representation of the climate variables.
+# The variables are held as one dense float32 array with axes (location, month, variable) on a
+# shared monthly time axis, so lags, rolling windows and composites are slices along the time axis
+# instead of groupby('Location') passes. Months a location does not have in the long frame are NaN
+# and flagged in `present`.
+class ClimatePanel:
+    def __init__(self, data, variables, locations, country_code, region, start, present=None):
+        # data is stored variable-major, (variable, location, month); from_frame and
+        # with_variables build it as one C-contiguous float32 block, so every variable is a
+        # contiguous (location, month) block
+        self.data = data
+        self.variables = list(variables)
+        self.locations = pd.Index(locations, name='Location')
+        self.country_code = np.asarray(country_code)
+        self.region = np.asarray(region)
+        self.start = int(start)  # year * 12 + month - 1 of the first month
+        self.present = np.ones(data.shape[1:], dtype=bool) if present is None else present
+
+    @property
+    def values(self):
+        return self.data.transpose(1, 2, 0)
+
+    @property
+    def nan_mask(self):
+        return np.isnan(self.values)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def periods(self):
+        return self.start + np.arange(self.data.shape[2])
+
+    @property
+    def years(self):
+        return self.periods // 12
+
+    @property
+    def months(self):
+        return self.periods % 12 + 1
+
+    def variable(self, name):
+        return self.data[self.variables.index(name)]
+
+    # Long frame -> panel. The variable columns are copied once, column by column, into a single
+    # float32 block: a frame sorted by Location/year/month_number with every location on the same
+    # months (e.g. one returned by to_frame) is copied in row order and reshaped; any other frame is
+    # scattered onto the month grid.
+    @classmethod
+    def from_frame(cls, df, variables):
+        loc_idx, locations = pd.factorize(df['Location'], sort=True)
+        period = df['year'].to_numpy(dtype=int) * 12 + df['month_number'].to_numpy(dtype=int) - 1
+        start = period.min()
+        time_idx = period - start
+        n_locations, n_periods = len(locations), time_idx.max() + 1
+
+        first_rows = np.unique(loc_idx, return_index=True)[1]
+        country_code = df['country_code'].to_numpy()[first_rows]
+        region = df['region'].to_numpy()[first_rows]
+
+        if np.array_equal(loc_idx * n_periods + time_idx, np.arange(len(df))):
+            data = np.empty((len(variables), len(df)), dtype=np.float32)
+            for i, name in enumerate(variables):
+                data[i] = df[name].to_numpy(dtype=np.float32, na_value=np.nan)
+            data = data.reshape(len(variables), n_locations, n_periods)
+            return cls(data, variables, locations, country_code, region, start)
+
+        data = np.full((len(variables), n_locations, n_periods), np.nan, dtype=np.float32)
+        for i, name in enumerate(variables):
+            data[i, loc_idx, time_idx] = df[name].to_numpy(dtype=np.float32, na_value=np.nan)
+        present = np.zeros((n_locations, n_periods), dtype=bool)
+        present[loc_idx, time_idx] = True
+        return cls(data, variables, locations, country_code, region, start, present)
+
+    # Panel -> long frame indexed by (Location, year, month_number), one row per present month.
+    # When every month is present the variable columns are views of the panel's array.
+    def to_frame(self, with_ids=False):
+        n_locations, n_periods = self.present.shape
+        loc_idx = np.repeat(np.arange(n_locations), n_periods)
+        time_idx = np.tile(np.arange(n_periods), n_locations)
+        values = self.data.reshape(len(self.variables), -1).T
+
+        if not self.present.all():
+            keep = self.present.ravel()
+            loc_idx, time_idx, values = loc_idx[keep], time_idx[keep], values[keep]
+
+        index = pd.MultiIndex.from_arrays(
+            [self.locations[loc_idx], self.years[time_idx].astype('int16'), self.months[time_idx].astype('int8')],
+            names=['Location', 'year', 'month_number']
+        )
+        frame = pd.DataFrame(values, index=index, columns=self.variables, copy=False)
+
+        if with_ids:
+            frame.insert(0, 'region', pd.Categorical(self.region[loc_idx]))
+            frame.insert(0, 'country_code', pd.Categorical(self.country_code[loc_idx]))
+        return frame
+
+    # New panel with extra (location, month) variables appended on the variable axis
+    def with_variables(self, new_variables):
+        names = list(new_variables)
+        stacked = np.stack([np.asarray(new_variables[name], dtype=np.float32) for name in names])
+        data = np.concatenate([self.data, stacked])
+        return ClimatePanel(data, self.variables + names, self.locations, self.country_code,
+                            self.region, self.start, self.present)
+
+    # Values `periods` months earlier, NaN before the start of the series
+    def shift(self, periods, variables=None):
+        data = self._select(variables)
+        shifted = np.full(data.shape, np.nan, dtype=np.float32)
+        if periods < data.shape[-1]:
+            shifted[..., periods:] = data[..., :data.shape[-1] - periods]
+        return shifted
+
+    # Trailing mean over `window` months ending `shift` months back, ignoring NaN months and
+    # requiring at least `min_periods` observed values. Computed from cumulative sums along time.
+    def rolling_mean(self, window, shift=1, variables=None, min_periods=1):
+        data = self._select(variables)
+        observed = ~np.isnan(data)
+        pad = [(0, 0)] * (data.ndim - 1) + [(1, 0)]
+        sums = np.pad(np.cumsum(np.where(observed, data, 0), axis=-1, dtype=np.float64), pad)
+        counts = np.pad(np.cumsum(observed, axis=-1), pad)
+
+        n_periods = data.shape[-1]
+        end = np.clip(np.arange(n_periods) - shift + 1, 0, n_periods)
+        begin = np.clip(end - window, 0, n_periods)
+        window_sum = sums[..., end] - sums[..., begin]
+        window_count = counts[..., end] - counts[..., begin]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = window_sum / window_count
+        return np.where(window_count >= min_periods, mean, np.nan).astype(np.float32)
+
+    # Range-based composite, e.g. tmax_temperature - tmin_temperature
+    def difference(self, high, low):
+        return self.variable(high) - self.variable(low)
+
+    # De Martonne aridity index
+    def aridity_index(self, precipitation='avg_precipitation', temperature='tavg_temperature'):
+        return self.variable(precipitation) // (self.variable(temperature) + 10)
+
+    def _select(self, variables):
+        if variables is None:
+            return self.data
+        return self.data[[self.variables.index(name) for name in variables]]
+
+# Lag and trailing rolling-mean features from a declarative spec:
+# {'variables': [...], 'lags': [...], 'windows': [...]}.
+# Every lag and window is computed for all variables and locations at once on the panel's month
+# grid, so nothing crosses a location boundary, and the results are gathered back to df's rows into
+# one preallocated float32 block (columns var_lag{k} then var_roll{w}, in spec order).
+# Rolling means exclude the current month to prevent leakage.
+@run_profile.profiled()
+def lag_rolling_features(df, spec):
+    variables, lags, windows = spec['variables'], spec['lags'], spec['windows']
+    panel = ClimatePanel.from_frame(df, variables)
+    loc_idx = panel.locations.get_indexer(df['Location'])
+    time_idx = (df['year'].to_numpy(dtype=int) * 12 + df['month_number'].to_numpy(dtype=int) - 1) - panel.start
+
+    columns = ([f'{var}_lag{lag}' for var in variables for lag in lags]
+               + [f'{var}_roll{window}' for var in variables for window in windows])
+    block = np.empty((len(df), len(columns)), dtype=np.float32, order='F')
+    var_pos = np.arange(len(variables))
+
+    for i, lag in enumerate(lags):
+        block[:, var_pos * len(lags) + i] = panel.shift(lag)[:, loc_idx, time_idx].T
+    offset = len(variables) * len(lags)
+    for i, window in enumerate(windows):
+        block[:, offset + var_pos * len(windows) + i] = panel.rolling_mean(window, shift=1)[:, loc_idx, time_idx].T
+
+    return pd.DataFrame(block, index=df.index, columns=columns, copy=False)
+
+def add_composite_features(df):
+    # Range-based interaction terms
+    df['temp_range'] = df['tmax_temperature'] - df['tmin_temperature']
+    df['precip_range'] = df['max_precipitation'] - df['min_precipitation']
+    df['aod_range'] = df['max_aod'] - df['min_aod']
+
+    # Interaction terms
+    df['aridity_index'] = df['avg_precipitation']//(df['tavg_temperature'] + 10) # De Martonne aridity index
+    return df
 
-# Ensuring correct sort order
-df = df.sort_values(['Location', 'year', 'month_number']).reset_index(drop=True)
+# Per-location tail state for appending new months to the lag/rolling features without
+# recomputing the history. For every location and variable it keeps the last max(lags) values and
+# the last max(windows) + 1 running (cumulative) sums and counts on the month grid, so each trailing
+# window sum is the same difference of running sums that lag_rolling_features takes.
+class FeatureState:
+    def __init__(self, spec, locations, country_code, region, end, tail, sums, counts):
+        self.spec = spec
+        self.locations = pd.Index(np.asarray(locations, dtype=object), name='Location')
+        self.country_code = np.asarray(country_code, dtype=object)
+        self.region = np.asarray(region, dtype=object)
+        self.end = int(end)  # first month (year * 12 + month - 1) not yet in the state
+        self.tail = tail  # (variable, location, max lag) float32
+        self.sums = sums  # (variable, location, max window + 1) float64
+        self.counts = counts  # (variable, location, max window + 1) int64
+
+    @classmethod
+    def from_frame(cls, df, spec):
+        panel = ClimatePanel.from_frame(df, spec['variables'])
+        n_lags, n_sums = max(spec['lags']), max(spec['windows']) + 1
+        observed = ~np.isnan(panel.data)
+
+        tail = np.concatenate([np.full(panel.data.shape[:2] + (n_lags,), np.nan, dtype=np.float32),
+                               panel.data], axis=-1)[..., -n_lags:]
+        zeros = np.zeros(panel.data.shape[:2] + (n_sums,))
+        sums = np.concatenate([zeros, np.cumsum(np.where(observed, panel.data, 0), axis=-1, dtype=np.float64)],
+                              axis=-1)[..., -n_sums:]
+        counts = np.concatenate([zeros.astype(np.int64), np.cumsum(observed, axis=-1)], axis=-1)[..., -n_sums:]
+
+        return cls(spec, panel.locations, panel.country_code, panel.region,
+                   panel.start + panel.data.shape[2], np.ascontiguousarray(tail), sums, counts)
+
+    # Lag and rolling features of the next month, from the state only
+    def next_features(self):
+        lags, windows = self.spec['lags'], self.spec['windows']
+        lagged = np.stack([self.tail[..., -lag] for lag in lags], axis=-1)
+
+        window_sum = np.stack([self.sums[..., -1] - self.sums[..., -1 - window] for window in windows], axis=-1)
+        window_count = np.stack([self.counts[..., -1] - self.counts[..., -1 - window] for window in windows], axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = window_sum / window_count
+        rolled = np.where(window_count >= 1, mean, np.nan).astype(np.float32)
+
+        return lagged, rolled
+
+    # Move the state one month forward with that month's (variable, location) values
+    def advance(self, values):
+        observed = ~np.isnan(values)
+        self.tail = np.concatenate([self.tail[..., 1:], values[..., np.newaxis]], axis=-1)
+        self.sums = np.concatenate([self.sums[..., 1:], (self.sums[..., -1] + np.where(observed, values, 0))[..., np.newaxis]], axis=-1)
+        self.counts = np.concatenate([self.counts[..., 1:], (self.counts[..., -1] + observed)[..., np.newaxis]], axis=-1)
+        self.end += 1
+
+    def add_locations(self, locations, country_code, region):
+        n_new = len(locations)
+        n_variables = len(self.spec['variables'])
+        self.locations = self.locations.append(pd.Index(np.asarray(locations, dtype=object), name='Location'))
+        self.country_code = np.concatenate([self.country_code, np.asarray(country_code, dtype=object)])
+        self.region = np.concatenate([self.region, np.asarray(region, dtype=object)])
+        self.tail = np.concatenate([self.tail, np.full((n_variables, n_new, self.tail.shape[-1]), np.nan, dtype=np.float32)], axis=1)
+        self.sums = np.concatenate([self.sums, np.zeros((n_variables, n_new, self.sums.shape[-1]))], axis=1)
+        self.counts = np.concatenate([self.counts, np.zeros((n_variables, n_new, self.counts.shape[-1]), dtype=np.int64)], axis=1)
+
+# Features for newly arrived months only, in O(new rows).
+# new_rows holds raw climate rows (merged-data schema) for months after the state's last month;
+# locations without a row in a month get a missing month, new locations start with an empty
+# history. The state is updated in place. The returned rows carry the spec variables, their lag and
+# rolling columns and month_sin/month_cos, identical to a full lag_rolling_features recompute.
+def append_month(panel_state, new_rows):
+    spec = panel_state.spec
+    variables, lags, windows = spec['variables'], spec['lags'], spec['windows']
+    rows = add_composite_features(new_rows.copy())
+
+    period = rows['year'].to_numpy(dtype=int) * 12 + rows['month_number'].to_numpy(dtype=int) - 1
+    if len(rows) and period.min() < panel_state.end:
+        raise ValueError("new_rows contain months that are already in the feature state")
+
+    new_locations = rows.drop_duplicates('Location')
+    new_locations = new_locations[~new_locations['Location'].isin(panel_state.locations)]
+    if len(new_locations):
+        panel_state.add_locations(new_locations['Location'].to_numpy(), new_locations['country_code'].to_numpy(),
+                                  new_locations['region'].to_numpy())
+
+    loc_idx = panel_state.locations.get_indexer(rows['Location'])
+    values = rows[variables].to_numpy(dtype=np.float32).T
+
+    columns = ([f'{var}_lag{lag}' for var in variables for lag in lags]
+               + [f'{var}_roll{window}' for var in variables for window in windows])
+    block = np.empty((len(rows), len(columns)), dtype=np.float32, order='F')
+    var_pos = np.arange(len(variables))
+    offset = len(variables) * len(lags)
+
+    for month in range(panel_state.end, period.max() + 1 if len(rows) else panel_state.end):
+        in_month = np.flatnonzero(period == month)
+        lagged, rolled = panel_state.next_features()
+        for i in range(len(lags)):
+            block[np.ix_(in_month, var_pos * len(lags) + i)] = lagged[:, loc_idx[in_month], i].T
+        for i in range(len(windows)):
+            block[np.ix_(in_month, offset + var_pos * len(windows) + i)] = rolled[:, loc_idx[in_month], i].T
+
+        month_values = np.full((len(variables), len(panel_state.locations)), np.nan, dtype=np.float32)
+        month_values[:, loc_idx[in_month]] = values[:, in_month]
+        panel_state.advance(month_values)
+
+    features = rows[['Location', 'country_code', 'region', 'year', 'month_number'] + variables]
+    features = pd.concat([features, pd.DataFrame(block, index=rows.index, columns=columns, copy=False)], axis=1)
+    features['month_sin'] = np.sin(2 * np.pi * features['month_number'] / 12)
+    features['month_cos'] = np.cos(2 * np.pi * features['month_number'] / 12)
+    return features
 
 # Variables
 all_vars = ['tmin_temperature', 'precip_range', 'temp_range',
@@ -228,1378 +950,2015 @@ lags = [1, 3]
 # Rolling windows (in months)
 windows = [3, 6]
 
-# LAG FEATURES
-for var in all_vars:
-    for lag in lags:
-        df[f'{var}_lag{lag}'] = df.groupby('Location')[var].shift(lag)
-
-# ROLLING FEATURES (trailing only)
-for var in all_vars:
-    for window in windows:
-        df[f'{var}_roll{window}'] = (
-            df.groupby('Location')[var]
-              .shift(1)  # excluding current month to prevent leakage
-              .rolling(window=window, min_periods=1)
-              .mean()
-              .reset_index(level=0, drop=True)
-        )
-
-# Encoding cyclicality and indicating that December and January are adjacent
-df['month_sin'] = np.sin(2 * np.pi * df['month_number'] / 12)
-df['month_cos'] = np.cos(2 * np.pi * df['month_number'] / 12)
-final_df = df.copy().reset_index(drop=True)
-
-"""#**Feature Selection and Modeling**
-
-## **Region Specific Model for Central Africa**
-
-###**Feature Selection**
-"""
-
-df = final_df[final_df['region'] == 'Central Africa'].copy().reset_index(drop=True)
-exclude_cols = ['Value', 'year', 'month_number', 'Location', 'region', 'country_code']
-numeric_cols = df.select_dtypes(include='number').columns
-feature_cols = [col for col in numeric_cols if col not in exclude_cols]
-
-# Feature Importance
-df_model = df.copy()
-X = df_model[feature_cols]
-y = df_model['Value']
-xgb_model = xgb.XGBRegressor(n_estimators=100, random_state=42)
-xgb_model.fit(X, y)
-importance_df = pd.DataFrame({
-    'feature': X.columns,
-    'importance': xgb_model.feature_importances_
-}).sort_values(by='importance', ascending=False)
-top_features = importance_df.sort_values(by="importance", ascending=False)
-
-# Computing correlation matrix
-corr = df[feature_cols].corr().abs()
-
-# Converting to distance matrix (1 - abs(correlation))
-distance_matrix = 1 - corr
-
-# Hierarchical clustering
-linkage_matrix = linkage(squareform(distance_matrix), method='average')
-
-# Assigning features to clusters
-cluster_labels = fcluster(linkage_matrix, t=0.2, criterion='distance')
-cluster_df = pd.DataFrame({'feature': corr.columns, 'cluster': cluster_labels})
-
-
-# Merging cluster data with feature importance scores for final feature selection
-features = pd.merge(cluster_df, top_features, on=['feature'], how='inner')
-
-# Ranking within each cluster by descending importance
-features['rank'] = features.groupby('cluster')['importance'] \
-                           .rank(method='first', ascending=False)
-
-features['selected'] = np.where(
-    (features['rank'] == 1) & (features['importance'] > 0),
-    'Select',
-    ''
-)
-
-features = features.sort_values(by=["cluster", "importance"], ascending=[True, False]).reset_index(drop=True)
-features['importance']= features['importance'].round(4)
-features
-
-low_importance_collinear_features = features[features['selected'] != "Select"]['feature'].tolist()
-df = df.drop(columns=low_importance_collinear_features)
-
-# Features
-exclude_cols = ['Value', 'year', 'month_number', 'Location', 'region', 'country_code']
-numeric_cols = df.select_dtypes(include='number').columns
-feature_cols = [col for col in numeric_cols if col not in exclude_cols]
-
-
-# Group-based interpolation and fallback to global mean
-df_imputed = df.copy()
-
-# Applying backward fill to columns with little missing data
-columns_to_bfill = df.columns[(df.isna().sum() >= 1) & (df.isna().sum() <= 49)]
-
-df_imputed[columns_to_bfill] = (
-    df.groupby('Location')[columns_to_bfill]
-    .transform(lambda group: group.bfill())
-)
-
-# Interpolating missing values within each country
-df_imputed[feature_cols] = (
-    df.groupby('Location')[feature_cols]
-    .transform(lambda group: group.fillna(group.mean()))
-)
-
-# Fallback: filling remaining NaNs with region-wise median
-df_imputed[feature_cols] = (
-    df_imputed
-    .groupby('region')[feature_cols]
-    .transform(lambda group: group.fillna(group.median()))
-)
-
-# Final fallback: fill any still-missing values with global column median
-df_imputed[feature_cols] = df_imputed[feature_cols].fillna(df_imputed[feature_cols].median())
-
-# VIF
-X = df_imputed[feature_cols]
-constant_filter = VarianceThreshold(threshold=0.0)
-X = X.loc[:, constant_filter.fit(X).get_support()]
-X = add_constant(X)
-vif_data = pd.DataFrame()
-vif_data["feature"] = X.columns
-vif_data["VIF"] = [variance_inflation_factor(X.values, i)
-                   for i in range(X.shape[1])]
-vif_data = vif_data[vif_data["feature"] != "const"]
-
-# Merging both
-features = pd.merge(vif_data, features[['feature', 'importance']], on=['feature'], how='left')
-features = features.sort_values(by='importance', ascending=False)
-features.reset_index(drop=True)
-
-high_VIF_features = features[features['VIF'] > 7]['feature'].tolist()
-df = df.drop(columns=high_VIF_features)
-
-"""### **Selected Features**"""
-
-# Features
-exclude_cols = ['Value', 'year', 'month_number', 'Location', 'region', 'country_code']
-numeric_cols = df.select_dtypes(include='number').columns
-feature_cols = [col for col in numeric_cols if col not in exclude_cols]
-
-# Feature Importance
-df_model = df.copy()
-X = df_model[feature_cols]
-y = df_model['Value']
-xgb_model = xgb.XGBRegressor(n_estimators=100, random_state=42)
-xgb_model.fit(X, y)
-importance_df = pd.DataFrame({
-    'feature': X.columns,
-    'importance': xgb_model.feature_importances_
-}).sort_values(by='importance', ascending=False)
-top_features = importance_df.sort_values(by="importance", ascending=False)
-
-
-# VIF
-X = df_imputed[feature_cols]
-constant_filter = VarianceThreshold(threshold=0.0)
-X = X.loc[:, constant_filter.fit(X).get_support()]
-X = add_constant(X)
-vif_data = pd.DataFrame()
-vif_data["feature"] = X.columns
-vif_data["VIF"] = [variance_inflation_factor(X.values, i)
-                   for i in range(X.shape[1])]
-vif_data = vif_data[vif_data["feature"] != "const"]
-
-# Merging both
-features = pd.merge(top_features, vif_data, on=['feature'], how='inner')
-features = features.sort_values(by='importance', ascending=False).reset_index(drop=True)
-features
-
-"""###**Modeling**"""
-
-# XGBoost Model
-
-X = df[feature_cols]
-y = df['Value']  # mortality
-
-# Train/test split
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-
-# Training XGBoost
-
-# Initial model
-# model = xgb.XGBRegressor(
-#     n_estimators=100,
-#     learning_rate=0.1,
-#     max_depth=4,
-#     random_state=42
-# )
-# model.fit(X_train, y_train)
-
-# Optimized model
-model = xgb.XGBRegressor(
-    objective='reg:squarederror',
-    n_estimators=1000, # More trees to allow learning more complex patterns
-    early_stopping_rounds=50, # adding stop if no improvement in 50 rounds to prevent long training & avoid overfitting
-    eval_metric='rmse',
-    learning_rate=0.05, #Lower learning rate for better generalization
-    max_depth=6, #Deeper trees to model interactions better
-    subsample=0.8, #Introducing row sampling for regularization to reduce overfitting
-    colsample_bytree=0.8, # including feature sampling per tree to improve generalization
-    random_state=42
-)
-
-
-# Fitting with eval set
-model.fit(
-    X_train, y_train,
-    eval_set=[(X_test, y_test)],
-    verbose=False
-)
-
-# Access best iteration and score
-print(f"Best iteration: {model.best_iteration}")
-print(f"Best score on validation set: {model.best_score}")
-
-# Make predictions using the best model
-predictions = model.predict(X_test)
-rmse = np.sqrt(mean_squared_error(y_test, predictions))
-print(f"RMSE on validation set using best model: {rmse}")
-
-# Regression Metrics
-
-y_pred = model.predict(X_test)
-y_pred = np.round(np.clip(y_pred, 0, None),0)
-
-rmse = np.sqrt(mean_squared_error(y_test, y_pred))
-mae = mean_absolute_error(y_test, y_pred)
-r2 = r2_score(y_test, y_pred)
-mape = np.mean(np.abs((y_test - y_pred) / y_test)) * 100
-
-print(f"RMSE: {rmse:.2f}")
-print(f"MAE: {mae:.2f}")
-print(f"R²: {r2:.3f}")
-print(f"MAPE: {mape:.2f}")
-
-# Residual Analysis:
-import matplotlib.pyplot as plt
-import seaborn as sns
-
-residuals = y_test - y_pred
-
-plt.figure(figsize=(8, 5))
-sns.histplot(residuals, kde=True)
-plt.title("Residual Distribution")
-plt.xlabel("Residual (Actual - Predicted)")
-plt.show()
-
-# Extracting SHAP Values For Explainability
-# SHAP explainer
-explainer = shap.TreeExplainer(model)
-shap_values = explainer(X)  # SHAP values for all rows
-
-# Converting SHAP Values to DataFrame
-shap_df = pd.DataFrame(shap_values.values, columns=X.columns)
-shap_df["base_value"] = shap_values.base_values #the baseline prediction (base_value)
-shap_df['region'] = df['region']
-shap_df['country_code'] = df['country_code']
-shap_df['Location'] = df['Location']
-shap_df['year'] = df['year']
-shap_df['month_number'] = df['month_number']
-shap_df['Value'] = df['Value']
-
-# Normalizing SHAP Scores (Climate Impact Weights)
-# Computing absolute shap values per row
-abs_shap = shap_df[feature_cols].abs()
-
-# Normalizing by row total to get % contribution
-norm_shap = abs_shap.div(abs_shap.sum(axis=1), axis=0)
-norm_shap.columns = [col + '_weight' for col in norm_shap.columns]
-
-# Combining with original data
-impact_df = pd.concat([df[['region', 'country_code', 'Location', 'year', 'month_number', 'Value']], norm_shap], axis=1)
-
-# Adding a “climate impact score” (magnitude of all SHAP)
-impact_df['climate_score'] = shap_df[feature_cols].sum(axis=1)
-impact_df['climate_score']  = np.round(np.clip(impact_df['climate_score'] , 0, None),0)
-
-columns_to_keep = ['region', 'country_code', 'Location', 'year', 'month_number', 'Value', 'climate_score']
-Central_Africa = impact_df[columns_to_keep].copy()
-
-"""## **Region Specific Model for East Africa**
-
-###**Feature Selection**
-"""
-
-df = final_df[final_df['region'] == 'East Africa'].copy().reset_index(drop=True)
-exclude_cols = ['Value', 'year', 'month_number', 'Location', 'region', 'country_code']
-numeric_cols = df.select_dtypes(include='number').columns
-feature_cols = [col for col in numeric_cols if col not in exclude_cols]
-
-# Feature Importance
-df_model = df.copy()
-X = df_model[feature_cols]
-y = df_model['Value']
-xgb_model = xgb.XGBRegressor(n_estimators=100, random_state=42)
-xgb_model.fit(X, y)
-importance_df = pd.DataFrame({
-    'feature': X.columns,
-    'importance': xgb_model.feature_importances_
-}).sort_values(by='importance', ascending=False)
-top_features = importance_df.sort_values(by="importance", ascending=False)
-
-# Computing correlation matrix
-corr = df[feature_cols].corr().abs()
-
-# Converting to distance matrix (1 - abs(correlation))
-distance_matrix = 1 - corr
-
-# Hierarchical clustering
-linkage_matrix = linkage(squareform(distance_matrix), method='average')
-
-# Assigning features to clusters
-cluster_labels = fcluster(linkage_matrix, t=0.2, criterion='distance')
-cluster_df = pd.DataFrame({'feature': corr.columns, 'cluster': cluster_labels})
-
-
-# Merging cluster data with feature importance scores for final feature selection
-features = pd.merge(cluster_df, top_features, on=['feature'], how='inner')
-
-# Ranking within each cluster by descending importance
-features['rank'] = features.groupby('cluster')['importance'] \
-                           .rank(method='first', ascending=False)
-
-features['selected'] = np.where(
-    (features['rank'] == 1) & (features['importance'] > 0),
-    'Select',
-    ''
-)
-
-features = features.sort_values(by=["cluster", "importance"], ascending=[True, False]).reset_index(drop=True)
-features['importance']= features['importance'].round(4)
-features
-
-low_importance_collinear_features = features[features['selected'] != "Select"]['feature'].tolist()
-df = df.drop(columns=low_importance_collinear_features)
-
-# Features
-exclude_cols = ['Value', 'year', 'month_number', 'Location', 'region', 'country_code']
-numeric_cols = df.select_dtypes(include='number').columns
-feature_cols = [col for col in numeric_cols if col not in exclude_cols]
-
-
-# Group-based interpolation and fallback to global mean
-df_imputed = df.copy()
-
-# Applying backward fill to columns with little missing data
-columns_to_bfill = df.columns[(df.isna().sum() >= 1) & (df.isna().sum() <= 49)]
-
-df_imputed[columns_to_bfill] = (
-    df.groupby('Location')[columns_to_bfill]
-    .transform(lambda group: group.bfill())
-)
-
-# Interpolating missing values within each country
-df_imputed[feature_cols] = (
-    df.groupby('Location')[feature_cols]
-    .transform(lambda group: group.fillna(group.mean()))
-)
-
-# Fallback: filling remaining NaNs with region-wise median
-df_imputed[feature_cols] = (
-    df_imputed
-    .groupby('region')[feature_cols]
-    .transform(lambda group: group.fillna(group.median()))
-)
-
-# Final fallback: fill any still-missing values with global column median
-df_imputed[feature_cols] = df_imputed[feature_cols].fillna(df_imputed[feature_cols].median())
-
-# VIF
-X = df_imputed[feature_cols]
-constant_filter = VarianceThreshold(threshold=0.0)
-X = X.loc[:, constant_filter.fit(X).get_support()]
-X = add_constant(X)
-vif_data = pd.DataFrame()
-vif_data["feature"] = X.columns
-vif_data["VIF"] = [variance_inflation_factor(X.values, i)
-                   for i in range(X.shape[1])]
-vif_data = vif_data[vif_data["feature"] != "const"]
-
-# Merging both
-features = pd.merge(vif_data, features[['feature', 'importance']], on=['feature'], how='left')
-features = features.sort_values(by='importance', ascending=False)
-features.reset_index(drop=True)
-
-high_VIF_features = features[features['VIF'] > 7]['feature'].tolist()
-df = df.drop(columns=high_VIF_features)
-
-"""### **Selected Features**"""
-
-# Features
-exclude_cols = ['Value', 'year', 'month_number', 'Location', 'region', 'country_code']
-numeric_cols = df.select_dtypes(include='number').columns
-feature_cols = [col for col in numeric_cols if col not in exclude_cols]
-
-# Feature Importance
-df_model = df.copy()
-X = df_model[feature_cols]
-y = df_model['Value']
-xgb_model = xgb.XGBRegressor(n_estimators=100, random_state=42)
-xgb_model.fit(X, y)
-importance_df = pd.DataFrame({
-    'feature': X.columns,
-    'importance': xgb_model.feature_importances_
-}).sort_values(by='importance', ascending=False)
-top_features = importance_df.sort_values(by="importance", ascending=False)
-
-
-# VIF
-X = df_imputed[feature_cols]
-constant_filter = VarianceThreshold(threshold=0.0)
-X = X.loc[:, constant_filter.fit(X).get_support()]
-X = add_constant(X)
-vif_data = pd.DataFrame()
-vif_data["feature"] = X.columns
-vif_data["VIF"] = [variance_inflation_factor(X.values, i)
-                   for i in range(X.shape[1])]
-vif_data = vif_data[vif_data["feature"] != "const"]
-
-# Merging both
-features = pd.merge(top_features, vif_data, on=['feature'], how='inner')
-features = features.sort_values(by='importance', ascending=False).reset_index(drop=True)
-features
-
-"""###**Modeling**"""
-
-# XGBoost Model
-
-X = df[feature_cols]
-y = df['Value']  # mortality
-
-# Train/test split
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-
-# Training XGBoost
-
-# Initial model
-# model = xgb.XGBRegressor(
-#     n_estimators=100,
-#     learning_rate=0.1,
-#     max_depth=4,
-#     random_state=42
-# )
-# model.fit(X_train, y_train)
-
-# Optimized model
-model = xgb.XGBRegressor(
-    objective='reg:squarederror',
-    n_estimators=1000, # More trees to allow learning more complex patterns
-    early_stopping_rounds=50, # adding stop if no improvement in 50 rounds to prevent long training & avoid overfitting
-    eval_metric='rmse',
-    learning_rate=0.05, #Lower learning rate for better generalization
-    max_depth=6, #Deeper trees to model interactions better
-    subsample=0.8, #Introducing row sampling for regularization to reduce overfitting
-    colsample_bytree=0.8, # including feature sampling per tree to improve generalization
-    random_state=42
-)
-
-
-# Fitting with eval set
-model.fit(
-    X_train, y_train,
-    eval_set=[(X_test, y_test)],
-    verbose=False
-)
-
-# Access best iteration and score
-print(f"Best iteration: {model.best_iteration}")
-print(f"Best score on validation set: {model.best_score}")
-
-# Make predictions using the best model
-predictions = model.predict(X_test)
-rmse = np.sqrt(mean_squared_error(y_test, predictions))
-print(f"RMSE on validation set using best model: {rmse}")
-
-# Regression Metrics
-
-y_pred = model.predict(X_test)
-y_pred = np.round(np.clip(y_pred, 0, None),0)
-
-rmse = np.sqrt(mean_squared_error(y_test, y_pred))
-mae = mean_absolute_error(y_test, y_pred)
-r2 = r2_score(y_test, y_pred)
-mape = np.mean(np.abs((y_test - y_pred) / y_test)) * 100
-
-print(f"RMSE: {rmse:.2f}")
-print(f"MAE: {mae:.2f}")
-print(f"R²: {r2:.3f}")
-print(f"MAPE: {mape:.2f}")
-
-# Residual Analysis:
-import matplotlib.pyplot as plt
-import seaborn as sns
-
-residuals = y_test - y_pred
-
-plt.figure(figsize=(8, 5))
-sns.histplot(residuals, kde=True)
-plt.title("Residual Distribution")
-plt.xlabel("Residual (Actual - Predicted)")
-plt.show()
-
-# Extracting SHAP Values For Explainability
-# SHAP explainer
-explainer = shap.TreeExplainer(model)
-shap_values = explainer(X)  # SHAP values for all rows
-
-# Converting SHAP Values to DataFrame
-shap_df = pd.DataFrame(shap_values.values, columns=X.columns)
-shap_df["base_value"] = shap_values.base_values #the baseline prediction (base_value)
-shap_df['region'] = df['region']
-shap_df['country_code'] = df['country_code']
-shap_df['Location'] = df['Location']
-shap_df['year'] = df['year']
-shap_df['month_number'] = df['month_number']
-shap_df['Value'] = df['Value']
-
-# Normalizing SHAP Scores (Climate Impact Weights)
-# Computing absolute shap values per row
-abs_shap = shap_df[feature_cols].abs()
-
-# Normalizing by row total to get % contribution
-norm_shap = abs_shap.div(abs_shap.sum(axis=1), axis=0)
-norm_shap.columns = [col + '_weight' for col in norm_shap.columns]
-
-# Combining with original data
-impact_df = pd.concat([df[['region', 'country_code', 'Location', 'year', 'month_number', 'Value']], norm_shap], axis=1)
-
-# Adding a “climate impact score” (magnitude of all SHAP)
-impact_df['climate_score'] = shap_df[feature_cols].sum(axis=1)
-impact_df['climate_score']  = np.round(np.clip(impact_df['climate_score'] , 0, None),0)
-
-columns_to_keep = ['region', 'country_code', 'Location', 'year', 'month_number', 'Value', 'climate_score']
-East_Africa = impact_df[columns_to_keep].copy()
-
-"""## **Region Specific Model for North Africa**
-
-###**Feature Selection**
-"""
-
-df = final_df[final_df['region'] == 'North Africa'].copy().reset_index(drop=True)
-exclude_cols = ['Value', 'year', 'month_number', 'Location', 'region', 'country_code']
-numeric_cols = df.select_dtypes(include='number').columns
-feature_cols = [col for col in numeric_cols if col not in exclude_cols]
-
-# Feature Importance
-df_model = df.copy()
-X = df_model[feature_cols]
-y = df_model['Value']
-xgb_model = xgb.XGBRegressor(n_estimators=100, random_state=42)
-xgb_model.fit(X, y)
-importance_df = pd.DataFrame({
-    'feature': X.columns,
-    'importance': xgb_model.feature_importances_
-}).sort_values(by='importance', ascending=False)
-top_features = importance_df.sort_values(by="importance", ascending=False)
-
-# Computing correlation matrix
-corr = df[feature_cols].corr().abs()
-
-# Converting to distance matrix (1 - abs(correlation))
-distance_matrix = 1 - corr
-
-# Hierarchical clustering
-linkage_matrix = linkage(squareform(distance_matrix), method='average')
-
-# Assigning features to clusters
-cluster_labels = fcluster(linkage_matrix, t=0.2, criterion='distance')
-cluster_df = pd.DataFrame({'feature': corr.columns, 'cluster': cluster_labels})
-
-
-# Merging cluster data with feature importance scores for final feature selection
-features = pd.merge(cluster_df, top_features, on=['feature'], how='inner')
-
-# Ranking within each cluster by descending importance
-features['rank'] = features.groupby('cluster')['importance'] \
-                           .rank(method='first', ascending=False)
-
-features['selected'] = np.where(
-    (features['rank'] == 1) & (features['importance'] > 0),
-    'Select',
-    ''
-)
-
-features = features.sort_values(by=["cluster", "importance"], ascending=[True, False]).reset_index(drop=True)
-features['importance']= features['importance'].round(4)
-features
-
-low_importance_collinear_features = features[features['selected'] != "Select"]['feature'].tolist()
-df = df.drop(columns=low_importance_collinear_features)
-
-# Features
-exclude_cols = ['Value', 'year', 'month_number', 'Location', 'region', 'country_code']
-numeric_cols = df.select_dtypes(include='number').columns
-feature_cols = [col for col in numeric_cols if col not in exclude_cols]
+feature_spec = {'variables': all_vars, 'lags': lags, 'windows': windows}
 
+# Skewness Evaluation
+def evaluate_skewness(dfX):
+    from scipy.stats import skew
+
+    # Identifying mean vs median feature columns
+    mean_cols = [col for col in dfX.columns if 'avg_' in col]
+    median_cols = [col for col in dfX.columns if 'med_' in col]
+
+    # Filtering only numeric columns to avoid dtype issues
+    mean_cols = [col for col in mean_cols if pd.api.types.is_numeric_dtype(dfX[col])]
+    median_cols = [col for col in median_cols if pd.api.types.is_numeric_dtype(dfX[col])]
+
+    # Evaluating skewness for each pair
+    results = []
+    for mean_col in mean_cols:
+        # Infer corresponding median col
+        med_col = mean_col.replace('avg_', 'med_')
+        if med_col in median_cols:
+            mean_skew = skew(dfX[mean_col].dropna())
+            med_skew = skew(dfX[med_col].dropna())
+            decision = 'drop_median' if abs(mean_skew) < abs(med_skew) else 'drop_mean'
+            results.append({
+                'feature_pair': (mean_col, med_col),
+                'mean_skew': mean_skew,
+                'median_skew': med_skew,
+                'drop': decision
+            })
+
+    # Creating DataFrame with results
+    skewness_dfX = pd.DataFrame(results)
+    skewness_dfX = skewness_dfX.sort_values(by='drop')
+
+    return skewness_dfX
 
-# Group-based interpolation and fallback to global mean
-df_imputed = df.copy()
+# Visualising results of Fisher-Pearson coefficient of skewness.
+def plot_skewness(ax, mean_values, median_values, title):
+    import seaborn as sns
 
-# Applying backward fill to columns with little missing data
-columns_to_bfill = df.columns[(df.isna().sum() >= 1) & (df.isna().sum() <= 49)]
+    sns.kdeplot(mean_values, label='Mean', ax=ax)
+    sns.kdeplot(median_values, label='Median', ax=ax)
+    ax.set_title(title)
+    ax.legend()
 
-df_imputed[columns_to_bfill] = (
-    df.groupby('Location')[columns_to_bfill]
-    .transform(lambda group: group.bfill())
-)
+# Feature frame for modeling from the augmented monthly data, plus the skewness evaluation that
+# motivated the dropped mean/median columns
+def build_feature_frame(final_filled_data, spec=feature_spec):
+    df = final_filled_data
 
-# Interpolating missing values within each country
-df_imputed[feature_cols] = (
-    df.groupby('Location')[feature_cols]
-    .transform(lambda group: group.fillna(group.mean()))
-)
+    # dropping yearly values used previously to aid augmentation
+    df = df.drop(columns=['Value', 'yearly_avg_temperature', 'yearly_avg_precipitation'])
+    df.rename(columns={'monthly_Value': 'Value'}, inplace=True)
 
-# Fallback: filling remaining NaNs with region-wise median
-df_imputed[feature_cols] = (
-    df_imputed
-    .groupby('region')[feature_cols]
-    .transform(lambda group: group.fillna(group.median()))
-)
+    #round death values
+    df['Value'] = df['Value'].round(0).clip(lower=0)
 
-# Final fallback: fill any still-missing values with global column median
-df_imputed[feature_cols] = df_imputed[feature_cols].fillna(df_imputed[feature_cols].median())
+    #Creating Composite features
+    df = add_composite_features(df)
 
-# VIF
-X = df_imputed[feature_cols]
-constant_filter = VarianceThreshold(threshold=0.0)
-X = X.loc[:, constant_filter.fit(X).get_support()]
-X = add_constant(X)
-vif_data = pd.DataFrame()
-vif_data["feature"] = X.columns
-vif_data["VIF"] = [variance_inflation_factor(X.values, i)
-                   for i in range(X.shape[1])]
-vif_data = vif_data[vif_data["feature"] != "const"]
-
-# Merging both
-features = pd.merge(vif_data, features[['feature', 'importance']], on=['feature'], how='left')
-features = features.sort_values(by='importance', ascending=False)
-features.reset_index(drop=True)
-
-high_VIF_features = features[features['VIF'] > 7]['feature'].tolist()
-df = df.drop(columns=high_VIF_features)
-
-"""### **Selected Features**"""
-
-# Features
-exclude_cols = ['Value', 'year', 'month_number', 'Location', 'region', 'country_code']
-numeric_cols = df.select_dtypes(include='number').columns
-feature_cols = [col for col in numeric_cols if col not in exclude_cols]
+    skewness_dfX = evaluate_skewness(df)
 
-# Feature Importance
-df_model = df.copy()
-X = df_model[feature_cols]
-y = df_model['Value']
-xgb_model = xgb.XGBRegressor(n_estimators=100, random_state=42)
-xgb_model.fit(X, y)
-importance_df = pd.DataFrame({
-    'feature': X.columns,
-    'importance': xgb_model.feature_importances_
-}).sort_values(by='importance', ascending=False)
-top_features = importance_df.sort_values(by="importance", ascending=False)
+    # Dropping columns with higher absolute skew toward better stability for modeling.
+    df = df.drop(columns=['tavg_temperature', 'avg_precipitation', 'med_aod'])
 
+    # Dropping columns based on results from EDA and granger causality testing
+    df = df.drop(columns=['min_aod', 'avg_aod', 'aod_range'])
 
-# VIF
-X = df_imputed[feature_cols]
-constant_filter = VarianceThreshold(threshold=0.0)
-X = X.loc[:, constant_filter.fit(X).get_support()]
-X = add_constant(X)
-vif_data = pd.DataFrame()
-vif_data["feature"] = X.columns
-vif_data["VIF"] = [variance_inflation_factor(X.values, i)
-                   for i in range(X.shape[1])]
-vif_data = vif_data[vif_data["feature"] != "const"]
-
-# Merging both
-features = pd.merge(top_features, vif_data, on=['feature'], how='inner')
-features = features.sort_values(by='importance', ascending=False).reset_index(drop=True)
-features
-
-"""###**Modeling**"""
-
-# XGBoost Model
-
-X = df[feature_cols]
-y = df['Value']  # mortality
-
-# Train/test split
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-
-# Training XGBoost
-
-# Initial model
-# model = xgb.XGBRegressor(
-#     n_estimators=100,
-#     learning_rate=0.1,
-#     max_depth=4,
-#     random_state=42
-# )
-# model.fit(X_train, y_train)
-
-# Optimized model
-model = xgb.XGBRegressor(
-    objective='reg:squarederror',
-    n_estimators=1000, # More trees to allow learning more complex patterns
-    early_stopping_rounds=50, # adding stop if no improvement in 50 rounds to prevent long training & avoid overfitting
-    eval_metric='rmse',
-    learning_rate=0.05, #Lower learning rate for better generalization
-    max_depth=6, #Deeper trees to model interactions better
-    subsample=0.8, #Introducing row sampling for regularization to reduce overfitting
-    colsample_bytree=0.8, # including feature sampling per tree to improve generalization
-    random_state=42
-)
-
-
-# Fitting with eval set
-model.fit(
-    X_train, y_train,
-    eval_set=[(X_test, y_test)],
-    verbose=False
-)
-
-# Access best iteration and score
-print(f"Best iteration: {model.best_iteration}")
-print(f"Best score on validation set: {model.best_score}")
-
-# Make predictions using the best model
-predictions = model.predict(X_test)
-rmse = np.sqrt(mean_squared_error(y_test, predictions))
-print(f"RMSE on validation set using best model: {rmse}")
-
-# Regression Metrics
-
-y_pred = model.predict(X_test)
-y_pred = np.round(np.clip(y_pred, 0, None),0)
-
-rmse = np.sqrt(mean_squared_error(y_test, y_pred))
-mae = mean_absolute_error(y_test, y_pred)
-r2 = r2_score(y_test, y_pred)
-mape = np.mean(np.abs((y_test - y_pred) / y_test)) * 100
-
-print(f"RMSE: {rmse:.2f}")
-print(f"MAE: {mae:.2f}")
-print(f"R²: {r2:.3f}")
-print(f"MAPE: {mape:.2f}")
-
-# Residual Analysis:
-import matplotlib.pyplot as plt
-import seaborn as sns
-
-residuals = y_test - y_pred
-
-plt.figure(figsize=(8, 5))
-sns.histplot(residuals, kde=True)
-plt.title("Residual Distribution")
-plt.xlabel("Residual (Actual - Predicted)")
-plt.show()
+    # Adding lag features and rolling average features to capture delayed health effects of climate stressors.
 
-# Extracting SHAP Values For Explainability
-# SHAP explainer
-explainer = shap.TreeExplainer(model)
-shap_values = explainer(X)  # SHAP values for all rows
+    # Ensuring correct sort order
+    df = df.sort_values(['Location', 'year', 'month_number']).reset_index(drop=True)
 
-# Converting SHAP Values to DataFrame
-shap_df = pd.DataFrame(shap_values.values, columns=X.columns)
-shap_df["base_value"] = shap_values.base_values #the baseline prediction (base_value)
-shap_df['region'] = df['region']
-shap_df['country_code'] = df['country_code']
-shap_df['Location'] = df['Location']
-shap_df['year'] = df['year']
-shap_df['month_number'] = df['month_number']
-shap_df['Value'] = df['Value']
+    # LAG AND ROLLING FEATURES (trailing only)
+    df = pd.concat([df, lag_rolling_features(df, spec)], axis=1)
 
-# Normalizing SHAP Scores (Climate Impact Weights)
-# Computing absolute shap values per row
-abs_shap = shap_df[feature_cols].abs()
+    # Encoding cyclicality and indicating that December and January are adjacent
+    df['month_sin'] = np.sin(2 * np.pi * df['month_number'] / 12)
+    df['month_cos'] = np.cos(2 * np.pi * df['month_number'] / 12)
+    final_df = df.copy().reset_index(drop=True)
 
-# Normalizing by row total to get % contribution
-norm_shap = abs_shap.div(abs_shap.sum(axis=1), axis=0)
-norm_shap.columns = [col + '_weight' for col in norm_shap.columns]
+    return final_df, skewness_dfX
 
-# Combining with original data
-impact_df = pd.concat([df[['region', 'country_code', 'Location', 'year', 'month_number', 'Value']], norm_shap], axis=1)
-
-# Adding a “climate impact score” (magnitude of all SHAP)
-impact_df['climate_score'] = shap_df[feature_cols].sum(axis=1)
-impact_df['climate_score']  = np.round(np.clip(impact_df['climate_score'] , 0, None),0)
-
-columns_to_keep = ['region', 'country_code', 'Location', 'year', 'month_number', 'Value', 'climate_score']
-North_Africa = impact_df[columns_to_keep].copy()
+"""#**Feature Selection and Modeling**
 
-"""## **Region Specific Model for Southern Africa**
+## **Region Specific Models**
 
-###**Feature Selection**
+The same feature selection, imputation, VIF, modeling and SHAP workflow runs for Central, East,
+North, Southern and West Africa.
 """
 
-df = final_df[final_df['region'] == 'Southern Africa'].copy().reset_index(drop=True)
-exclude_cols = ['Value', 'year', 'month_number', 'Location', 'region', 'country_code']
-numeric_cols = df.select_dtypes(include='number').columns
-feature_cols = [col for col in numeric_cols if col not in exclude_cols]
-
-# Feature Importance
-df_model = df.copy()
-X = df_model[feature_cols]
-y = df_model['Value']
-xgb_model = xgb.XGBRegressor(n_estimators=100, random_state=42)
-xgb_model.fit(X, y)
-importance_df = pd.DataFrame({
-    'feature': X.columns,
-    'importance': xgb_model.feature_importances_
-}).sort_values(by='importance', ascending=False)
-top_features = importance_df.sort_values(by="importance", ascending=False)
-
-# Computing correlation matrix
-corr = df[feature_cols].corr().abs()
-
-# Converting to distance matrix (1 - abs(correlation))
-distance_matrix = 1 - corr
-
-# Hierarchical clustering
-linkage_matrix = linkage(squareform(distance_matrix), method='average')
-
-# Assigning features to clusters
-cluster_labels = fcluster(linkage_matrix, t=0.2, criterion='distance')
-cluster_df = pd.DataFrame({'feature': corr.columns, 'cluster': cluster_labels})
-
-
-# Merging cluster data with feature importance scores for final feature selection
-features = pd.merge(cluster_df, top_features, on=['feature'], how='inner')
-
-# Ranking within each cluster by descending importance
-features['rank'] = features.groupby('cluster')['importance'] \
-                           .rank(method='first', ascending=False)
-
-features['selected'] = np.where(
-    (features['rank'] == 1) & (features['importance'] > 0),
-    'Select',
-    ''
-)
-
-features = features.sort_values(by=["cluster", "importance"], ascending=[True, False]).reset_index(drop=True)
-features['importance']= features['importance'].round(4)
-features
-
-low_importance_collinear_features = features[features['selected'] != "Select"]['feature'].tolist()
-df = df.drop(columns=low_importance_collinear_features)
+REGIONS = ['Central Africa', 'East Africa', 'North Africa', 'Southern Africa', 'West Africa']
 
-# Features
 exclude_cols = ['Value', 'year', 'month_number', 'Location', 'region', 'country_code']
-numeric_cols = df.select_dtypes(include='number').columns
-feature_cols = [col for col in numeric_cols if col not in exclude_cols]
-
-
-# Group-based interpolation and fallback to global mean
-df_imputed = df.copy()
-
-# Applying backward fill to columns with little missing data
-columns_to_bfill = df.columns[(df.isna().sum() >= 1) & (df.isna().sum() <= 49)]
-
-df_imputed[columns_to_bfill] = (
-    df.groupby('Location')[columns_to_bfill]
-    .transform(lambda group: group.bfill())
-)
-
-# Interpolating missing values within each country
-df_imputed[feature_cols] = (
-    df.groupby('Location')[feature_cols]
-    .transform(lambda group: group.fillna(group.mean()))
-)
-
-# Fallback: filling remaining NaNs with region-wise median
-df_imputed[feature_cols] = (
-    df_imputed
-    .groupby('region')[feature_cols]
-    .transform(lambda group: group.fillna(group.median()))
-)
-
-# Final fallback: fill any still-missing values with global column median
-df_imputed[feature_cols] = df_imputed[feature_cols].fillna(df_imputed[feature_cols].median())
-
-# VIF
-X = df_imputed[feature_cols]
-constant_filter = VarianceThreshold(threshold=0.0)
-X = X.loc[:, constant_filter.fit(X).get_support()]
-X = add_constant(X)
-vif_data = pd.DataFrame()
-vif_data["feature"] = X.columns
-vif_data["VIF"] = [variance_inflation_factor(X.values, i)
-                   for i in range(X.shape[1])]
-vif_data = vif_data[vif_data["feature"] != "const"]
-
-# Merging both
-features = pd.merge(vif_data, features[['feature', 'importance']], on=['feature'], how='left')
-features = features.sort_values(by='importance', ascending=False)
-features.reset_index(drop=True)
-
-high_VIF_features = features[features['VIF'] > 7]['feature'].tolist()
-df = df.drop(columns=high_VIF_features)
-
-"""### **Selected Features**"""
-
-# Features
-exclude_cols = ['Value', 'year', 'month_number', 'Location', 'region', 'country_code']
-numeric_cols = df.select_dtypes(include='number').columns
-feature_cols = [col for col in numeric_cols if col not in exclude_cols]
-
-# Feature Importance
-df_model = df.copy()
-X = df_model[feature_cols]
-y = df_model['Value']
-xgb_model = xgb.XGBRegressor(n_estimators=100, random_state=42)
-xgb_model.fit(X, y)
-importance_df = pd.DataFrame({
-    'feature': X.columns,
-    'importance': xgb_model.feature_importances_
-}).sort_values(by='importance', ascending=False)
-top_features = importance_df.sort_values(by="importance", ascending=False)
-
-
-# VIF
-X = df_imputed[feature_cols]
-constant_filter = VarianceThreshold(threshold=0.0)
-X = X.loc[:, constant_filter.fit(X).get_support()]
-X = add_constant(X)
-vif_data = pd.DataFrame()
-vif_data["feature"] = X.columns
-vif_data["VIF"] = [variance_inflation_factor(X.values, i)
-                   for i in range(X.shape[1])]
-vif_data = vif_data[vif_data["feature"] != "const"]
-
-# Merging both
-features = pd.merge(top_features, vif_data, on=['feature'], how='inner')
-features = features.sort_values(by='importance', ascending=False).reset_index(drop=True)
-features
-
-"""###**Modeling**"""
-
-# XGBoost Model
-
-X = df[feature_cols]
-y = df['Value']  # mortality
-
-# Train/test split
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-
-# Training XGBoost
-
-# Initial model
-# model = xgb.XGBRegressor(
-#     n_estimators=100,
-#     learning_rate=0.1,
-#     max_depth=4,
-#     random_state=42
-# )
-# model.fit(X_train, y_train)
-
-# Optimized model
-model = xgb.XGBRegressor(
-    objective='reg:squarederror',
-    n_estimators=1000, # More trees to allow learning more complex patterns
-    early_stopping_rounds=50, # adding stop if no improvement in 50 rounds to prevent long training & avoid overfitting
-    eval_metric='rmse',
-    learning_rate=0.05, #Lower learning rate for better generalization
-    max_depth=6, #Deeper trees to model interactions better
-    subsample=0.8, #Introducing row sampling for regularization to reduce overfitting
-    colsample_bytree=0.8, # including feature sampling per tree to improve generalization
-    random_state=42
-)
-
-
-# Fitting with eval set
-model.fit(
-    X_train, y_train,
-    eval_set=[(X_test, y_test)],
-    verbose=False
-)
-
-# Access best iteration and score
-print(f"Best iteration: {model.best_iteration}")
-print(f"Best score on validation set: {model.best_score}")
-
-# Make predictions using the best model
-predictions = model.predict(X_test)
-rmse = np.sqrt(mean_squared_error(y_test, predictions))
-print(f"RMSE on validation set using best model: {rmse}")
-
-# Regression Metrics
-
-y_pred = model.predict(X_test)
-y_pred = np.round(np.clip(y_pred, 0, None),0)
-
-rmse = np.sqrt(mean_squared_error(y_test, y_pred))
-mae = mean_absolute_error(y_test, y_pred)
-r2 = r2_score(y_test, y_pred)
-mape = np.mean(np.abs((y_test - y_pred) / y_test)) * 100
-
-print(f"RMSE: {rmse:.2f}")
-print(f"MAE: {mae:.2f}")
-print(f"R²: {r2:.3f}")
-print(f"MAPE: {mape:.2f}")
-
-# Residual Analysis:
-import matplotlib.pyplot as plt
-import seaborn as sns
-
-residuals = y_test - y_pred
-
-plt.figure(figsize=(8, 5))
-sns.histplot(residuals, kde=True)
-plt.title("Residual Distribution")
-plt.xlabel("Residual (Actual - Predicted)")
-plt.show()
-
-# Extracting SHAP Values For Explainability
-# SHAP explainer
-explainer = shap.TreeExplainer(model)
-shap_values = explainer(X)  # SHAP values for all rows
-
-# Converting SHAP Values to DataFrame
-shap_df = pd.DataFrame(shap_values.values, columns=X.columns)
-shap_df["base_value"] = shap_values.base_values #the baseline prediction (base_value)
-shap_df['region'] = df['region']
-shap_df['country_code'] = df['country_code']
-shap_df['Location'] = df['Location']
-shap_df['year'] = df['year']
-shap_df['month_number'] = df['month_number']
-shap_df['Value'] = df['Value']
-
-# Normalizing SHAP Scores (Climate Impact Weights)
-# Computing absolute shap values per row
-abs_shap = shap_df[feature_cols].abs()
-
-# Normalizing by row total to get % contribution
-norm_shap = abs_shap.div(abs_shap.sum(axis=1), axis=0)
-norm_shap.columns = [col + '_weight' for col in norm_shap.columns]
-
-# Combining with original data
-impact_df = pd.concat([df[['region', 'country_code', 'Location', 'year', 'month_number', 'Value']], norm_shap], axis=1)
-
-# Adding a “climate impact score” (magnitude of all SHAP)
-impact_df['climate_score'] = shap_df[feature_cols].sum(axis=1)
-impact_df['climate_score']  = np.round(np.clip(impact_df['climate_score'] , 0, None),0)
 
-columns_to_keep = ['region', 'country_code', 'Location', 'year', 'month_number', 'Value', 'climate_score']
-Southern_Africa = impact_df[columns_to_keep].copy()
-
-"""## **Region Specific Model for West Africa**
-
-###**Feature Selection**
-"""
-
-df = final_df[final_df['region'] == 'West Africa'].copy().reset_index(drop=True)
-exclude_cols = ['Value', 'year', 'month_number', 'Location', 'region', 'country_code']
-numeric_cols = df.select_dtypes(include='number').columns
-feature_cols = [col for col in numeric_cols if col not in exclude_cols]
+region_config = {
+    'random_state': 42,
+    'importance_estimators': 100,
+    'cluster_distance': 0.2, # features closer than this (1 - abs(correlation)) share a cluster
+    'vif_threshold': 7,
+    'vif_elimination': 'all', # 'all' drops every feature above the threshold, 'iterative' one at a time
+    'test_size': 0.2,
+    'n_jobs': None, # XGBoost threads, set per worker by run_all_regions
+    'contribution_backend': 'native', # 'native' (Booster pred_contribs) or 'shap' (shap.TreeExplainer)
+    'attribution_chunk_size': 65536, # rows scored per chunk
+    'attribution_workers': 1, # threads scoring chunks in parallel
+    'attribution_path': os.environ.get('SCA_ATTRIBUTION_PATH'), # Parquet dataset for the weights, None to skip
+    'attribution_cache_dir': os.path.join(CACHE_DIR, 'attribution'), # None recomputes every row
+
+    # Optimized model
+    'model_params': {
+        'objective': 'reg:squarederror',
+        'n_estimators': 1000, # More trees to allow learning more complex patterns
+        'early_stopping_rounds': 50, # adding stop if no improvement in 50 rounds to prevent long training & avoid overfitting
+        'eval_metric': 'rmse',
+        'learning_rate': 0.05, #Lower learning rate for better generalization
+        'max_depth': 6, #Deeper trees to model interactions better
+        'subsample': 0.8, #Introducing row sampling for regularization to reduce overfitting
+        'colsample_bytree': 0.8, # including feature sampling per tree to improve generalization
+    }
+}
+
+def _feature_columns(df):
+    numeric_cols = df.select_dtypes(include='number').columns
+    return [col for col in numeric_cols if col not in exclude_cols]
+
+# XGBoost on shared QuantileDMatrix objects
+# The sklearn wrapper quantizes its inputs again on every fit. Instead the region's features are
+# converted once to a float32 block, the training rows are quantized once per feature set and the
+# evaluation and full-sample matrices reuse those cut points (ref=). Parameters are taken from
+# XGBRegressor.get_xgb_params(), so the boosters are the ones the sklearn estimators would fit.
+def _booster_params(config, **params):
+    import xgboost as xgb
+
+    params = xgb.XGBRegressor(**params, random_state=config['random_state'],
+                              n_jobs=config['n_jobs']).get_xgb_params()
+    return {key: value for key, value in params.items() if value is not None}
+
+def _gain_importance(booster, feature_names):
+    # Same normalization as XGBRegressor.feature_importances_
+    score = booster.get_score(importance_type='gain')
+    importance = np.array([score.get(name, 0.0) for name in feature_names], dtype=np.float32)
+    total = importance.sum()
+    return importance / total if total else importance
 
 # Feature Importance
-df_model = df.copy()
-X = df_model[feature_cols]
-y = df_model['Value']
-xgb_model = xgb.XGBRegressor(n_estimators=100, random_state=42)
-xgb_model.fit(X, y)
-importance_df = pd.DataFrame({
-    'feature': X.columns,
-    'importance': xgb_model.feature_importances_
-}).sort_values(by='importance', ascending=False)
-top_features = importance_df.sort_values(by="importance", ascending=False)
-
-# Computing correlation matrix
-corr = df[feature_cols].corr().abs()
-
-# Converting to distance matrix (1 - abs(correlation))
-distance_matrix = 1 - corr
-
-# Hierarchical clustering
-linkage_matrix = linkage(squareform(distance_matrix), method='average')
-
-# Assigning features to clusters
-cluster_labels = fcluster(linkage_matrix, t=0.2, criterion='distance')
-cluster_df = pd.DataFrame({'feature': corr.columns, 'cluster': cluster_labels})
-
-
-# Merging cluster data with feature importance scores for final feature selection
-features = pd.merge(cluster_df, top_features, on=['feature'], how='inner')
-
-# Ranking within each cluster by descending importance
-features['rank'] = features.groupby('cluster')['importance'] \
-                           .rank(method='first', ascending=False)
-
-features['selected'] = np.where(
-    (features['rank'] == 1) & (features['importance'] > 0),
-    'Select',
-    ''
-)
-
-features = features.sort_values(by=["cluster", "importance"], ascending=[True, False]).reset_index(drop=True)
-features['importance']= features['importance'].round(4)
-features
-
-low_importance_collinear_features = features[features['selected'] != "Select"]['feature'].tolist()
-df = df.drop(columns=low_importance_collinear_features)
-
-# Features
-exclude_cols = ['Value', 'year', 'month_number', 'Location', 'region', 'country_code']
-numeric_cols = df.select_dtypes(include='number').columns
-feature_cols = [col for col in numeric_cols if col not in exclude_cols]
-
+@run_profile.profiled()
+def feature_importance(dmatrix, config):
+    import xgboost as xgb
+
+    booster = xgb.train(_booster_params(config), dmatrix, num_boost_round=config['importance_estimators'])
+    importance_df = pd.DataFrame({
+        'feature': dmatrix.feature_names,
+        'importance': _gain_importance(booster, dmatrix.feature_names)
+    }).sort_values(by='importance', ascending=False)
+    return importance_df
+
+# Final model: early stopping on the evaluation matrix, as XGBRegressor.fit(eval_set=...) does
+@run_profile.profiled('xgboost_fit')
+def train_region_model(train, test, config):
+    import xgboost as xgb
+
+    params = dict(config['model_params'])
+    num_boost_round = params.pop('n_estimators')
+    early_stopping_rounds = params.pop('early_stopping_rounds')
+    return xgb.train(_booster_params(config, **params), train, num_boost_round=num_boost_round,
+                     evals=[(test, 'validation_0')], early_stopping_rounds=early_stopping_rounds,
+                     verbose_eval=False)
 
 # Group-based interpolation and fallback to global mean
-df_imputed = df.copy()
+def impute_region_features(df, feature_cols):
+    df_imputed = df.copy()
 
-# Applying backward fill to columns with little missing data
-columns_to_bfill = df.columns[(df.isna().sum() >= 1) & (df.isna().sum() <= 49)]
+    # Applying backward fill to columns with little missing data
+    columns_to_bfill = df.columns[(df.isna().sum() >= 1) & (df.isna().sum() <= 49)]
 
-df_imputed[columns_to_bfill] = (
-    df.groupby('Location')[columns_to_bfill]
-    .transform(lambda group: group.bfill())
-)
+    if len(columns_to_bfill):
+        df_imputed[columns_to_bfill] = (
+            df.groupby('Location', observed=True)[columns_to_bfill]
+            .transform(lambda group: group.bfill())
+        )
 
-# Interpolating missing values within each country
-df_imputed[feature_cols] = (
-    df.groupby('Location')[feature_cols]
-    .transform(lambda group: group.fillna(group.mean()))
-)
+    # Interpolating missing values within each country
+    df_imputed[feature_cols] = (
+        df.groupby('Location', observed=True)[feature_cols]
+        .transform(lambda group: group.fillna(group.mean()))
+    )
 
-# Fallback: filling remaining NaNs with region-wise median
-df_imputed[feature_cols] = (
-    df_imputed
-    .groupby('region')[feature_cols]
-    .transform(lambda group: group.fillna(group.median()))
-)
+    # Fallback: filling remaining NaNs with region-wise median
+    df_imputed[feature_cols] = (
+        df_imputed
+        .groupby('region', observed=True)[feature_cols]
+        .transform(lambda group: group.fillna(group.median()))
+    )
 
-# Final fallback: fill any still-missing values with global column median
-df_imputed[feature_cols] = df_imputed[feature_cols].fillna(df_imputed[feature_cols].median())
+    # Final fallback: fill any still-missing values with global column median
+    df_imputed[feature_cols] = df_imputed[feature_cols].fillna(df_imputed[feature_cols].median())
+    return df_imputed
 
 # VIF
-X = df_imputed[feature_cols]
-constant_filter = VarianceThreshold(threshold=0.0)
-X = X.loc[:, constant_filter.fit(X).get_support()]
-X = add_constant(X)
-vif_data = pd.DataFrame()
-vif_data["feature"] = X.columns
-vif_data["VIF"] = [variance_inflation_factor(X.values, i)
-                   for i in range(X.shape[1])]
-vif_data = vif_data[vif_data["feature"] != "const"]
-
-# Merging both
-features = pd.merge(vif_data, features[['feature', 'importance']], on=['feature'], how='left')
-features = features.sort_values(by='importance', ascending=False)
-features.reset_index(drop=True)
-
-high_VIF_features = features[features['VIF'] > 7]['feature'].tolist()
-df = df.drop(columns=high_VIF_features)
-
-"""### **Selected Features**"""
-
-# Features
-exclude_cols = ['Value', 'year', 'month_number', 'Location', 'region', 'country_code']
-numeric_cols = df.select_dtypes(include='number').columns
-feature_cols = [col for col in numeric_cols if col not in exclude_cols]
+# Every VIF at once from the diagonal of the inverse correlation matrix (the VIF of a feature
+# regressed on the others plus a constant). The inverse comes from a Cholesky factor; when the
+# matrix is numerically singular a ridge of a few ulps is added to the diagonal, so exactly
+# collinear features get very large but finite VIFs, as with the per-column OLS fits.
+def _inverse_correlation(corr):
+    ridge = 0.0
+    while True:
+        try:
+            chol_inv = np.linalg.inv(np.linalg.cholesky(corr + ridge * np.eye(len(corr))))
+            return chol_inv.T @ chol_inv
+        except np.linalg.LinAlgError:
+            ridge = ridge * 10 if ridge else len(corr) * np.finfo(float).eps
+
+def _vif_inputs(X):
+    from sklearn.feature_selection import VarianceThreshold
+
+    constant_filter = VarianceThreshold(threshold=0.0)
+    X = X.loc[:, constant_filter.fit(X).get_support()]
+    corr = np.atleast_2d(np.corrcoef(X.to_numpy(dtype=float), rowvar=False))
+    return list(X.columns), corr
+
+def _vif_frame(columns, inverse):
+    vif_data = pd.DataFrame()
+    vif_data["feature"] = columns
+    vif_data["VIF"] = np.diag(inverse)
+    return vif_data
+
+@run_profile.profiled('vif')
+def vif_table(X):
+    columns, corr = _vif_inputs(X)
+    return _vif_frame(columns, _inverse_correlation(corr))
+
+# Iterative elimination: drops the highest-VIF feature while any VIF is above the threshold.
+# Removing feature k turns the inverse P into P[-k, -k] - P[-k, k] P[k, -k] / P[k, k] (a rank-one
+# downdate), so the inverse is not recomputed. Only when the dropped feature was numerically
+# collinear (VIF beyond 1/sqrt(eps)) would that subtraction cancel catastrophically, and the
+# remaining block is refactorized instead. Returns the VIF frame of the kept features and the
+# dropped features in elimination order.
+@run_profile.profiled('vif')
+def eliminate_high_vif(X, threshold=7):
+    columns, corr = _vif_inputs(X)
+    inverse = _inverse_correlation(corr)
+    dropped = []
+
+    while columns:
+        vif = np.diag(inverse)
+        k = int(np.argmax(vif))
+        if vif[k] <= threshold:
+            break
+
+        dropped.append(columns.pop(k))
+        keep = np.arange(len(vif)) != k
+        corr = corr[np.ix_(keep, keep)]
+        if vif[k] > 1 / np.sqrt(np.finfo(float).eps):
+            inverse = _inverse_correlation(corr)
+        else:
+            inverse = inverse[np.ix_(keep, keep)] - np.outer(inverse[keep, k], inverse[k, keep]) / inverse[k, k]
+
+    return _vif_frame(columns, inverse), dropped
+
+# SHAP contributions for the rows of a matrix, without the bias column.
+# 'native' asks the booster for its exact TreeSHAP contributions (pred_contribs), using the
+# booster's threads and returning float32; 'shap' goes through shap.TreeExplainer on the frame X,
+# and shap is only imported when that backend is chosen.
+def shap_contributions(model, dmatrix, X, backend='native'):
+    if backend == 'shap':
+        import shap
+        return shap.TreeExplainer(model)(X).values
+    contributions = model.predict(dmatrix, pred_contribs=True, iteration_range=(0, model.best_iteration + 1))
+    return contributions[:, :-1]
+
+# climate_score is the clipped, rounded row sum of the contributions; the '_weight' shares are
+# their absolute values divided by the row total, computed in place over the contribution buffer
+def climate_attribution(contributions):
+    climate_score = contributions.sum(axis=1, dtype=np.float64)
+    weights = np.abs(contributions, out=contributions)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights /= weights.sum(axis=1, keepdims=True)
+    return weights, np.round(np.clip(climate_score, 0, None), 0)
+
+def _write_attribution_chunk(path, ids, feature_cols, weights, climate_score, basename):
+    chunk = pd.DataFrame(weights, columns=[col + '_weight' for col in feature_cols])
+    chunk = pd.concat([ids.reset_index(drop=True).astype({'region': str}), chunk], axis=1)
+    chunk['climate_score'] = climate_score
+    pa_dataset.write_dataset(
+        pa.Table.from_pandas(chunk, preserve_index=False), path, format='parquet',
+        partitioning=['region', 'year'], partitioning_flavor='hive',
+        basename_template=f'{basename}-{{i}}.parquet', existing_data_behavior='overwrite_or_ignore'
+    )
+
+# Attribution cache: per scope (the region) one directory per model fingerprint (booster bytes,
+# feature columns and backend), holding the weights and climate_score of every feature row scored
+# with that model, addressed by a hash of the row's feature values. Contributions depend only on
+# the model and the row, so a row whose features did not change is never scored twice. The misses
+# of every chunk are written as a Feather fragment of their own. Lookups only load the fragments'
+# row_hash columns (16 bytes of index per cached row) and take the hit rows from the
+# memory-mapped fragments, so the weights held in memory stay bounded by the chunk size.
+# Directories of the scope's earlier models can never hit again and are removed.
+def _model_fingerprint(model, feature_cols, backend):
+    digest = hashlib.sha256(bytes(model.save_raw('ubj')))
+    digest.update('\x1f'.join(feature_cols + [backend]).encode())
+    return digest.hexdigest()
+
+def _row_hashes(X):
+    return pd.util.hash_pandas_object(X, index=False).to_numpy()
+
+class AttributionCache:
+    def __init__(self, cache_dir, scope, fingerprint, feature_cols):
+        self.weight_cols = [col + '_weight' for col in feature_cols]
+        scope_dir = os.path.join(cache_dir, scope)
+        self.path = os.path.join(scope_dir, fingerprint[:16])
+        for old_dir in glob.glob(os.path.join(glob.escape(scope_dir), '*')):
+            if old_dir != self.path:
+                shutil.rmtree(old_dir, ignore_errors=True)
+
+        self.fragments = [feather.read_table(fragment_path, memory_map=True) for fragment_path in
+                          sorted(glob.glob(os.path.join(glob.escape(self.path), '*.feather')))]
+        hashes = [fragment['row_hash'].to_numpy() for fragment in self.fragments]
+        fragment_id = np.repeat(np.arange(len(hashes)), [len(fragment_hashes) for fragment_hashes in hashes])
+        offset = np.concatenate([np.arange(len(fragment_hashes)) for fragment_hashes in hashes] or [np.empty(0, int)])
+        self.hashes, first = np.unique(np.concatenate(hashes or [np.empty(0, np.uint64)]), return_index=True)
+        self.fragment_id, self.offset = fragment_id[first], offset[first]
+
+    # Position of every hash in the cache index, -1 for misses
+    def lookup(self, row_hash):
+        position = np.searchsorted(self.hashes, row_hash)
+        found = position < len(self.hashes)
+        found[found] = self.hashes[position[found]] == row_hash[found]
+        return np.where(found, position, -1)
+
+    # Weights and climate_score of cached positions, read from the fragments that hold them
+    def read(self, position):
+        weights = np.empty((len(position), len(self.weight_cols)), dtype=np.float32)
+        climate_score = np.empty(len(position))
+        fragment_id = self.fragment_id[position]
+        for fragment in np.unique(fragment_id):
+            selected = fragment_id == fragment
+            rows = self.fragments[fragment].take(self.offset[position[selected]])
+            weights[selected] = np.column_stack([rows[col].to_numpy() for col in self.weight_cols])
+            climate_score[selected] = rows['climate_score'].to_numpy()
+        return weights, climate_score
+
+    def add(self, row_hash, weights, climate_score):
+        fragment = pd.DataFrame(weights, columns=self.weight_cols)
+        fragment.insert(0, 'row_hash', row_hash)
+        fragment['climate_score'] = climate_score
+        fragment_path = os.path.join(self.path, f'{os.getpid()}-{threading.get_ident()}-{time.time_ns()}.feather')
+        with _atomic_write(fragment_path) as tmp_path:
+            feather.write_feather(fragment, tmp_path, compression='uncompressed')
+
+# Streaming attribution: the rows are scored in fixed-size chunks, each quantized with the
+# training cut points of `reference` and turned into '_weight' shares and climate_score on its
+# own, so the attribution buffers grow with the chunk size and not with the row count. Chunks run
+# on a thread pool (prediction releases the GIL) with the cores split between the threads. When a
+# path is given every chunk is appended to a Parquet dataset partitioned by region and year, as
+# files named after `name`; the files a previous run wrote under that name are removed first.
+# With a cache_dir, rows found in the model's attribution cache (scoped by `name`) are read from
+# it and only the new or changed rows are scored, then added to the cache chunk by chunk.
+# Returns the climate_score of every row, in row order, and the cache hit and miss counts.
+def stream_attribution(model, X, ids, reference, path=None, name='part', chunk_size=65536,
+                       max_workers=1, n_jobs=None, backend='native', cache_dir=None):
+    if path is not None and pa is None:
+        raise ImportError('pyarrow is required to write the attribution dataset')
+
+    import xgboost as xgb
+
+    n_rows = len(X)
+    feature_cols = list(X.columns)
+    climate_score = np.empty(n_rows)
+    cache_position = np.full(n_rows, -1)
+
+    if cache_dir is not None and feather is not None:
+        cache = AttributionCache(cache_dir, name, _model_fingerprint(model, feature_cols, backend), feature_cols)
+        row_hash = _row_hashes(X)
+        cache_position = cache.lookup(row_hash)
+    else:
+        cache = None
+
+    model.set_param({'nthread': max(1, (n_jobs or os.cpu_count() or 1) // max_workers)})
+    if path is not None:
+        for old_file in glob.glob(os.path.join(glob.escape(path), '*', '*', f'{glob.escape(name)}-*.parquet')):
+            os.remove(old_file)
+
+    def score_chunk(start):
+        rows = slice(start, min(start + chunk_size, n_rows))
+        position = cache_position[rows]
+        hit = position >= 0
+        weights = np.empty((len(position), len(feature_cols)), dtype=np.float32)
+        if hit.any():
+            weights[hit], climate_score[rows][hit] = cache.read(position[hit])
+        if not hit.all():
+            X_miss = X.iloc[rows][~hit]
+            chunk = xgb.QuantileDMatrix(X_miss, ref=reference)
+            weights[~hit], climate_score[rows][~hit] = climate_attribution(shap_contributions(model, chunk, X_miss, backend))
+            if cache is not None:
+                cache.add(row_hash[rows][~hit], weights[~hit], climate_score[rows][~hit])
+        if path is not None:
+            _write_attribution_chunk(path, ids.iloc[rows], feature_cols, weights, climate_score[rows],
+                                     f'{name}-{start // chunk_size:05d}')
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        list(pool.map(score_chunk, range(0, n_rows, chunk_size)))
+
+    n_hits = int((cache_position >= 0).sum())
+    return climate_score, {'cache_hits': n_hits, 'cache_misses': n_rows - n_hits}
+
+# Feature selection, imputation, VIF and modeling for one region.
+# Returns the trained booster ('model'), the region's selected feature rows ('X') with their
+# identifiers and mortality ('ids') and training row positions ('train_idx'), which
+# attribute_region scores, plus the selected features with their importance and VIF, the
+# validation metrics and the test-set residuals.
+def run_region_pipeline(final_df, region, config=None):
+    import xgboost as xgb
+    from scipy.cluster.hierarchy import linkage, fcluster
+    from scipy.spatial.distance import squareform
+    from sklearn.model_selection import train_test_split
+    from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
+
+    config = {**region_config, **(config or {})}
+
+    ###**Feature Selection**
+    df = final_df[final_df['region'] == region].copy().reset_index(drop=True)
+    feature_cols = _feature_columns(df)
+
+    # One float32 block for the region; later feature subsets are taken from it by position
+    X_all = df[feature_cols].to_numpy(dtype=np.float32, na_value=np.nan)
+    y_all = df['Value'].to_numpy(dtype=np.float32, na_value=np.nan)
+    column_position = {col: i for i, col in enumerate(feature_cols)}
+
+    # Feature Importance
+    top_features = feature_importance(xgb.QuantileDMatrix(X_all, label=y_all, feature_names=feature_cols), config)
+
+    # Computing correlation matrix
+    corr = df[feature_cols].corr().abs()
+
+    # Converting to distance matrix (1 - abs(correlation))
+    distance_matrix = 1 - corr
+
+    # Hierarchical clustering
+    linkage_matrix = linkage(squareform(distance_matrix), method='average')
+
+    # Assigning features to clusters
+    cluster_labels = fcluster(linkage_matrix, t=config['cluster_distance'], criterion='distance')
+    cluster_df = pd.DataFrame({'feature': corr.columns, 'cluster': cluster_labels})
+
+    # Merging cluster data with feature importance scores for final feature selection
+    features = pd.merge(cluster_df, top_features, on=['feature'], how='inner')
+
+    # Ranking within each cluster by descending importance
+    features['rank'] = features.groupby('cluster')['importance'] \
+                               .rank(method='first', ascending=False)
+
+    features['selected'] = np.where(
+        (features['rank'] == 1) & (features['importance'] > 0),
+        'Select',
+        ''
+    )
+
+    features = features.sort_values(by=["cluster", "importance"], ascending=[True, False]).reset_index(drop=True)
+    features['importance']= features['importance'].round(4)
+
+    low_importance_collinear_features = features[features['selected'] != "Select"]['feature'].tolist()
+    df = df.drop(columns=low_importance_collinear_features)
+
+    # Features
+    feature_cols = _feature_columns(df)
+
+    df_imputed = impute_region_features(df, feature_cols)
+
+    # VIF
+    vif_data = vif_table(df_imputed[feature_cols])
+
+    # Merging both
+    features = pd.merge(vif_data, features[['feature', 'importance']], on=['feature'], how='left')
+    features = features.sort_values(by='importance', ascending=False)
+
+    if config['vif_elimination'] == 'iterative':
+        high_VIF_features = eliminate_high_vif(df_imputed[feature_cols], config['vif_threshold'])[1]
+    else:
+        high_VIF_features = features[features['VIF'] > config['vif_threshold']]['feature'].tolist()
+    df = df.drop(columns=high_VIF_features)
+
+    ### **Selected Features**
+    feature_cols = _feature_columns(df)
+    X_selected = X_all[:, [column_position[col] for col in feature_cols]]
+
+    # Train/test split
+    train_idx, test_idx = train_test_split(np.arange(len(df)), test_size=config['test_size'],
+                                           random_state=config['random_state'])
+
+    # The training rows fix the bins; the evaluation and full-sample matrices reuse them
+    train = xgb.QuantileDMatrix(X_selected[train_idx], label=y_all[train_idx], feature_names=feature_cols)
+    test = xgb.QuantileDMatrix(X_selected[test_idx], label=y_all[test_idx], feature_names=feature_cols, ref=train)
+    full = xgb.QuantileDMatrix(X_selected, label=y_all, feature_names=feature_cols, ref=train)
+
+    # Feature Importance
+    top_features = feature_importance(full, config)
+
+    # VIF
+    vif_data = vif_table(df_imputed[feature_cols])
+
+    # Merging both
+    features = pd.merge(top_features, vif_data, on=['feature'], how='inner')
+    features = features.sort_values(by='importance', ascending=False).reset_index(drop=True)
+
+    ###**Modeling**
+    X = df[feature_cols]
+    y_test = df['Value'].iloc[test_idx]  # mortality
+
+    model = train_region_model(train, test, config)
+
+    # Make predictions using the best model
+    predictions = model.predict(test, iteration_range=(0, model.best_iteration + 1))
 
-# Feature Importance
-df_model = df.copy()
-X = df_model[feature_cols]
-y = df_model['Value']
-xgb_model = xgb.XGBRegressor(n_estimators=100, random_state=42)
-xgb_model.fit(X, y)
-importance_df = pd.DataFrame({
-    'feature': X.columns,
-    'importance': xgb_model.feature_importances_
-}).sort_values(by='importance', ascending=False)
-top_features = importance_df.sort_values(by="importance", ascending=False)
+    # Regression Metrics
+    y_pred = np.round(np.clip(predictions, 0, None),0)
+    metrics = {
+        'best_iteration': model.best_iteration,
+        'best_score': model.best_score,
+        'validation_rmse': np.sqrt(mean_squared_error(y_test, predictions)),
+        'rmse': np.sqrt(mean_squared_error(y_test, y_pred)),
+        'mae': mean_absolute_error(y_test, y_pred),
+        'r2': r2_score(y_test, y_pred),
+        'mape': np.mean(np.abs((y_test - y_pred) / y_test)) * 100
+    }
 
+    # Residual Analysis:
+    residuals = y_test - y_pred
 
-# VIF
-X = df_imputed[feature_cols]
-constant_filter = VarianceThreshold(threshold=0.0)
-X = X.loc[:, constant_filter.fit(X).get_support()]
-X = add_constant(X)
-vif_data = pd.DataFrame()
-vif_data["feature"] = X.columns
-vif_data["VIF"] = [variance_inflation_factor(X.values, i)
-                   for i in range(X.shape[1])]
-vif_data = vif_data[vif_data["feature"] != "const"]
-
-# Merging both
-features = pd.merge(top_features, vif_data, on=['feature'], how='inner')
-features = features.sort_values(by='importance', ascending=False).reset_index(drop=True)
-features
-
-"""###**Modeling**"""
-
-# XGBoost Model
-
-X = df[feature_cols]
-y = df['Value']  # mortality
-
-# Train/test split
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-
-# Training XGBoost
-
-# Initial model
-# model = xgb.XGBRegressor(
-#     n_estimators=100,
-#     learning_rate=0.1,
-#     max_depth=4,
-#     random_state=42
-# )
-# model.fit(X_train, y_train)
-
-# Optimized model
-model = xgb.XGBRegressor(
-    objective='reg:squarederror',
-    n_estimators=1000, # More trees to allow learning more complex patterns
-    early_stopping_rounds=50, # adding stop if no improvement in 50 rounds to prevent long training & avoid overfitting
-    eval_metric='rmse',
-    learning_rate=0.05, #Lower learning rate for better generalization
-    max_depth=6, #Deeper trees to model interactions better
-    subsample=0.8, #Introducing row sampling for regularization to reduce overfitting
-    colsample_bytree=0.8, # including feature sampling per tree to improve generalization
-    random_state=42
-)
-
-
-# Fitting with eval set
-model.fit(
-    X_train, y_train,
-    eval_set=[(X_test, y_test)],
-    verbose=False
-)
-
-# Access best iteration and score
-print(f"Best iteration: {model.best_iteration}")
-print(f"Best score on validation set: {model.best_score}")
-
-# Make predictions using the best model
-predictions = model.predict(X_test)
-rmse = np.sqrt(mean_squared_error(y_test, predictions))
-print(f"RMSE on validation set using best model: {rmse}")
-
-# Regression Metrics
-
-y_pred = model.predict(X_test)
-y_pred = np.round(np.clip(y_pred, 0, None),0)
-
-rmse = np.sqrt(mean_squared_error(y_test, y_pred))
-mae = mean_absolute_error(y_test, y_pred)
-r2 = r2_score(y_test, y_pred)
-mape = np.mean(np.abs((y_test - y_pred) / y_test)) * 100
-
-print(f"RMSE: {rmse:.2f}")
-print(f"MAE: {mae:.2f}")
-print(f"R²: {r2:.3f}")
-print(f"MAPE: {mape:.2f}")
-
-# Residual Analysis:
-residuals = y_test - y_pred
-
-plt.figure(figsize=(8, 5))
-sns.histplot(residuals, kde=True)
-plt.title("Residual Distribution")
-plt.xlabel("Residual (Actual - Predicted)")
-plt.show()
+    return {
+        'region': region,
+        'model': model,
+        'X': X,
+        'ids': df[['region', 'country_code', 'Location', 'year', 'month_number', 'Value']].copy(),
+        'train_idx': train_idx,
+        'features': features,
+        'metrics': metrics,
+        'residuals': residuals
+    }
 
 # Extracting SHAP Values For Explainability
-# SHAP explainer
-explainer = shap.TreeExplainer(model)
-shap_values = explainer(X)  # SHAP values for all rows
-
-# Converting SHAP Values to DataFrame
-shap_df = pd.DataFrame(shap_values.values, columns=X.columns)
-shap_df["base_value"] = shap_values.base_values #the baseline prediction (base_value)
-shap_df['region'] = df['region']
-shap_df['country_code'] = df['country_code']
-shap_df['Location'] = df['Location']
-shap_df['year'] = df['year']
-shap_df['month_number'] = df['month_number']
-shap_df['Value'] = df['Value']
-
-# Normalizing SHAP Scores (Climate Impact Weights)
-# Computing absolute shap values per row
-abs_shap = shap_df[feature_cols].abs()
-
-# Normalizing by row total to get % contribution
-norm_shap = abs_shap.div(abs_shap.sum(axis=1), axis=0)
-norm_shap.columns = [col + '_weight' for col in norm_shap.columns]
-
-# Combining with original data
-impact_df = pd.concat([df[['region', 'country_code', 'Location', 'year', 'month_number', 'Value']], norm_shap], axis=1)
-
-# Adding a “climate impact score” (magnitude of all SHAP)
-impact_df['climate_score'] = shap_df[feature_cols].sum(axis=1)
-impact_df['climate_score']  = np.round(np.clip(impact_df['climate_score'] , 0, None),0)
-
-columns_to_keep = ['region', 'country_code', 'Location', 'year', 'month_number', 'Value', 'climate_score']
-West_Africa = impact_df[columns_to_keep].copy()
+# Normalizing SHAP Scores (Climate Impact Weights) and the “climate impact score” of one trained
+# region (a run_region_pipeline result), chunk by chunk. The chunks are quantized with the cut
+# points of the region's training rows, as the booster was trained. Returns the region's climate
+# scores ('impact' rows: identifiers, Value and climate_score) and the attribution cache counts.
+def attribute_region(result, config=None):
+    import xgboost as xgb
+
+    config = {**region_config, **(config or {})}
+    X = result['X']
+    X_train = X.to_numpy(dtype=np.float32, na_value=np.nan)[result['train_idx']]
+    reference = xgb.QuantileDMatrix(X_train, feature_names=list(X.columns))
+
+    impact_df = result['ids'].copy()
+    with run_profile.section('shap_attribution', rows=len(X)):
+        impact_df['climate_score'], attribution_cache = stream_attribution(
+            result['model'], X, impact_df, reference, path=config['attribution_path'],
+            name=result['region'].replace(' ', '_'), chunk_size=config['attribution_chunk_size'],
+            max_workers=config['attribution_workers'], n_jobs=config['n_jobs'],
+            backend=config['contribution_backend'], cache_dir=config['attribution_cache_dir']
+        )
+    return impact_df, attribution_cache
+
+# Worker entry point: also caps the worker's BLAS/OpenMP pools at its share of the cores, and
+# returns the worker's profile records with the result
+def _run_region_worker(final_df, region, config):
+    run_profile.configure(run_profile.trace_memory)
+    with threadpool_limits(limits=config['n_jobs']):
+        result = run_region_pipeline(final_df, region, config)
+    return result, run_profile.records()
+
+# Runs the region pipelines in parallel, one process per region. The available cores are split
+# between the workers and each worker's XGBoost n_jobs is set to its share, so the pool does not
+# oversubscribe the machine. Results are returned in `regions` order.
+def run_all_regions(final_df, config=None, regions=REGIONS, max_workers=None):
+    n_cpus = os.cpu_count() or 1
+    n_workers = max(1, min(len(regions), max_workers or n_cpus))
+    config = {**region_config, **(config or {}), 'n_jobs': max(1, n_cpus // n_workers)}
+
+    if n_workers == 1:
+        return {region: run_region_pipeline(final_df, region, config) for region in regions}
+
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = {
+            region: pool.submit(_run_region_worker, final_df[final_df['region'] == region], region, config)
+            for region in regions
+        }
+        results = {region: future.result() for region, future in futures.items()}
+
+    for _, records in results.values():
+        run_profile.merge(records)
+    return {region: result for region, (result, _) in results.items()}
+
+# Training benchmark: the region's two importance fits and the final early-stopped fit, once with
+# the sklearn wrapper on pandas frames (a fresh quantized matrix per fit) and once on the shared
+# QuantileDMatrix objects used by run_region_pipeline. Each variant runs in a fresh process so
+# the peak resident memory of one does not hide the other's.
+def _training_benchmark_worker(X, y, selected, variant, config):
+    import resource
+    import xgboost as xgb
+    from sklearn.model_selection import train_test_split
+
+    start = time.perf_counter()
+    train_idx, test_idx = train_test_split(np.arange(len(X)), test_size=config['test_size'],
+                                           random_state=config['random_state'])
+    X_selected = X[selected]
+    if variant == 'sklearn':
+        for features in (X, X_selected):
+            xgb.XGBRegressor(n_estimators=config['importance_estimators'], random_state=config['random_state'],
+                             n_jobs=config['n_jobs']).fit(features, y)
+        model = xgb.XGBRegressor(**config['model_params'], random_state=config['random_state'],
+                                 n_jobs=config['n_jobs'])
+        model.fit(X_selected.iloc[train_idx], y.iloc[train_idx],
+                  eval_set=[(X_selected.iloc[test_idx], y.iloc[test_idx])], verbose=False)
+        best_iteration = model.best_iteration
+    else:
+        X_all = X.to_numpy(dtype=np.float32, na_value=np.nan)
+        y_all = y.to_numpy(dtype=np.float32, na_value=np.nan)
+        feature_importance(xgb.QuantileDMatrix(X_all, label=y_all, feature_names=list(X.columns)), config)
+        X_all = X_all[:, [X.columns.get_loc(col) for col in selected]]
+        train = xgb.QuantileDMatrix(X_all[train_idx], label=y_all[train_idx], feature_names=selected)
+        test = xgb.QuantileDMatrix(X_all[test_idx], label=y_all[test_idx], feature_names=selected, ref=train)
+        full = xgb.QuantileDMatrix(X_all, label=y_all, feature_names=selected, ref=train)
+        feature_importance(full, config)
+        best_iteration = train_region_model(train, test, config).best_iteration
+
+    return {
+        'variant': variant,
+        'seconds': time.perf_counter() - start,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'best_iteration': best_iteration
+    }
+
+def benchmark_region_training(final_df, region, selected=None, config=None):
+    config = {**region_config, **(config or {})}
+    df = final_df[final_df['region'] == region].reset_index(drop=True)
+    if selected is None:
+        selected = run_region_pipeline(final_df, region, config)['features']['feature'].tolist()
+    X = df[_feature_columns(df)]
+
+    results = []
+    for variant in ('sklearn', 'quantile_dmatrix'):
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            results.append(pool.submit(_training_benchmark_worker, X, df['Value'], selected, variant, config).result())
+    return pd.DataFrame(results)
+
+def print_region_metrics(region, metrics):
+    print(region)
+
+    # Access best iteration and score
+    print(f"Best iteration: {metrics['best_iteration']}")
+    print(f"Best score on validation set: {metrics['best_score']}")
+    print(f"RMSE on validation set using best model: {metrics['validation_rmse']}")
+
+    print(f"RMSE: {metrics['rmse']:.2f}")
+    print(f"MAE: {metrics['mae']:.2f}")
+    print(f"R²: {metrics['r2']:.3f}")
+    print(f"MAPE: {metrics['mape']:.2f}")
+
+def plot_residuals(ax, residuals):
+    import seaborn as sns
+
+    sns.histplot(residuals, kde=True, ax=ax)
+    ax.set_title("Residual Distribution")
+    ax.set_xlabel("Residual (Actual - Predicted)")
 
 """##**Forecast**"""
 
-#Combining all
-df_combined = pd.concat([Central_Africa, East_Africa, North_Africa, Southern_Africa, West_Africa], ignore_index=True)
-df_combined['climate_score'] = df_combined['climate_score'].astype(int)
-
-model_df = df_combined.copy().reset_index(drop=True)
-
-# install if not already installed
-# !pip install pmdarima
-
-# SARIMA Forecasting to 2030
-from tqdm import tqdm
-
-# Making sure date column is a datetime and setting index
-model_df['date'] = pd.to_datetime({
-    'year': model_df['year'],
-    'month': model_df['month_number'],
-    'day': 1
-    })
-model_df.sort_values(['Location', 'date'], inplace=True)
-
-# Setting forecast horizon to Dec 2030
-forecast_end = pd.Timestamp("2030-12-01")
-forecast_months = pd.date_range(model_df['date'].max() + pd.DateOffset(months=1), forecast_end, freq='MS')
-
-# Container for forecasts
-forecast_list = []
-
-# Variables to forecast
-var = 'climate_score'
-locations = model_df['Location'].unique()
-
-# Looping through each location
-for location in tqdm(locations, desc="Forecasting"):
-    ts = model_df[model_df['Location'] == location].set_index('date')[var].dropna()
-    if len(ts) < 24:
-        continue  # Skipping short time series
-
+forecast_config = {
+    'method': 'sarima', # 'sarima' (per-location auto_arima), 'holt_winters' or 'seasonal_naive' (all locations as one matrix)
+    'n_workers': None, # processes fitting locations in parallel, defaults to the number of cores
+    'timeout': 600, # seconds allowed for one location's search and forecast, None for no limit
+    'min_history': 24, # shorter series are skipped
+    'forecast_end': '2030-12-01',
+    'arima_params': {'seasonal': True, 'm': 12, 'stepwise': True, 'max_order': 5, 'suppress_warnings': True},
+    'order_cache_dir': os.path.join(CACHE_DIR, 'sarima'), # None searches every location on every run
+    'research_months': 12, # search again once a series has grown this many months since its last search
+    'research_rmse_ratio': 1.1, # or once a warm refit's in-sample RMSE exceeds the searched fit's by this factor
+    # Smoothing parameters searched for the Holt-Winters mode (level, trend, season, trend damping)
+    'holt_winters_grid': {'alpha': (0.05, 0.1, 0.2, 0.4, 0.6), 'beta': (0.0, 0.01, 0.05, 0.1),
+                          'gamma': (0.05, 0.1, 0.2, 0.4), 'phi': (0.9, 0.98, 1.0)}
+}
+
+# Raised by the location timer; a BaseException so the model search's own error handling
+# cannot swallow it
+class ForecastTimeout(BaseException):
+    pass
+
+@contextmanager
+def _time_limit(seconds):
+    # SIGALRM only exists on Unix and only reaches the main thread; elsewhere there is no limit
+    if not seconds or not hasattr(signal, 'SIGALRM') or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def _expired(signum, frame):
+        raise ForecastTimeout
+
+    previous = signal.signal(signal.SIGALRM, _expired)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
     try:
-        model = auto_arima(ts, seasonal=True, m=12, stepwise=True,  max_order=5, suppress_warnings=True)
-
-
-        forecast = model.predict(n_periods=len(forecast_months))
-        df_forecast = pd.DataFrame({
-            'Location': location,
-            'date': forecast_months,
-            var: forecast
-        })
-        forecast_list.append(df_forecast)
-
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+# SARIMA order cache: one JSON file per set of auto_arima arguments, holding for every location
+# the model chosen by its last order search, the latest fitted parameters, and the series length
+# and in-sample RMSE at that search
+ARIMA_STATE_PARAMS = ('order', 'seasonal_order', 'with_intercept', 'trend', 'method', 'maxiter')
+
+def _order_cache_path(config):
+    key = hashlib.sha256(json.dumps(config['arima_params'], sort_keys=True).encode()).hexdigest()
+    return os.path.join(config['order_cache_dir'], f'sarima_{key[:16]}.json')
+
+def _load_order_cache(config):
+    if config['order_cache_dir'] is None or not os.path.exists(_order_cache_path(config)):
+        return {}
+    with open(_order_cache_path(config)) as f:
+        return json.load(f)
+
+def _save_order_cache(config, states):
+    with _atomic_write(_order_cache_path(config)) as tmp_path, open(tmp_path, 'w') as f:
+        json.dump(states, f)
+
+def _in_sample_rmse(model):
+    return float(np.sqrt(np.mean(np.square(model.resid()))))
+
+# Refit with the cached order, starting the optimizer from the cached parameters. Returns None
+# when the location should be searched again: the series grew past research_months since the
+# search, the in-sample RMSE degraded past research_rmse_ratio, or the refit failed.
+def _warm_refit(ts, state, config):
+    from pmdarima import ARIMA
+
+    if len(ts) - state['search_n_obs'] >= config['research_months']:
+        return None
+    params = {key: tuple(value) if isinstance(value, list) else value for key, value in state['params'].items()}
+    try:
+        model = ARIMA(**params, start_params=np.asarray(state['coefficients']),
+                      suppress_warnings=True).fit(ts)
+    except Exception:
+        return None
+    if _in_sample_rmse(model) > state['search_rmse'] * config['research_rmse_ratio']:
+        return None
+    return model
+
+# One location: warm refit from the cached state when it is still valid, otherwise the SARIMA
+# order search, then the forecast. The state is taken as soon as the model is fitted, so a search
+# is cached even when the forecast fails. Errors and timeouts are returned as the location's status
+# instead of being raised, so one bad series does not stop the run.
+def _forecast_location(location, ts, n_periods, config, state=None):
+    from pmdarima import auto_arima
+
+    start = time.perf_counter()
+    result = {'Location': location, 'status': 'ok', 'error': None, 'order': None,
+              'seasonal_order': None, 'searched': None, 'forecast': None, 'state': None}
+    try:
+        with threadpool_limits(limits=1), _time_limit(config['timeout']):
+            model = _warm_refit(ts, state, config) if state is not None else None
+            result['searched'] = model is None
+            if model is None:
+                model = auto_arima(ts, **config['arima_params'])
+                state = {'search_n_obs': len(ts), 'search_rmse': _in_sample_rmse(model)}
+            result['order'], result['seasonal_order'] = model.order, model.seasonal_order
+            model_params = model.get_params()
+            result['state'] = {**state, 'params': {key: model_params[key] for key in ARIMA_STATE_PARAMS},
+                               'coefficients': np.asarray(model.params()).tolist()}
+            # Forecast from the series' own last month through forecast_end and keep the last
+            # n_periods, so a series that ends early still lines up with the other locations
+            last, end = ts.index[-1], pd.Timestamp(config['forecast_end'])
+            n_ahead = max(n_periods, (end.year - last.year) * 12 + end.month - last.month)
+            result['forecast'] = np.asarray(model.predict(n_periods=n_ahead))[n_ahead - n_periods:]
+    except ForecastTimeout:
+        result.update(status='timeout', error=f"no fit within {config['timeout']} s")
     except Exception as e:
-        print(f"Failed for {location}: {e}")
+        result.update(status='failed', error=f'{type(e).__name__}: {e}')
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def _fit_locations(series, n_periods, config, states):
+    from tqdm import tqdm
+
+    n_workers = max(1, min(len(series), config['n_workers'] or os.cpu_count() or 1))
+    if n_workers == 1:
+        return [_forecast_location(location, ts, n_periods, config, states.get(str(location)))
+                for location, ts in tqdm(series.items(), desc="Forecasting")]
+
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = {location: pool.submit(_forecast_location, location, ts, n_periods, config, states.get(str(location)))
+                   for location, ts in series.items()}
+        for _ in tqdm(as_completed(futures.values()), total=len(futures), desc="Forecasting"):
+            pass
+
+    results = []
+    for location, future in futures.items():
+        try:
+            results.append(future.result())
+        except Exception as e:  # the worker itself died
+            results.append({'Location': location, 'status': 'failed', 'error': f'{type(e).__name__}: {e}',
+                            'order': None, 'seasonal_order': None, 'searched': None, 'forecast': None,
+                            'state': None, 'seconds': np.nan})
+    return results
+
+@run_profile.profiled('sarima_forecast')
+def _sarima_forecasts(model_df, var, n_periods, config):
+    # One monthly series per location, in Location order; short series are skipped. Months missing
+    # inside a series are filled by linear interpolation: statsmodels only builds forecast dates
+    # from a regular index, and predict fails on a date index with gaps.
+    series, skipped = {}, []
+    for location, group in model_df.groupby('Location', observed=True, sort=True):
+        ts = group.set_index('date')[var].dropna()
+        if len(ts) < config['min_history']:
+            skipped.append({'Location': location, 'status': 'skipped', 'error': f'{len(ts)} months of history'})
+        else:
+            series[location] = ts.asfreq('MS').interpolate()
+
+    states = _load_order_cache(config)
+    results = _fit_locations(series, n_periods, config, states)
+    fit_report = pd.DataFrame([{k: v for k, v in result.items() if k not in ('forecast', 'state')}
+                               for result in results] + skipped)
+
+    if config['order_cache_dir'] is not None:
+        states.update({str(result['Location']): result['state'] for result in results if result['state'] is not None})
+        _save_order_cache(config, states)
+
+    fitted = [result for result in results if result['status'] == 'ok']
+    forecasts = np.array([result['forecast'] for result in fitted]).reshape(len(fitted), n_periods)
+    return [result['Location'] for result in fitted], forecasts, fit_report
+
+# Matrix forecasting
+# climate_score as a (location, month) matrix starting in January of the first year, so column
+# % 12 is the calendar month; months without data are NaN
+def _monthly_matrix(model_df, var):
+    codes, locations = pd.factorize(model_df['Location'].astype(str), sort=True)
+    first_year = model_df['year'].min()
+    column = (model_df['year'].to_numpy() - first_year) * 12 + model_df['month_number'].to_numpy() - 1
+    Y = np.full((len(locations), column.max() + 1), np.nan)
+    Y[codes, column] = model_df[var].to_numpy(dtype=float, na_value=np.nan)
+    return list(locations), Y
+
+# Holt-Winters additive with damped trend, fitted for every location at once: each combination
+# of the grid is run through the recursion as one (combination, location) array, missing months
+# carry the state forward, and each location keeps the combination with the lowest one-step
+# squared error after the first season. Returns the forecasts for the n_periods months after the
+# last column, the chosen parameters and the in-sample RMSE.
+def holt_winters_matrix(Y, n_periods, grid, season_length=12):
+    n_locations, n_months = Y.shape
+    alpha, beta, gamma, phi = (values.ravel()[:, np.newaxis] for values in
+                               np.meshgrid(*(np.asarray(grid[key], dtype=float) for key in ('alpha', 'beta', 'gamma', 'phi')),
+                                           indexing='ij'))
+
+    # Initial state from the first two seasons
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        first_season = np.nanmean(Y[:, :season_length], axis=1)
+        second_season = np.nanmean(Y[:, season_length:2 * season_length], axis=1)
+    level = np.nan_to_num(first_season, nan=np.nanmean(Y))
+    trend = np.nan_to_num((second_season - first_season) / season_length)
+    season = np.nan_to_num(Y[:, :season_length] - level[:, np.newaxis])
+
+    n_grid = len(alpha)
+    level = np.repeat(level[np.newaxis], n_grid, axis=0)
+    trend = np.repeat(trend[np.newaxis], n_grid, axis=0)
+    season = np.repeat(season[np.newaxis], n_grid, axis=0)
+    sse = np.zeros((n_grid, n_locations))
+    n_errors = np.zeros(n_locations)
+
+    for t in range(n_months):
+        y = Y[:, t]
+        observed = ~np.isnan(y)
+        s = season[:, :, t % season_length]
+        expected = level + phi * trend
+        if t >= season_length:
+            sse += np.where(observed, (y - expected - s) ** 2, 0.0)
+            n_errors += observed
+        new_level = np.where(observed, alpha * (y - s) + (1 - alpha) * expected, expected)
+        trend = np.where(observed, beta * (new_level - level) + (1 - beta) * phi * trend, phi * trend)
+        season[:, :, t % season_length] = np.where(observed, gamma * (y - new_level) + (1 - gamma) * s, s)
+        level = new_level
+
+    best = np.argmin(sse, axis=0)
+    rows = np.arange(n_locations)
+    horizon = np.arange(1, n_periods + 1)
+    damping = np.cumsum(phi[best] ** horizon, axis=1)
+    months = (n_months - 1 + horizon) % season_length
+    forecasts = level[best, rows][:, np.newaxis] + damping * trend[best, rows][:, np.newaxis] + season[best[:, np.newaxis], rows[:, np.newaxis], months]
+
+    params = pd.DataFrame({key: values[best, 0] for key, values in zip(('alpha', 'beta', 'gamma', 'phi'), (alpha, beta, gamma, phi))})
+    rmse = np.sqrt(sse[best, rows] / np.maximum(n_errors, 1))
+    return forecasts, params, rmse
+
+# Seasonal naive with drift: each calendar month repeats its last observed value, shifted by the
+# location's average yearly change (first to last observed year) for every year ahead
+def seasonal_naive_matrix(Y, n_periods, season_length=12):
+    n_locations, n_months = Y.shape
+    n_years = -(-n_months // season_length)
+    by_year = np.full((n_locations, n_years * season_length), np.nan)
+    by_year[:, :n_months] = Y
+    by_year = by_year.reshape(n_locations, n_years, season_length)
+
+    # Last observed value of every calendar month and the year it was observed
+    observed = ~np.isnan(by_year)
+    last_year = np.where(observed, np.arange(n_years)[:, np.newaxis], -1).max(axis=1)
+    season = np.take_along_axis(by_year, np.maximum(last_year, 0)[:, np.newaxis, :], axis=1)[:, 0]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        yearly_mean = np.nanmean(by_year, axis=2)
+    has_year = ~np.isnan(yearly_mean)
+    first = has_year.argmax(axis=1)
+    last = n_years - 1 - has_year[:, ::-1].argmax(axis=1)
+    rows = np.arange(n_locations)
+    drift = np.nan_to_num((yearly_mean[rows, last] - yearly_mean[rows, first]) / np.maximum(last - first, 1))
+
+    position = n_months - 1 + np.arange(1, n_periods + 1)
+    months = position % season_length
+    years_ahead = position // season_length - last_year[:, months]
+    return season[:, months] + drift[:, np.newaxis] * years_ahead
+
+@run_profile.profiled('matrix_forecast')
+def _matrix_forecasts(model_df, var, n_periods, config):
+    start = time.perf_counter()
+    locations, Y = _monthly_matrix(model_df, var)
+    n_observed = (~np.isnan(Y)).sum(axis=1)
+    keep = n_observed >= config['min_history']
+    fitted = [location for location, kept in zip(locations, keep) if kept]
+
+    fit_report = pd.DataFrame({'Location': locations, 'status': np.where(keep, 'ok', 'skipped'),
+                               'error': [None if kept else f'{n} months of history' for n, kept in zip(n_observed, keep)]})
+    if config['method'] == 'holt_winters':
+        forecasts, params, rmse = holt_winters_matrix(Y[keep], n_periods, config['holt_winters_grid'])
+        fit_report.loc[keep, ['alpha', 'beta', 'gamma', 'phi']] = params.to_numpy()
+        fit_report.loc[keep, 'rmse'] = rmse
+    elif config['method'] == 'seasonal_naive':
+        forecasts = seasonal_naive_matrix(Y[keep], n_periods)
+    else:
+        raise ValueError(f"Unknown forecast method: {config['method']!r}")
+    fit_report['seconds'] = time.perf_counter() - start
+    return fitted, forecasts, fit_report
+
+# Forecasting to 2030
+# 'sarima' fits the locations in parallel: a warm refit of the cached order where it is still
+# valid, otherwise an auto_arima search, and the cache is updated with the new fits.
+# 'holt_winters' and 'seasonal_naive' forecast every location at once from the (location, month)
+# matrix. Returns the history frame, the forecasts and a fit report with one row per location:
+# 'ok', 'skipped' (short series), 'failed' or 'timeout', with the error, the fitted orders or
+# parameters and the fit time.
+def forecast_climate_scores(df_combined, config=None):
+    config = {**forecast_config, **(config or {})}
+    model_df = df_combined.copy().reset_index(drop=True)
+
+    # Making sure date column is a datetime and setting index
+    model_df['date'] = pd.to_datetime({
+        'year': model_df['year'],
+        'month': model_df['month_number'],
+        'day': 1
+        })
+    model_df.sort_values(['Location', 'date'], inplace=True)
+
+    # Setting forecast horizon to Dec 2030
+    forecast_end = pd.Timestamp(config['forecast_end'])
+    forecast_months = pd.date_range(model_df['date'].max() + pd.DateOffset(months=1), forecast_end, freq='MS')
+
+    # Variables to forecast
+    var = 'climate_score'
+
+    if config['method'] == 'sarima':
+        locations, forecasts, fit_report = _sarima_forecasts(model_df, var, len(forecast_months), config)
+    else:
+        locations, forecasts, fit_report = _matrix_forecasts(model_df, var, len(forecast_months), config)
+    run_profile.count('forecast_failures', int(fit_report['status'].isin(['failed', 'timeout']).sum()))
+    run_profile.count('forecast_skipped', int((fit_report['status'] == 'skipped').sum()))
+
+    # Combining forecasts: one row per location and month, in Location and date order
+    forecast_df = pd.DataFrame({
+        'Location': np.repeat(np.asarray(locations, dtype=object), len(forecast_months)),
+        'date': np.tile(forecast_months.to_numpy(), len(locations)),
+        var: forecasts.ravel()
+    })
 
-# Combining forecasts
-forecast_df = pd.concat(forecast_list, axis=0)
+    # Adding month/year for later use
+    forecast_df['month'] = forecast_df['date'].dt.month
+    forecast_df['year'] = forecast_df['date'].dt.year
+
+    # Adding back region and country code info
+    meta_cols = ['Location', 'region', 'country_code']
+    meta_df = model_df[meta_cols].drop_duplicates()
+    forecast_df = forecast_df.merge(meta_df, on='Location', how='left')
+
+    forecast_df['climate_score']= np.round(np.clip(forecast_df['climate_score'], 0, None),0)
+    forecast_df['climate_score'] = forecast_df['climate_score'].fillna(0)
+
+    return model_df, forecast_df, fit_report
+
+# Backtest: every location's last holdout_months are held out, each method forecasts them from
+# the remaining history, and the forecasts are scored against the held-out climate_score on the
+# months every method forecast (mae, rmse). The SARIMA path runs without its order cache, so its time includes the full searches.
+def backtest_forecasters(df_combined, holdout_months=24, methods=('sarima', 'holt_winters', 'seasonal_naive'),
+                         config=None):
+    dates = pd.to_datetime({'year': df_combined['year'], 'month': df_combined['month_number'], 'day': 1})
+    cutoff = dates.max() - pd.DateOffset(months=holdout_months)
+    history = df_combined[dates <= cutoff]
+    actual = df_combined[dates > cutoff].assign(date=dates[dates > cutoff])[['Location', 'date', 'climate_score']]
+    actual = actual.astype({'Location': str})
+
+    runs = []
+    for method in methods:
+        method_config = {**(config or {}), 'method': method, 'order_cache_dir': None,
+                         'forecast_end': dates.max().strftime('%Y-%m-%d')}
+        start = time.perf_counter()
+        _, forecast_df, fit_report = forecast_climate_scores(history, method_config)
+        seconds = time.perf_counter() - start
+
+        scored = actual.merge(forecast_df.astype({'Location': str})[['Location', 'date', 'climate_score']],
+                              on=['Location', 'date'], suffixes=('', '_forecast'))
+        runs.append((method, seconds, int((fit_report['status'] == 'ok').sum()), scored.set_index(['Location', 'date'])))
+
+    # Errors are compared on the months every method forecast
+    common = runs[0][3].index
+    for *_, scored in runs[1:]:
+        common = common.intersection(scored.index)
+
+    results = []
+    for method, seconds, n_locations, scored in runs:
+        error = scored['climate_score_forecast'] - scored['climate_score']
+        common_error = error.loc[common]
+        results.append({
+            'method': method,
+            'seconds': seconds,
+            'locations': n_locations,
+            'rows_scored': len(scored),
+            'mae': common_error.abs().mean(),
+            'rmse': np.sqrt((common_error ** 2).mean())
+        })
 
-# Pivoting
-forecast_df = forecast_df.pivot_table(index=['Location', 'date'],
-                                      values=var).reset_index()
+    return pd.DataFrame(results)
+
+# Ranks of every row within its (location, year) group, highest score first, from one lexsort.
+# Returns the rank order of the rows, their sorted group keys, the group start of every sorted
+# row, the rank (ties share the lowest rank, as rank(method='min')) and the within-year percentile
+# (share of the group scoring at or below the row). Missing scores sort last.
+def _year_ranks(location_codes, years, months, scores):
+    key = location_codes.astype(np.int64) * (years.max() - years.min() + 1) + (years - years.min())
+    order = np.lexsort((months, -scores, key))
+    key, scores = key[order], scores[order]
+    position = np.arange(len(order))
+
+    new_group = np.r_[True, key[1:] != key[:-1]]
+    group_start = np.maximum.accumulate(np.where(new_group, position, 0))
+    group_end = np.r_[np.flatnonzero(new_group)[1:], len(order)][np.cumsum(new_group) - 1]
+    run_start = np.maximum.accumulate(np.where(new_group | np.r_[True, scores[1:] != scores[:-1]], position, 0))
+
+    month_rank = (run_start - group_start + 1).astype(float)
+    month_rank[np.isnan(scores)] = np.nan
+    percentile = (group_end - run_start) / (group_end - group_start)
+    return order, key, group_start, month_rank, percentile
+
+# Risk index over the history and forecast scores.
+# One pass ranks every month within its location and year, gives its within-year percentile and
+# the running and total annual climate_score (in calendar order). Rows are kept sorted by
+# (location, year, rank) next to their sorted group keys, so the riskiest months of a location and
+# year are a binary search and a slice; the peak month of every location and year is kept sorted
+# by (month, year) for the reverse lookup.
+class RiskIndex:
+    def __init__(self, frame, keys, group_start, first_year, n_years):
+        self.frame = frame  # ranked rows in (Location, year, month_rank) order
+        self.keys = keys  # location code * n_years + year offset, sorted
+        self.group_start = group_start  # row where each row's (location, year) group starts
+        self.first_year = int(first_year)
+        self.n_years = int(n_years)
+        self.locations = pd.Index(frame['Location'].unique(), name='Location')
+
+        # Peak month of every location and year, sorted by (month, year, location)
+        peaks = frame.iloc[np.flatnonzero(group_start == np.arange(len(frame)))]
+        peak_key = peaks['month'].to_numpy(np.int64) * self.n_years + peaks['year'].to_numpy(np.int64) - self.first_year
+        peak_order = np.argsort(peak_key, kind='stable')
+        self.peaks = peaks.iloc[peak_order].reset_index(drop=True)
+        self.peak_keys = peak_key[peak_order]
+
+    @classmethod
+    def from_frame(cls, df, variable='climate_score'):
+        month_col = 'month' if 'month' in df.columns else 'month_number'
+        location_codes, locations = pd.factorize(df['Location'].astype(str), sort=True)
+        years = df['year'].to_numpy(np.int64)
+        months = df[month_col].to_numpy(np.int64)
+        scores = df[variable].to_numpy(dtype=float, na_value=np.nan)
+        order, keys, group_start, month_rank, percentile = _year_ranks(location_codes, years, months, scores)
+
+        # Running and total annual score in calendar order
+        calendar = np.lexsort((months, years, location_codes))
+        calendar_scores = np.nan_to_num(scores[calendar])
+        calendar_key = keys[np.argsort(order)][calendar]
+        new_group = np.r_[True, calendar_key[1:] != calendar_key[:-1]]
+        starts = np.flatnonzero(new_group)
+        group = np.cumsum(new_group) - 1
+        running = np.cumsum(calendar_scores)
+        cumulative_score, annual_score = np.empty(len(df)), np.empty(len(df))
+        cumulative_score[calendar] = running - (running - calendar_scores)[starts][group]
+        annual_score[calendar] = np.add.reduceat(calendar_scores, starts)[group] if len(starts) else []
+
+        extra = [col for col in ('region', 'country_code', 'date', 'source') if col in df.columns]
+        frame = df[extra].iloc[order].reset_index(drop=True)
+        frame.insert(0, 'Location', np.asarray(locations, dtype=object)[location_codes[order]])
+        frame['year'], frame['month'] = years[order], months[order]
+        frame[variable] = scores[order]
+        frame['month_rank'], frame['percentile'] = month_rank, percentile
+        frame['cumulative_score'], frame['annual_score'] = cumulative_score[order], annual_score[order]
+        return cls(frame, keys, group_start, years.min(), years.max() - years.min() + 1)
+
+    # Keys only separate (location, year) groups for years inside the indexed range; a year
+    # outside it would land in a neighbouring location's group
+    def _in_range(self, year):
+        return self.first_year <= year < self.first_year + self.n_years
+
+    def _key(self, location, year):
+        return self.locations.get_loc(location) * self.n_years + (year - self.first_year)
+
+    # The n riskiest months of one location and year; empty for a year outside the index
+    def top_months(self, location, year, n=3):
+        key = self._key(location, year)
+        if not self._in_range(year):
+            return self.frame.iloc[:0]
+        start, end = np.searchsorted(self.keys, [key, key + 1])
+        return self.frame.iloc[start:min(start + n, end)]
+
+    # The n riskiest months of every location and year
+    def top(self, n=3):
+        return self.frame[np.arange(len(self.frame)) - self.group_start < n]
+
+    # Locations whose riskiest month is `month`, in one year or in any year
+    def peak_locations(self, month, year=None):
+        if year is None:
+            bounds = [month * self.n_years, (month + 1) * self.n_years]
+        elif not self._in_range(year):
+            return self.peaks.iloc[:0]
+        else:
+            key = month * self.n_years + year - self.first_year
+            bounds = [key, key + 1]
+        start, end = np.searchsorted(self.peak_keys, bounds)
+        return self.peaks.iloc[start:end]
+
+    def write(self, path):
+        with _atomic_write(path) as tmp_path:
+            feather.write_feather(self.frame.assign(group_start=self.group_start), tmp_path, compression='uncompressed')
+
+    @classmethod
+    def read(cls, path):
+        frame = feather.read_table(path, memory_map=True).to_pandas()
+        group_start = frame.pop('group_start').to_numpy()
+        location_codes = pd.Index(frame['Location'].unique()).get_indexer(frame['Location'])
+        first_year = frame['year'].min()
+        n_years = frame['year'].max() - first_year + 1
+        return cls(frame, location_codes * n_years + (frame['year'].to_numpy() - first_year), group_start,
+                   first_year, n_years)
+
+# Month ranks within each location and year, from the same single sort as the risk index
+def annual_rank(df, variable):
+    df = df.copy()
 
-# Adding month/year for later use
-forecast_df['month'] = forecast_df['date'].dt.month
-forecast_df['year'] = forecast_df['date'].dt.year
+    location_codes = pd.factorize(df['Location'].astype(str), sort=True)[0]
+    month_col = 'month' if 'month' in df.columns else 'month_number'
+    order, _, _, month_rank, _ = _year_ranks(location_codes, df['year'].to_numpy(np.int64),
+                                             df[month_col].to_numpy(np.int64),
+                                             df[variable].to_numpy(dtype=float, na_value=np.nan))
+    df['month_rank'] = np.empty(len(df))
+    df.iloc[order, df.columns.get_loc('month_rank')] = month_rank
+    return df
 
-# Adding back region and country code info
-meta_cols = ['Location', 'region', 'country_code']
-meta_df = model_df[meta_cols].drop_duplicates()
-forecast_df = forecast_df.merge(meta_df, on='Location', how='left')
+"""##**Outputs**"""
 
-forecast_df['climate_score']= np.round(np.clip(forecast_df['climate_score'], 0, None),0)
-forecast_df['climate_score'] = forecast_df['climate_score'].fillna(0)
+OUTPUT_DIR = os.environ.get('SCA_OUTPUT_DIR', 'outputs')
 
-def annual_rank(df, variable):
-    df = df.copy()
+SCORE_COLUMNS = ['Location', 'region', 'country_code', 'date', 'year', 'month', 'climate_score']
 
-    df['month_rank'] = df.groupby(['Location', 'year'])[variable].rank(ascending=False, method='min')
-    return df
+# History and forecasts as one table, 'source' telling them apart, sorted by Location and date
+def climate_score_table(model_df, forecast_df):
+    history = model_df.rename(columns={'month_number': 'month'})[SCORE_COLUMNS].assign(source='history')
+    forecast = forecast_df[SCORE_COLUMNS].assign(source='forecast')
+    scores = pd.concat([history, forecast], ignore_index=True).astype({
+        'Location': str, 'region': str, 'country_code': str, 'year': 'int16', 'month': 'int8',
+        'climate_score': 'float32', 'source': 'category'
+    })
+    return scores.sort_values(['Location', 'date'], ignore_index=True)
+
+# Small tables the dashboard keeps in memory: yearly statistics per region, the average
+# seasonal profile of every location, the top_n riskiest months of every location and year and
+# the peak month of every location and year (from the risk index)
+def dashboard_aggregates(scores, risk_index, top_n=3):
+    region_year = (
+        scores.groupby(['region', 'year', 'source'], observed=True)
+        .agg(climate_score=('climate_score', 'mean'), total_score=('climate_score', 'sum'),
+             peak_score=('climate_score', 'max'), locations=('Location', 'nunique'))
+        .reset_index()
+    )
+    country_month = (
+        scores.groupby(['region', 'Location', 'country_code', 'source', 'month'], observed=True)['climate_score']
+        .mean().reset_index()
+    )
+    risk_columns = ['region', 'Location', 'country_code', 'year', 'month', 'date', 'climate_score', 'source',
+                    'month_rank', 'percentile']
+    top_risk_months = risk_index.top(top_n)[risk_columns].reset_index(drop=True)
+    peak_months = risk_index.peaks[risk_columns + ['annual_score']]
+    return {'region_year': region_year, 'country_month': country_month, 'top_risk_months': top_risk_months,
+            'peak_months': peak_months}
+
+# Writes a region=/year= Hive partition per region and year, one part-0.parquet each, with a
+# row group per Location: a partition holds about 15 locations x 12 months, so a filter on
+# Location keeps a single row group of every file and skips the rest by its min/max statistics.
+# The partition columns are not repeated in the files, and a partition that is rewritten loses
+# its other files, like write_dataset's 'delete_matching'.
+def _write_score_partitions(table, path):
+    regions = table.column('region').to_numpy(zero_copy_only=False)
+    years = table.column('year').to_numpy()
+    locations = table.column('Location').to_numpy(zero_copy_only=False)
+    file_table = table.drop_columns(['region', 'year'])
+
+    partitions = pd.DataFrame({'region': regions, 'year': years}).groupby(['region', 'year'], sort=False).indices
+    for (region, year), rows in partitions.items():
+        partition_dir = os.path.join(path, f'region={urllib.parse.quote(region)}', f'year={year}')
+
+        # rows are sorted by Location and date, so every Location is one run of rows
+        starts = np.flatnonzero(np.r_[True, locations[rows][1:] != locations[rows][:-1]])
+        ends = np.r_[starts[1:], len(rows)]
+        partition = file_table.take(rows)
+        with _atomic_write(os.path.join(partition_dir, 'part-0.parquet')) as tmp_path:
+            with pq.ParquetWriter(tmp_path, partition.schema, write_statistics=True) as writer:
+                for start, end in zip(starts, ends):
+                    writer.write_table(partition.slice(start, end - start), row_group_size=end - start)
+            for old_file in os.listdir(partition_dir):
+                if old_file != os.path.basename(tmp_path):
+                    os.remove(os.path.join(partition_dir, old_file))
+
+# Writes the score table twice under output_dir, plus the dashboard aggregates:
+#   climate_scores/       Parquet partitioned by region and year, rows sorted by Location and date
+#                         inside each file and one row group per Location (_write_score_partitions),
+#                         so a Location filter reads one row group of every partition it scans
+#   climate_scores.arrow  the whole table as an uncompressed Arrow IPC file, for memory-mapping
+#   risk_index.arrow      the RiskIndex of the table, read back with RiskIndex.read
+#   aggregates/*.parquet  the dashboard_aggregates tables
+def write_outputs(model_df, forecast_df, output_dir=OUTPUT_DIR):
+    if pa is None:
+        raise ImportError('pyarrow is required to write the outputs')
+
+    scores = climate_score_table(model_df, forecast_df)
+    table = pa.Table.from_pandas(scores, preserve_index=False)
+    _write_score_partitions(table, os.path.join(output_dir, 'climate_scores'))
+
+    with _atomic_write(os.path.join(output_dir, 'climate_scores.arrow')) as tmp_path:
+        feather.write_feather(table, tmp_path, compression='uncompressed')
+
+    risk_index = RiskIndex.from_frame(scores)
+    risk_index.write(os.path.join(output_dir, 'risk_index.arrow'))
+
+    for name, aggregate in dashboard_aggregates(scores, risk_index).items():
+        with _atomic_write(os.path.join(output_dir, 'aggregates', f'{name}.parquet')) as tmp_path:
+            aggregate.to_parquet(tmp_path, index=False)
+    return table.num_rows
+
+def _output_filter(locations=None, regions=None, start=None, end=None):
+    conditions = []
+    if locations is not None:
+        conditions.append(pa_dataset.field('Location').isin(list(locations)))
+    if regions is not None:
+        conditions.append(pa_dataset.field('region').isin(list(regions)))
+    if start is not None:
+        start = pd.Timestamp(start)
+        conditions += [pa_dataset.field('year') >= start.year, pa_dataset.field('date') >= start.to_pydatetime()]
+    if end is not None:
+        end = pd.Timestamp(end)
+        conditions += [pa_dataset.field('year') <= end.year, pa_dataset.field('date') <= end.to_pydatetime()]
+    if not conditions:
+        return None
+    expression = conditions[0]
+    for condition in conditions[1:]:
+        expression = expression & condition
+    return expression
+
+# Reads the score rows matching the location, region and date-range (inclusive) filters.
+# From Parquet, the filters prune region/year partitions and skip row groups by their
+# statistics; with memory_map=True the Arrow IPC copy is memory-mapped and filtered instead.
+def read_outputs(output_dir=OUTPUT_DIR, locations=None, regions=None, start=None, end=None,
+                 columns=None, memory_map=False):
+    if pa is None:
+        raise ImportError('pyarrow is required to read the outputs')
+
+    expression = _output_filter(locations, regions, start, end)
+    if memory_map:
+        table = feather.read_table(os.path.join(output_dir, 'climate_scores.arrow'), memory_map=True)
+        if expression is not None:
+            table = table.filter(expression)
+        if columns is not None:
+            table = table.select(columns)
+    else:
+        dataset = pa_dataset.dataset(os.path.join(output_dir, 'climate_scores'), format='parquet',
+                                     partitioning='hive')
+        table = dataset.to_table(columns=columns, filter=expression)
+    return table.to_pandas()
+
+"""##**Reporting**"""
+
+# Figures are kept out of the computation. 'headless' draws nothing; 'report' renders every
+# figure to a PNG in a background process pool and lists them in an index.html, so the pipeline
+# hands the data over and carries on; 'show' opens the figures with plt.show() as they come.
+PLOT_MODES = ('headless', 'report', 'show')
+REPORT_DIR = os.environ.get('SCA_REPORT_DIR', os.path.join(OUTPUT_DIR, 'report'))
+
+def _render_figure(path, draw, args, figsize):
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=figsize)
+    draw(fig.subplots(), *args)
+    fig.savefig(path, dpi=100, bbox_inches='tight')
+    return path
+
+class FigureReport:
+    def __init__(self, mode='headless', report_dir=REPORT_DIR, max_workers=1):
+        if mode not in PLOT_MODES:
+            raise ValueError(f'Unknown plot mode: {mode}')
+        self.mode = mode
+        self.report_dir = report_dir
+        self.max_workers = max_workers
+        self.figures = {}
+        self._pool = None
+
+    # Draws figure `name` with draw(ax, *args). In report mode this only submits the job.
+    def figure(self, name, draw, *args, figsize=(8, 5)):
+        if self.mode == 'headless':
+            return
+        if self.mode == 'show':
+            import matplotlib.pyplot as plt
+
+            fig, ax = plt.subplots(figsize=figsize)
+            draw(ax, *args)
+            plt.show()
+            return
+        if self._pool is None:
+            os.makedirs(self.report_dir, exist_ok=True)
+            # Spawned workers: forking a parent that may hold OpenMP threads can deadlock
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                             mp_context=multiprocessing.get_context('spawn'))
+        path = os.path.join(self.report_dir, f'{name}.png')
+        self.figures[name] = self._pool.submit(_render_figure, path, draw, args, figsize)
+
+    # Waits for the rendering jobs, writes index.html and returns the paths of the rendered figures
+    def close(self):
+        if self._pool is None:
+            return []
+        self._pool.shutdown(wait=True)
+        self._pool = None
+
+        rendered, failed = [], []
+        for name, future in self.figures.items():
+            if future.exception() is None:
+                rendered.append(future.result())
+            else:
+                failed.append(f'{name}: {future.exception()!r}')
+
+        items = ''.join(f'<figure><img src="{os.path.basename(path)}"><figcaption>{os.path.basename(path)[:-4]}'
+                        f'</figcaption></figure>\n' for path in rendered)
+        items += ''.join(f'<p>Failed: {message}</p>\n' for message in failed)
+        with open(os.path.join(self.report_dir, 'index.html'), 'w') as f:
+            f.write(f'<html><head><title>Pipeline report</title></head><body>\n{items}</body></html>\n')
+        return rendered
+
+# Figures of the skewness pairs evaluated on the augmented data, and of each region's residuals
+def report_skewness(report, final_filled_data, skewness_dfX):
+    for mean_col, med_col in skewness_dfX['feature_pair']:
+        report.figure(f'skewness_{mean_col}', plot_skewness, final_filled_data[mean_col].dropna(),
+                      final_filled_data[med_col].dropna(), f'{mean_col} vs {med_col}')
+
+def report_residuals(report, region_results):
+    for region, result in region_results.items():
+        report.figure(f"residuals_{region.replace(' ', '_')}", plot_residuals, result['residuals'])
+
+"""##**Pipeline**"""
+
+# Each stage takes its params and the outputs of its input stages, in order
+def _load_stage(params):
+    return load_merged_data(params['path'], url=params['url'])
+
+def _augment_stage(params, merged_data):
+    weights_by_country = get_country_climate_weights(merged_data, 'Value', as_frame=True)
+    final_aug_data = disaggregate_monthly(merged_data, 'Value', weights_by_country,
+                                          solver=params['solver'], mode=params['mode'])
+    return impute_monthly_mortality(final_aug_data, 'monthly_Value', 'Value', inplace=True)
+
+def _features_stage(params, final_filled_data):
+    return build_feature_frame(final_filled_data, spec=params['spec'])
+
+def _train_stage(params, features):
+    final_df, _ = features
+    return run_all_regions(final_df, params['config'], regions=params['regions'], max_workers=params['max_workers'])
+
+def _attribute_stage(params, region_results):
+    impacts = []
+    for result in region_results.values():
+        impact, attribution_cache = attribute_region(result, params['config'])
+        run_profile.count('attribution_cache_hits', attribution_cache['cache_hits'])
+        run_profile.count('attribution_cache_misses', attribution_cache['cache_misses'])
+        impacts.append(impact)
+
+    #Combining all
+    df_combined = pd.concat(impacts, ignore_index=True)
+    df_combined['climate_score'] = df_combined['climate_score'].astype(int)
+    return df_combined
+
+def _forecast_stage(params, df_combined):
+    return forecast_climate_scores(df_combined, params['config'])
+
+def _outputs_stage(params, forecast):
+    model_df, forecast_df, _ = forecast
+    return write_outputs(model_df, forecast_df, params['output_dir'])
+
+# Stage graph. 'files' names the params holding input files, which are hashed by content.
+pipeline_stages = {
+    'load': {'run': _load_stage, 'inputs': [], 'params': {'path': DATA_PATH, 'url': DATA_URL},
+             'files': ['path']},
+    'augment': {'run': _augment_stage, 'inputs': ['load'], 'params': {'solver': 'kkt', 'mode': 'per_year'}},
+    'features': {'run': _features_stage, 'inputs': ['augment'], 'params': {'spec': feature_spec}},
+    'train': {'run': _train_stage, 'inputs': ['features'],
+              'params': {'config': None, 'regions': REGIONS, 'max_workers': None}},
+    'attribute': {'run': _attribute_stage, 'inputs': ['train'], 'params': {'config': None}},
+    'forecast': {'run': _forecast_stage, 'inputs': ['attribute'], 'params': {'config': None}},
+    'outputs': {'run': _outputs_stage, 'inputs': ['forecast'], 'params': {'output_dir': OUTPUT_DIR}}
+}
+
+STAGE_CACHE_DIR = os.path.join(CACHE_DIR, 'stages')
+
+# Code version of a stage: the source of its function and of every function, class and plain
+# constant of this module that it references, followed transitively, so editing one stage's code
+# does not invalidate the stages before it
+def _referenced_names(obj):
+    if inspect.isclass(obj):
+        return set().union(*(_referenced_names(member) for member in vars(obj).values()
+                             if inspect.isfunction(inspect.unwrap(member)) or isinstance(member, (classmethod, property))))
+    if isinstance(obj, classmethod):
+        obj = obj.__func__
+    if isinstance(obj, property):
+        return _referenced_names(obj.fget)
+    names, code_objects = set(), [inspect.unwrap(obj).__code__]
+    while code_objects:
+        code = code_objects.pop()
+        names.update(code.co_names)
+        code_objects.extend(const for const in code.co_consts if inspect.iscode(const))
+    return {name for name in names if not name.startswith('__')}
+
+def _code_digest(fn):
+    module_globals = globals()
+    sources, pending, seen = {}, [fn], set()
+    while pending:
+        obj = pending.pop()
+        for name in _referenced_names(obj) - seen:
+            seen.add(name)
+            value = module_globals.get(name)
+            target = inspect.unwrap(value) if callable(value) else value
+            if (inspect.isfunction(target) or inspect.isclass(target)) and target.__module__ == fn.__module__:
+                sources[name] = inspect.getsource(target)
+                pending.append(target)
+            elif isinstance(value, (dict, list, tuple, str, int, float)):
+                sources[name] = repr(value)
+    digest = hashlib.sha256(inspect.getsource(fn).encode())
+    for name in sorted(sources):
+        digest.update(f'{name}\x1f{sources[name]}'.encode())
+    return digest.hexdigest()
+
+def _stage_key(name, stage, params, input_keys):
+    digest = hashlib.sha256(name.encode())
+    digest.update(_code_digest(stage['run']).encode())
+    digest.update(json.dumps(params, sort_keys=True, default=repr).encode())
+    # Files are keyed by their contents; a missing one by the params alone (the load stage then
+    # reads params['url'])
+    for param in stage.get('files', []):
+        if os.path.exists(params[param]):
+            digest.update(_file_hash(params[param]).encode())
+    for input_key in input_keys:
+        digest.update(input_key.encode())
+    return digest.hexdigest()
+
+def _stage_order(stages, until_stage=None):
+    order = []
+
+    def visit(name):
+        if name not in order:
+            for upstream in stages[name]['inputs']:
+                visit(upstream)
+            order.append(name)
+
+    for name in ([until_stage] if until_stage else stages):
+        visit(name)
+    return order
+
+def _downstream(stages, name):
+    selected = {name}
+    for stage in _stage_order(stages):
+        if selected.intersection(stages[stage]['inputs']):
+            selected.add(stage)
+    return selected
+
+# Stage outputs by name; cached outputs are only unpickled when something reads them
+class StageOutputs(dict):
+    def __init__(self):
+        super().__init__()
+        self.paths = {}
+
+    def __missing__(self, name):
+        with open(self.paths[name], 'rb') as f:
+            self[name] = pickle.load(f)
+        return self[name]
+
+# Rows a stage produced: frames by length, tuples by their first item, region results by their
+# feature rows, and row counts (write_outputs) as they are
+def _output_rows(output):
+    if isinstance(output, (int, np.integer)):
+        return int(output)
+    if isinstance(output, tuple):
+        return _output_rows(output[0])
+    if isinstance(output, dict):
+        return sum(len(result['X']) for result in output.values())
+    return len(output)
+
+# Runs the stages in dependency order. Every output is pickled under a key hashing the stage's
+# code version, its params, the content of its input files and the keys of its input stages, so a
+# stage reruns only when something it depends on changed. from_stage forces that stage and
+# everything downstream of it to recompute; until_stage stops once that stage and its inputs are
+# done. params overrides stage params as {stage: {param: value}}. on_stage(name, outputs) is called
+# once each stage's output is available, e.g. to hand it to the reporting layer. Each stage runs
+# as a run_profile section ('stage:<name>', profiled when run_profile has a profile_dir). Returns
+# the outputs and a report of cached and computed stages with their time, memory and row counts.
+def run_pipeline(stages=None, from_stage=None, until_stage=None, params=None, cache_dir=STAGE_CACHE_DIR,
+                 on_stage=None):
+    stages = pipeline_stages if stages is None else stages
+    params = params or {}
+    forced = _downstream(stages, from_stage) if from_stage else set()
+    outputs, keys, report = StageOutputs(), {}, []
+
+    for name in _stage_order(stages, until_stage):
+        stage = stages[name]
+        stage_params = {**stage['params'], **params.get(name, {})}
+        keys[name] = _stage_key(name, stage, stage_params, [keys[upstream] for upstream in stage['inputs']])
+        output_path = os.path.join(cache_dir, f'{name}_{keys[name][:16]}.pkl')
+
+        with run_profile.section(f'stage:{name}', profile=True) as entry:
+            if name not in forced and os.path.exists(output_path):
+                outputs.paths[name] = output_path
+                status = 'cached'
+            else:
+                outputs[name] = stage['run'](stage_params, *(outputs[upstream] for upstream in stage['inputs']))
+                entry['rows'] = _output_rows(outputs[name])
+                with _atomic_write(output_path) as tmp_path, open(tmp_path, 'wb') as f:
+                    pickle.dump(outputs[name], f, protocol=pickle.HIGHEST_PROTOCOL)
+                status = 'computed'
+
+        report.append({'stage': name, 'status': status, 'seconds': entry['wall_seconds'],
+                       'cpu_seconds': entry['cpu_seconds'], 'peak_rss_mb': entry['peak_rss_mb'],
+                       'rows': entry['rows'],
+                       'rows_per_sec': entry['rows'] / entry['wall_seconds'] if entry['rows'] else None,
+                       'key': keys[name][:16]})
+        if on_stage is not None:
+            on_stage(name, outputs)
+
+    return outputs, pd.DataFrame(report)
+
+"""##**Benchmarks**"""
+
+BENCHMARK_DIR = os.environ.get('SCA_BENCHMARK_DIR', 'benchmarks')
+
+# Locations per region and the year span of the merged CSV, which the synthetic panels scale up
+SYNTHETIC_REGIONS = {'Central Africa': 8, 'East Africa': 15, 'North Africa': 5, 'Southern Africa': 6, 'West Africa': 15}
+SYNTHETIC_START_YEAR = 1993
+SYNTHETIC_YEARS = 32
+
+# Synthetic panel with the columns and dtypes of the merged CSV as load_merged_data returns them.
+# scale multiplies the number of locations (axis='locations') or of years (axis='years'). Every
+# location gets a seasonal temperature, precipitation and AOD climate with monthly noise; AOD is
+# missing for the first ten years, as in the source data; the yearly columns are the
+# location-year mean temperature and total precipitation; Value is a yearly mortality count that
+# follows the yearly temperature; and missing_fraction of the location-months are dropped.
+def synthetic_panel(scale=1, axis='locations', missing_fraction=0.01, seed=0):
+    if axis not in ('locations', 'years'):
+        raise ValueError(f'Unknown axis: {axis}')
+    rng = np.random.default_rng(seed)
+    location_scale, year_scale = (scale, 1) if axis == 'locations' else (1, scale)
+
+    regions = np.repeat(list(SYNTHETIC_REGIONS), [n * location_scale for n in SYNTHETIC_REGIONS.values()])
+    n_locations, n_years = len(regions), SYNTHETIC_YEARS * year_scale
+    location = np.repeat(np.arange(n_locations), n_years * 12)
+    year_offset = np.tile(np.repeat(np.arange(n_years), 12), n_locations)
+    month = np.tile(np.arange(1, 13), n_locations * n_years)
+    location_year = location * n_years + year_offset
+    n_rows = len(location)
+
+    def per_location(values):
+        return values[location]
+
+    def noise(low, high):
+        return rng.uniform(low, high, n_rows)
+
+    season = np.sin(2 * np.pi * (month - per_location(rng.uniform(0, 12, n_locations))) / 12)
+    tavg = (per_location(rng.normal(25, 4, n_locations)) + per_location(rng.uniform(1, 5, n_locations)) * season
+            + rng.normal(0, 0.7, n_rows))
+    precip = (per_location(rng.lognormal(4, 0.8, n_locations)) * np.clip(1 + 0.9 * season, 0.05, None)
+              * rng.gamma(4, 0.25, n_rows))
+    aod = np.clip(per_location(rng.uniform(100, 400, n_locations)) * (1 + 0.4 * season)
+                  + rng.normal(0, 60, n_rows), 1, None)
+    aod[year_offset < 10] = np.nan
+
+    yearly_temperature = (np.bincount(location_year, tavg) / 12)[location_year]
+    yearly_precipitation = np.bincount(location_year, precip)[location_year]
+    temperature_anomaly = yearly_temperature - per_location(np.bincount(location, tavg) / (n_years * 12))
+    value = (per_location(rng.lognormal(5, 1.2, n_locations)) * np.exp(0.05 * temperature_anomaly
+             + 0.01 * year_offset / year_scale) * rng.lognormal(0, 0.05, n_locations * n_years)[location_year])
+
+    codes = np.array([f's{i:04d}' for i in range(n_locations)], dtype=object)
+    panel = pd.DataFrame({
+        'country_code': codes[location],
+        'year': SYNTHETIC_START_YEAR + year_offset,
+        'month_number': month,
+        'tavg_temperature': tavg,
+        'tmed_temperature': tavg + rng.normal(0, 0.3, n_rows),
+        'tmin_temperature': tavg - noise(6, 10),
+        'tmax_temperature': tavg + noise(6, 10),
+        'avg_precipitation': precip,
+        'med_precipitation': precip * noise(0.8, 1.1),
+        'min_precipitation': precip * noise(0, 0.6),
+        'max_precipitation': precip * noise(1.5, 2.5),
+        'avg_aod': aod,
+        'med_aod': aod * noise(0.9, 1.1),
+        'min_aod': aod * noise(0.2, 0.6),
+        'max_aod': aod * noise(2, 4),
+        'yearly_avg_temperature': yearly_temperature,
+        'yearly_avg_precipitation': yearly_precipitation,
+        'region': regions[location],
+        'Location': np.array([f'Location {i:04d}' for i in range(n_locations)], dtype=object)[location],
+        'Value': value
+    })
+    panel = panel[rng.random(n_rows) >= missing_fraction].reset_index(drop=True)
+    return _compact_dtypes(panel)
+
+# Inputs of the benchmarks on one panel, each built on first use and outside the timings
+class BenchmarkInputs:
+    def __init__(self, panel):
+        self.panel = panel
+
+    @cached_property
+    def weights(self):
+        return get_country_climate_weights(self.panel, 'Value', as_frame=True)
+
+    @cached_property
+    def disaggregated(self):
+        return disaggregate_monthly(self.panel.copy(), 'Value', self.weights)
+
+    @cached_property
+    def augmented(self):
+        return impute_monthly_mortality(self.disaggregated, 'monthly_Value', 'Value')
+
+    @cached_property
+    def composite(self):
+        df = add_composite_features(self.augmented.copy())
+        return df.sort_values(['Location', 'year', 'month_number']).reset_index(drop=True)
+
+    @cached_property
+    def features(self):
+        return build_feature_frame(self.augmented)[0]
+
+    # The largest region, as in the region benchmarks
+    @cached_property
+    def region(self):
+        return self.features['region'].value_counts().idxmax()
+
+    @cached_property
+    def region_frame(self):
+        df = self.features[self.features['region'] == self.region].reset_index(drop=True)
+        return df, _feature_columns(df)
+
+    @cached_property
+    def region_model(self):
+        import xgboost as xgb
+        from sklearn.model_selection import train_test_split
+
+        df, feature_cols = self.region_frame
+        X = df[feature_cols].to_numpy(dtype=np.float32, na_value=np.nan)
+        y = df['Value'].to_numpy(dtype=np.float32, na_value=np.nan)
+        train_idx, test_idx = train_test_split(np.arange(len(df)), test_size=region_config['test_size'],
+                                               random_state=region_config['random_state'])
+        train = xgb.QuantileDMatrix(X[train_idx], label=y[train_idx], feature_names=feature_cols)
+        test = xgb.QuantileDMatrix(X[test_idx], label=y[test_idx], feature_names=feature_cols, ref=train)
+        return train_region_model(train, test, region_config), train
+
+    # Historical climate scores in the layout of the attribute stage
+    @cached_property
+    def scores(self):
+        rng = np.random.default_rng(0)
+        scores = self.augmented[['region', 'country_code', 'Location', 'year', 'month_number', 'Value']].copy()
+        monthly = self.augmented['monthly_Value'].to_numpy(dtype=float, na_value=0)
+        scores['climate_score'] = np.round(monthly * rng.uniform(0, 0.3, len(scores))).astype(int)
+        return scores
+
+# Each benchmark is (setup, run): setup(inputs) prepares the arguments outside the timing and
+# run(*args) is timed and returns the rows it processed. The per-call SLSQP Denton fits and the
+# SARIMA searches are run on the first BENCHMARK_LIMITS country-years and locations only.
+BENCHMARK_LIMITS = {'denton': 500, 'forecast_sarima': 4}
+
+def _denton_setup(inputs):
+    positions, yearly_totals = _country_year_positions(inputs.panel, 'Value')
+    indicators = _monthly_indicators(inputs.panel, inputs.weights)[positions]
+    limit = BENCHMARK_LIMITS['denton']
+    return yearly_totals[:limit], indicators[:limit]
+
+def _denton_run(yearly_totals, indicators):
+    for yearly_total, indicator_series in zip(yearly_totals, indicators):
+        denton_disaggregate(yearly_total, indicator_series)
+    return indicators.size
+
+def _disaggregate_run(panel, weights):
+    return len(disaggregate_monthly(panel, 'Value', weights))
+
+def _impute_run(disaggregated):
+    return len(impute_monthly_mortality(disaggregated, 'monthly_Value', 'Value', inplace=True))
+
+def _lag_roll_run(df, spec):
+    return len(lag_rolling_features(df, spec))
+
+def _selection_vif_setup(inputs):
+    df, feature_cols = inputs.region_frame
+    X = df[feature_cols].to_numpy(dtype=np.float32, na_value=np.nan)
+    y = df['Value'].to_numpy(dtype=np.float32, na_value=np.nan)
+    return X, y, feature_cols, impute_region_features(df, feature_cols)[feature_cols]
+
+def _selection_vif_run(X, y, feature_cols, X_imputed):
+    import xgboost as xgb
+
+    feature_importance(xgb.QuantileDMatrix(X, label=y, feature_names=feature_cols), region_config)
+    eliminate_high_vif(X_imputed, region_config['vif_threshold'])
+    return len(X)
+
+def _region_training_run(final_df, region, config):
+    return len(run_region_pipeline(final_df, region, config)['X'])
+
+def _shap_setup(inputs):
+    df, feature_cols = inputs.region_frame
+    model, reference = inputs.region_model
+    return model, df[feature_cols], df[['Location', 'year', 'month_number']].copy(), reference
+
+def _shap_run(model, X, ids, reference):
+    stream_attribution(model, X, ids, reference, chunk_size=region_config['attribution_chunk_size'])
+    return len(X)
+
+def _forecast_setup(inputs, method):
+    scores = inputs.scores
+    if method == 'sarima':
+        locations = scores['Location'].unique()[:BENCHMARK_LIMITS['forecast_sarima']]
+        scores = scores[scores['Location'].isin(locations)]
+    # The same horizon past the history as the pipeline's 2030 end past the 2024 data
+    config = {'method': method, 'order_cache_dir': None, 'forecast_end': f"{int(scores['year'].max()) + 6}-12-01"}
+    return scores, config
+
+def _forecast_run(scores, config):
+    return len(forecast_climate_scores(scores, config)[0])
+
+BENCHMARKS = {
+    'denton': (_denton_setup, _denton_run),
+    'disaggregate': (lambda inputs: (inputs.panel.copy(), inputs.weights), _disaggregate_run),
+    'impute': (lambda inputs: (inputs.disaggregated.copy(),), _impute_run),
+    'lag_roll': (lambda inputs: (inputs.composite, feature_spec), _lag_roll_run),
+    'selection_vif': (_selection_vif_setup, _selection_vif_run),
+    'region_training': (lambda inputs: (inputs.features, inputs.region, None), _region_training_run),
+    'shap': (_shap_setup, _shap_run),
+    'forecast_sarima': (lambda inputs: _forecast_setup(inputs, 'sarima'), _forecast_run),
+    'forecast_holt_winters': (lambda inputs: _forecast_setup(inputs, 'holt_winters'), _forecast_run)
+}
+
+# Runs the benchmarks on a synthetic panel per scale, repeat times each. Reports the best and
+# median wall time, the median CPU time, the peak RSS and the rows per second of the best run.
+# A benchmark that raises is reported with its error and the others still run; on_result(results)
+# is called with the rows so far after every benchmark, so they can be stored as they complete.
+def run_benchmarks(scales=(1, 10), axis='locations', names=None, repeat=1, seed=0, on_result=None):
+    results = []
+    for scale in scales:
+        inputs = BenchmarkInputs(synthetic_panel(scale, axis, seed=seed))
+        for name in names or BENCHMARKS:
+            setup, run = BENCHMARKS[name]
+            result = {'benchmark': name, 'axis': axis, 'scale': scale, 'panel_rows': len(inputs.panel)}
+            runs = []
+            try:
+                for _ in range(repeat):
+                    args = setup(inputs)
+                    with run_profile.section(f'benchmark:{name}') as entry:
+                        entry['rows'] = run(*args)
+                    runs.append(entry)
+            except Exception as exc:
+                traceback.print_exc()
+                results.append({**result, 'error': f'{type(exc).__name__}: {exc}'})
+                print(f'{name} x{scale}: failed')
+            else:
+                wall = np.array([entry['wall_seconds'] for entry in runs])
+                results.append({
+                    **result, 'rows': runs[0]['rows'], 'repeat': repeat,
+                    'seconds_min': wall.min(), 'seconds_median': np.median(wall),
+                    'cpu_seconds_median': np.median([entry['cpu_seconds'] for entry in runs]),
+                    'peak_rss_mb': max(entry['peak_rss_mb'] for entry in runs),
+                    'rows_per_sec': runs[0]['rows'] / wall.min() if wall.min() else None
+                })
+                print(f"{name} x{scale}: {wall.min():.3f} s")
+            if on_result is not None:
+                on_result(pd.DataFrame(results))
+    return pd.DataFrame(results)
+
+def _benchmark_environment():
+    import platform
+    import xgboost as xgb
 
-forecast_df = annual_rank(forecast_df, variable='climate_score')
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=MODULE_DIR).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'machine': platform.machine(),
+            'cpus': os.cpu_count(), 'numpy': np.__version__, 'pandas': pd.__version__, 'xgboost': xgb.__version__}
+
+# Stores one JSON file per benchmark run in output_dir, named by its start time, so runs can be
+# compared later; an existing path is rewritten with the results so far
+def write_benchmarks(results, output_dir=BENCHMARK_DIR, path=None):
+    path = path or os.path.join(output_dir, f"benchmarks_{time.strftime('%Y%m%dT%H%M%S')}.json")
+    with _atomic_write(path) as tmp_path, open(tmp_path, 'w') as f:
+        json.dump({'environment': _benchmark_environment(), 'results': results.to_dict(orient='records')},
+                  f, indent=2, default=float)
+    return path
+
+def read_benchmarks(path):
+    with open(path) as f:
+        return pd.DataFrame(json.load(f)['results'])
+
+def latest_benchmarks(output_dir=BENCHMARK_DIR):
+    paths = sorted(glob.glob(os.path.join(output_dir, 'benchmarks_*.json')))
+    return paths[-1] if paths else None
+
+# Best wall times of two runs side by side; a benchmark regressed when it became slower than
+# the baseline by more than the threshold ratio
+def compare_benchmarks(baseline, current, threshold=1.1):
+    baseline = read_benchmarks(baseline) if isinstance(baseline, str) else baseline
+    current = read_benchmarks(current) if isinstance(current, str) else current
+    keys = ['benchmark', 'axis', 'scale']
+    baseline, current = (results.dropna(subset=['seconds_min']) for results in (baseline, current))
+    comparison = pd.merge(baseline[keys + ['seconds_min']], current[keys + ['seconds_min']], on=keys,
+                          suffixes=('_baseline', '_current'))
+    comparison['ratio'] = comparison['seconds_min_current'] / comparison['seconds_min_baseline']
+    comparison['regression'] = comparison['ratio'] > threshold
+    return comparison
+
+"""##**Command Line**"""
+
+RUN_REPORT_PATH = os.path.join(OUTPUT_DIR, 'run_report.json')
+
+# Subcommand -> last pipeline stage it runs; upstream stages come from the stage cache when valid.
+# 'forecast' also writes the output tables the dashboard reads.
+COMMAND_STAGES = {'run': None, 'augment': 'augment', 'features': 'features', 'train': 'train',
+                  'attribute': 'attribute', 'forecast': 'outputs'}
+
+# Stage outputs with figures, handed to the report as soon as they are available
+def report_stage(report, name, outputs):
+    if name == 'features':
+        report_skewness(report, outputs['augment'], outputs['features'][1])
+    elif name == 'train':
+        report_residuals(report, outputs['train'])
+
+# Summaries of the stages computed in this run; cached outputs are not unpickled just to print them
+def print_stage_results(outputs, run_report):
+    stages_run = set(run_report.loc[run_report['status'] == 'computed', 'stage'])
+
+    # Feature Generation
+    if 'features' in stages_run:
+        print(outputs['features'][1])
+
+    # Feature Selection and Modeling
+    if 'train' in stages_run:
+        for region, result in outputs['train'].items():
+            print_region_metrics(region, result['metrics'])
+
+    # Forecast
+    if 'forecast' in stages_run:
+        fit_report = outputs['forecast'][2]
+        print(fit_report[fit_report['status'] != 'ok'][['Location', 'status', 'error']])
+
+    print(run_report.to_string(index=False))
+
+# Dashboard over the written outputs. Streamlit runs in its own process, so serving does not
+# import the modeling stack.
+def serve(output_dir=OUTPUT_DIR, port=None):
+    app = os.path.join(MODULE_DIR, 'streamlit_app.py')
+    command = [sys.executable, '-m', 'streamlit', 'run', app]
+    if port is not None:
+        command += ['--server.port', str(port)]
+    return subprocess.call(command, env={**os.environ, 'SCA_OUTPUT_DIR': output_dir})
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Climate-attributable sickle cell mortality risk pipeline')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    stage_options = argparse.ArgumentParser(add_help=False)
+    stage_options.add_argument('--from-stage', choices=list(pipeline_stages),
+                               help='recompute this stage and every stage after it')
+    stage_options.add_argument('--plots', choices=PLOT_MODES, default='headless',
+                               help='headless: no figures; report: render them to PNG/HTML in the '
+                                    'background; show: open them interactively')
+    stage_options.add_argument('--report-dir', default=REPORT_DIR)
+    stage_options.add_argument('--run-report', default=RUN_REPORT_PATH, help='JSON run report to write')
+    stage_options.add_argument('--trace-memory', action='store_true',
+                               help='record tracemalloc peaks per section (slower)')
+    stage_options.add_argument('--profile', choices=['cprofile', 'pyinstrument'],
+                               help='also dump a profile of every computed stage to --profile-dir')
+    stage_options.add_argument('--profile-dir', default=os.path.join(OUTPUT_DIR, 'profiles'))
+
+    run = commands.add_parser('run', parents=[stage_options], help='full pipeline (the default)')
+    run.add_argument('--until-stage', choices=list(pipeline_stages), help='stop after this stage')
+    commands.add_parser('augment', parents=[stage_options], help='monthly disaggregation and imputation')
+    commands.add_parser('features', parents=[stage_options], help='lag and rolling climate features')
+
+    train = commands.add_parser('train', parents=[stage_options], help='feature selection and region models')
+    train.add_argument('--region', action='append', choices=REGIONS,
+                       help='train only this region (repeatable); defaults to all regions')
+    train.add_argument('--max-workers', type=int, help='region processes to run in parallel')
+
+    attribute = commands.add_parser('attribute', parents=[stage_options], help='historical climate scores')
+    attribute.add_argument('--output', help='also write the scores to this Parquet file')
+
+    forecast = commands.add_parser('forecast', parents=[stage_options],
+                                   help='forecast climate scores and write the output tables')
+    forecast.add_argument('--method', choices=['sarima', 'holt_winters', 'seasonal_naive'],
+                          default=forecast_config['method'])
+    forecast.add_argument('--output-dir', default=OUTPUT_DIR)
+
+    serve_command = commands.add_parser('serve', help='dashboard over the output tables')
+    serve_command.add_argument('--output-dir', default=OUTPUT_DIR)
+    serve_command.add_argument('--port', type=int)
+
+    benchmark = commands.add_parser('benchmark', help='benchmarks on synthetic panels')
+    benchmark.add_argument('--scales', type=int, nargs='+', default=[1, 10],
+                           help='panel sizes as multiples of the merged data (e.g. 1 10 100)')
+    benchmark.add_argument('--axis', choices=['locations', 'years'], default='locations')
+    benchmark.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='benchmarks to run')
+    benchmark.add_argument('--repeat', type=int, default=1, help='runs per benchmark; the best is compared')
+    benchmark.add_argument('--output-dir', default=BENCHMARK_DIR)
+    benchmark.add_argument('--compare', nargs='?', const='latest',
+                           help='baseline results file to compare with (default: the latest stored run)')
+    benchmark.add_argument('--threshold', type=float, default=1.1,
+                           help='slowdown ratio reported as a regression')
+    return parser
+
+# Runs the benchmark suite and stores the results as they complete; exits with 1 when a benchmark
+# failed or regressed against the baseline
+def benchmark_command(args):
+    baseline = latest_benchmarks(args.output_dir) if args.compare == 'latest' else args.compare
+    path = os.path.join(args.output_dir, f"benchmarks_{time.strftime('%Y%m%dT%H%M%S')}.json")
+    results = run_benchmarks(args.scales, args.axis, args.only, args.repeat,
+                             on_result=lambda results: write_benchmarks(results, args.output_dir, path))
+    print(results.to_string(index=False))
+    print(f'Results written to {path}')
+    failed = 'error' in results and results['error'].notna().any()
+
+    if args.compare is None:
+        return int(failed)
+    if baseline is None:
+        print('No stored benchmark run to compare with')
+        return int(failed)
+    comparison = compare_benchmarks(baseline, results, args.threshold)
+    print(f'Compared with {baseline}')
+    print(comparison.to_string(index=False))
+    return int(failed or comparison['regression'].any())
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # Without a subcommand the whole pipeline runs, as it did before the subcommands existed
+    if not argv or (argv[0] not in COMMAND_STAGES and argv[0] not in ('serve', 'benchmark', '-h', '--help')):
+        argv = ['run', *argv]
+    args = build_parser().parse_args(argv)
+
+    if args.command == 'serve':
+        return serve(args.output_dir, args.port)
+    if args.command == 'benchmark':
+        return benchmark_command(args)
+
+    params = {}
+    if args.command == 'train':
+        params['train'] = {'regions': args.region or REGIONS, 'max_workers': args.max_workers}
+    elif args.command == 'forecast':
+        params['forecast'] = {'config': {'method': args.method}}
+        params['outputs'] = {'output_dir': args.output_dir}
+
+    until_stage = args.until_stage if args.command == 'run' else COMMAND_STAGES[args.command]
+    run_profile.configure(trace_memory=args.trace_memory, profile_dir=args.profile_dir if args.profile else None,
+                          profiler=args.profile or 'cprofile')
+    report = FigureReport(args.plots, args.report_dir)
+    on_stage = None if args.plots == 'headless' else (lambda name, outputs: report_stage(report, name, outputs))
+    outputs, run_report = run_pipeline(from_stage=args.from_stage, until_stage=until_stage, params=params,
+                                       on_stage=on_stage)
+    print_stage_results(outputs, run_report)
+    run_profile.write(args.run_report, command=args.command, argv=argv,
+                      stages=run_report.to_dict(orient='records'))
+    if run_profile.counters:
+        print(', '.join(f'{name}: {n}' for name, n in run_profile.counters.items()))
+
+    if args.command == 'attribute' and args.output:
+        outputs['attribute'].to_parquet(args.output, index=False)
+
+    # Only the figures still rendering are waited for, after the pipeline has finished
+    rendered = report.close()
+    if rendered:
+        print(f'{len(rendered)} figures written to {os.path.join(args.report_dir, "index.html")}')
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
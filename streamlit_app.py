@@ -1,7 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import os
+import time
+
+import pandas as pd
 import streamlit as st
 import streamlit.components.v1 as components
+from pyarrow import compute as pc, feather
+
+# Written by write_outputs at the end of the modeling pipeline
+OUTPUT_DIR = os.environ.get('SCA_OUTPUT_DIR', 'outputs')
+AGGREGATES = ['region_year', 'country_month', 'top_risk_months', 'peak_months']
+MONTH_NAMES = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
 
 iframe_code = """
 <div style="position: relative; width: 100%; height: 0; padding-bottom: 56.25%;">
@@ -12,4 +22,84 @@ iframe_code = """
 </div>
 """
 
-components.html(iframe_code, height=720)
+# The aggregate tables are small and read once; every filter change redraws from memory
+@st.cache_data
+def load_aggregates(output_dir):
+    return {name: pd.read_parquet(os.path.join(output_dir, 'aggregates', f'{name}.parquet'))
+            for name in AGGREGATES}
+
+# Memory-mapped Arrow copy of the full score table, opened once per server
+@st.cache_resource
+def score_table(output_dir):
+    return feather.read_table(os.path.join(output_dir, 'climate_scores.arrow'), memory_map=True)
+
+# Full monthly detail, only read when a single country is selected
+@st.cache_data
+def location_detail(output_dir, location):
+    table = score_table(output_dir)
+    return table.filter(pc.equal(table['Location'], location)).to_pandas()
+
+st.set_page_config(page_title='Climate Impact on Sickle Cell Mortality Risk', layout='wide')
+st.title('Climate Impact on Sickle Cell Mortality Risk in Africa')
+
+if not os.path.exists(os.path.join(OUTPUT_DIR, 'aggregates')):
+    st.info(f'No pipeline outputs found in {OUTPUT_DIR!r}. Run the modeling pipeline to write them.')
+    st.stop()
+
+start = time.perf_counter()
+aggregates = load_aggregates(OUTPUT_DIR)
+region_year = aggregates['region_year']
+country_month = aggregates['country_month']
+top_risk_months = aggregates['top_risk_months']
+peak_months = aggregates['peak_months']
+
+# Filters
+regions = st.sidebar.multiselect('Region', sorted(region_year['region'].unique()),
+                                 default=sorted(region_year['region'].unique()))
+first_year, last_year = int(region_year['year'].min()), int(region_year['year'].max())
+years = st.sidebar.slider('Years', first_year, last_year, (first_year, last_year))
+sources = st.sidebar.multiselect('Series', ['history', 'forecast'], default=['history', 'forecast'])
+locations = sorted(country_month.loc[country_month['region'].isin(regions), 'Location'].unique())
+country = st.sidebar.selectbox('Country', ['All countries'] + locations)
+
+in_years = region_year['year'].between(*years)
+region_view = region_year[region_year['region'].isin(regions) & in_years & region_year['source'].isin(sources)]
+month_view = country_month[country_month['region'].isin(regions) & country_month['source'].isin(sources)]
+risk_view = top_risk_months[top_risk_months['region'].isin(regions) & top_risk_months['year'].between(*years)
+                            & top_risk_months['source'].isin(sources)]
+if country != 'All countries':
+    month_view = month_view[month_view['Location'] == country]
+    risk_view = risk_view[risk_view['Location'] == country]
+
+dashboard, power_bi = st.tabs(['Dashboard', 'Power BI report'])
+
+with dashboard:
+    st.subheader('Average monthly climate score by region')
+    st.line_chart(region_view.pivot_table(index='year', columns='region', values='climate_score'))
+
+    left, right = st.columns(2)
+    with left:
+        st.subheader('Seasonal profile')
+        st.bar_chart(month_view.pivot_table(index='month', columns='source', values='climate_score'))
+    with right:
+        st.subheader('Riskiest months')
+        st.dataframe(risk_view.sort_values('climate_score', ascending=False).head(20), hide_index=True)
+
+    st.subheader('Countries by peak month')
+    peak_month = st.selectbox('Peak month', range(1, 13), format_func=lambda month: MONTH_NAMES[month - 1])
+    peak_view = peak_months[(peak_months['month'] == peak_month) & peak_months['region'].isin(regions)
+                            & peak_months['year'].between(*years) & peak_months['source'].isin(sources)]
+    st.dataframe(peak_view.groupby(['Location', 'region'], observed=True)
+                 .agg(years=('year', 'size'), peak_score=('climate_score', 'max'))
+                 .sort_values('years', ascending=False).reset_index(), hide_index=True)
+
+    if country != 'All countries':
+        detail = location_detail(OUTPUT_DIR, country)
+        detail = detail[detail['year'].between(*years) & detail['source'].isin(sources)]
+        st.subheader(f'{country}: monthly climate score')
+        st.line_chart(detail.pivot_table(index='date', columns='source', values='climate_score'))
+
+    st.caption(f'Redrawn in {(time.perf_counter() - start) * 1000:.0f} ms')
+
+with power_bi:
+    components.html(iframe_code, height=720)
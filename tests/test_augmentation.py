@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import modeling_climate_impact_on_sickle_cell_mortality_risk_in_africa as model
+
+
+# The per-group loop impute_monthly_mortality replaced, kept as the reference
+def _impute_loop(df, monthly_col, yearly_col):
+    df = df.copy()
+
+    for (country, year), group in df.groupby(["country_code", "year"]):
+        if pd.isna(year) or pd.isna(country):
+            continue
+
+        yearly_total = group[yearly_col].iloc[0]
+        if pd.isna(yearly_total):
+            continue
+
+        indices = group.index
+        monthly_vals = df.loc[indices, monthly_col].values
+
+        known_mask = ~pd.isna(monthly_vals)
+        known_sum = round(monthly_vals[known_mask].sum()) if known_mask.any() else 0
+        count_known = known_mask.sum()
+        missing_mask = pd.isna(monthly_vals)
+        count_missing = 12 - count_known
+
+        if count_missing <= 0:
+            df.loc[indices[missing_mask], monthly_col] = 0
+            continue
+
+        if known_sum >= round(yearly_total):
+            df.loc[indices[missing_mask], monthly_col] = 0
+        else:
+            residual = round(yearly_total) - known_sum
+            per_month_value = round(residual / count_missing)
+            df.loc[indices[missing_mask], monthly_col] = per_month_value
+
+    df[monthly_col] = df[monthly_col].astype("Int64")
+    return df
+
+
+# Country-years of 1 to 15 months in shuffled row order, some with a missing yearly total, a few
+# rows without a country code, and about a third of the (whole) monthly values missing
+def _random_frame(rng):
+    groups = []
+    for i in range(rng.integers(1, 9)):
+        n_months = int(rng.choice([1, 5, 11, 12, 13, 15]))
+        yearly_total = np.nan if rng.random() < 0.15 else rng.uniform(0, 700)
+        monthly = rng.integers(0, 60, n_months).astype(float)
+        monthly[rng.random(n_months) < 0.35] = np.nan
+        groups.append(pd.DataFrame({
+            'country_code': f'c{i % 3}', 'year': 2000 + i // 3, 'month_number': np.arange(1, n_months + 1),
+            'Value': yearly_total, 'monthly_Value': monthly
+        }))
+    df = pd.concat(groups, ignore_index=True).astype({'country_code': object})
+    df.loc[rng.random(len(df)) < 0.03, 'country_code'] = None
+    return df.sample(frac=1, random_state=int(rng.integers(1 << 31))).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_impute_monthly_mortality_matches_the_loop(seed):
+    df = _random_frame(np.random.default_rng(seed))
+    expected = _impute_loop(df, 'monthly_Value', 'Value')
+
+    result = model.impute_monthly_mortality(df, 'monthly_Value', 'Value')
+    pd.testing.assert_frame_equal(result, expected)
+    assert df['monthly_Value'].dtype == float  # the input frame is left alone
+
+    inplace = model.impute_monthly_mortality(df, 'monthly_Value', 'Value', inplace=True)
+    assert inplace is df
+    pd.testing.assert_frame_equal(inplace, expected)
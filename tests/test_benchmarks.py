@@ -0,0 +1,20 @@
+import modeling_climate_impact_on_sickle_cell_mortality_risk_in_africa as model
+
+
+def test_selection_vif_runs_on_a_10x_panel():
+    results = model.run_benchmarks(scales=[10], names=['selection_vif'])
+    assert 'error' not in results
+    assert results.loc[0, 'rows'] > 0
+
+
+def test_failed_benchmark_keeps_the_other_results(monkeypatch):
+    def fail(inputs):
+        raise RuntimeError('setup failed')
+
+    monkeypatch.setitem(model.BENCHMARKS, 'failing', (fail, None))
+    stored = []
+    results = model.run_benchmarks(scales=[1], names=['failing', 'lag_roll'], on_result=stored.append)
+
+    assert results['error'].tolist()[0] == 'RuntimeError: setup failed'
+    assert results.loc[1, 'rows'] > 0
+    assert [len(results) for results in stored] == [1, 2]
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+import modeling_climate_impact_on_sickle_cell_mortality_risk_in_africa as model
+
+
+# The per-row largest-remainder loop round_to_totals replaced, kept as the reference
+def _round_loop(raw, yearly_total):
+    floored = np.floor(raw).astype(int)
+    diff = int(round(yearly_total)) - floored.sum()
+
+    if diff > 0:
+        for i in np.argsort(raw - floored)[-diff:]:
+            floored[i] += 1
+    elif diff < 0:
+        for i in np.argsort(floored - raw)[:abs(diff)]:
+            floored[i] -= 1
+
+    return np.maximum(floored, 0)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_round_to_totals_matches_the_loop(seed):
+    rng = np.random.default_rng(seed)
+    # Quarter steps give tied remainders; totals up to 15 above or below the rounded sum
+    raw = np.round(rng.uniform(0, 40, (500, 12)) * 4) / 4
+    yearly_totals = raw.sum(axis=1) + rng.integers(-15, 16, len(raw)) + rng.choice([0, 0.25, 0.5], len(raw))
+
+    expected = np.array([_round_loop(row, total) for row, total in zip(raw, yearly_totals)])
+    np.testing.assert_array_equal(model.round_to_totals(raw, yearly_totals), expected)
+
+
+# The KKT solver against the SLSQP one on the bundled data: the same annual totals, and no month
+# more than one death apart
+def test_kkt_solver_keeps_the_slsqp_totals_and_months_within_one():
+    data = model.load_merged_data(use_cache=False)
+    weights = model.get_country_climate_weights(data, 'Value', as_frame=True)
+    positions, yearly_totals = model._country_year_positions(data, 'Value')
+    indicators = model._monthly_indicators(data, weights)[positions]
+
+    kkt = model.denton_disaggregate_batched(yearly_totals, indicators)
+    slsqp = np.array([model.denton_disaggregate(total, row) for total, row in zip(yearly_totals, indicators)])
+
+    np.testing.assert_array_equal(kkt.sum(axis=1), slsqp.sum(axis=1))
+    np.testing.assert_array_equal(kkt.sum(axis=1), np.round(yearly_totals))
+    assert np.abs(kkt - slsqp).max() <= 1
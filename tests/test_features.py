@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import modeling_climate_impact_on_sickle_cell_mortality_risk_in_africa as model
+
+SPEC = model.feature_spec
+FEATURE_COLUMNS = ([f'{var}_lag{lag}' for var in SPEC['variables'] for lag in SPEC['lags']]
+                   + [f'{var}_roll{window}' for var in SPEC['variables'] for window in SPEC['windows']]
+                   + SPEC['variables'] + ['month_sin', 'month_cos'])
+
+
+def _panel():
+    # Raw merged-data rows; 1% of the location-months are missing
+    return model.synthetic_panel(1).sort_values(['Location', 'year', 'month_number'], ignore_index=True)
+
+
+def _period(df):
+    return df['year'].astype(int) * 12 + df['month_number'].astype(int) - 1
+
+
+def _full_recompute(panel):
+    df = model.add_composite_features(panel.copy())
+    features = pd.concat([df, model.lag_rolling_features(df, SPEC)], axis=1)
+    features['month_sin'] = np.sin(2 * np.pi * features['month_number'] / 12)
+    features['month_cos'] = np.cos(2 * np.pi * features['month_number'] / 12)
+    return features
+
+
+def _append(panel, cut):
+    history = model.add_composite_features(panel[_period(panel) < cut].copy())
+    state = model.FeatureState.from_frame(history, SPEC)
+    appended = model.append_month(state, panel[_period(panel) >= cut])
+    assert state.end == _period(panel).max() + 1
+    return appended
+
+
+@pytest.mark.parametrize('n_months', [1, 3, 25])
+def test_append_month_matches_full_recompute(n_months):
+    panel = _panel()
+    appended = _append(panel, _period(panel).max() - n_months + 1)
+    expected = _full_recompute(panel).loc[appended.index]
+
+    assert len(appended) > 0
+    np.testing.assert_array_equal(appended[FEATURE_COLUMNS].to_numpy(), expected[FEATURE_COLUMNS].to_numpy())
+
+
+def test_append_month_for_a_location_first_seen_in_the_new_rows():
+    panel = _panel()
+    cut = _period(panel).max() - 13 + 1
+    new_location = panel['Location'].iloc[0]
+    panel = panel[(panel['Location'] != new_location) | (_period(panel) >= cut)].reset_index(drop=True)
+
+    appended = _append(panel, cut)
+    expected = _full_recompute(panel).loc[appended.index]
+
+    assert (appended['Location'] == new_location).sum() > 0
+    np.testing.assert_array_equal(appended[FEATURE_COLUMNS].to_numpy(), expected[FEATURE_COLUMNS].to_numpy())
+
+
+def test_append_month_rejects_months_already_in_the_state():
+    panel = _panel()
+    cut = _period(panel).max()
+    state = model.FeatureState.from_frame(model.add_composite_features(panel[_period(panel) < cut].copy()), SPEC)
+    with pytest.raises(ValueError):
+        model.append_month(state, panel[_period(panel) >= cut - 1])
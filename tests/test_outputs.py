@@ -0,0 +1,27 @@
+import pandas as pd
+import pyarrow as pa
+from pyarrow import dataset as pa_dataset
+
+import modeling_climate_impact_on_sickle_cell_mortality_risk_in_africa as model
+
+
+def _scores():
+    # Three locations of one region over 2020-2021; C only has the first half of 2021
+    rows = [{'Location': location, 'region': 'West Africa', 'year': year, 'month': month,
+             'date': pd.Timestamp(year, month, 1), 'climate_score': float(month)}
+            for location in ('A', 'B', 'C')
+            for year in (2020, 2021)
+            for month in range(1, 13 if (location, year) != ('C', 2021) else 7)]
+    return pa.Table.from_pandas(pd.DataFrame(rows), preserve_index=False)
+
+
+def test_single_location_read_keeps_one_row_group_per_partition(tmp_path):
+    model._write_score_partitions(_scores(), str(tmp_path))
+    dataset = pa_dataset.dataset(str(tmp_path), format='parquet', partitioning='hive')
+    location_filter = pa_dataset.field('Location') == 'C'
+
+    fragments = list(dataset.get_fragments())
+    assert len(fragments) == 2
+    assert sum(fragment.num_row_groups for fragment in fragments) == 6
+    assert sum(len(fragment.split_by_row_group(location_filter)) for fragment in fragments) == 2
+    assert dataset.to_table(filter=location_filter).num_rows == 18
@@ -0,0 +1,29 @@
+import pytest
+
+import modeling_climate_impact_on_sickle_cell_mortality_risk_in_africa as model
+
+
+def test_missing_data_file_is_keyed_by_its_url(tmp_path):
+    stage = model.pipeline_stages['load']
+    missing = {'path': str(tmp_path / 'missing.csv'), 'url': model.DATA_URL}
+    other_url = {**missing, 'url': 'https://example.org/data.csv'}
+
+    key = model._stage_key('load', stage, missing, [])
+    assert key == model._stage_key('load', stage, missing, [])
+    assert key != model._stage_key('load', stage, other_url, [])
+
+
+def test_atomic_write_keeps_the_old_file_when_the_write_fails(tmp_path):
+    path = tmp_path / 'nested' / 'report.json'
+    with model._atomic_write(str(path)) as tmp:
+        with open(tmp, 'w') as f:
+            f.write('old')
+    assert path.read_text() == 'old'
+
+    with pytest.raises(RuntimeError):
+        with model._atomic_write(str(path)) as tmp:
+            with open(tmp, 'w') as f:
+                f.write('partial')
+            raise RuntimeError
+    assert path.read_text() == 'old'
+    assert [p.name for p in path.parent.iterdir()] == ['report.json']
@@ -0,0 +1,29 @@
+import pandas as pd
+
+import modeling_climate_impact_on_sickle_cell_mortality_risk_in_africa as model
+
+
+def _index():
+    # Two locations over 2020-2021; month 5 is the riskiest month of every location and year
+    rows = [{'Location': location, 'year': year, 'month': month,
+             'climate_score': offset + (year - 2020) * 50 + (40 if month == 5 else month)}
+            for location, offset in (('A', 0), ('B', 100))
+            for year in (2020, 2021)
+            for month in range(1, 13)]
+    return model.RiskIndex.from_frame(pd.DataFrame(rows))
+
+
+def test_top_months_outside_year_range_is_empty():
+    index = _index()
+    assert len(index.top_months('A', 2021)) == 3
+    assert (index.top_months('A', 2021)['year'] == 2021).all()
+    assert index.top_months('A', 2022).empty
+    assert index.top_months('B', 2019).empty
+
+
+def test_peak_locations_outside_year_range_is_empty():
+    index = _index()
+    assert set(index.peak_locations(5, 2021)['Location']) == {'A', 'B'}
+    assert index.peak_locations(5, 2022).empty
+    assert index.peak_locations(4, 2022).empty
+    assert index.peak_locations(5, 2019).empty
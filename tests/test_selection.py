@@ -0,0 +1,100 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+from statsmodels.stats.outliers_influence import variance_inflation_factor
+from statsmodels.tools.tools import add_constant
+
+import modeling_climate_impact_on_sickle_cell_mortality_risk_in_africa as model
+
+
+# VIF of every non-constant column with one OLS fit per column, as vif_table used to compute them
+def _statsmodels_vif(X):
+    X = add_constant(X.loc[:, X.std() > 0])
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        vif = [variance_inflation_factor(X.values, i) for i in range(X.shape[1])]
+    return pd.Series(vif, index=X.columns).drop('const')
+
+
+def _statsmodels_elimination(X, threshold):
+    dropped = []
+    while X.shape[1]:
+        vif = _statsmodels_vif(X)
+        if vif.max() <= threshold:
+            return vif, dropped
+        dropped.append(vif.idxmax())
+        X = X.drop(columns=vif.idxmax())
+    return pd.Series(dtype=float), dropped
+
+
+def _features(rng, n=300):
+    a, b, c, d = rng.normal(size=(4, n))
+    return pd.DataFrame({
+        'a': a, 'b': b, 'c': c,
+        'c_noisy': c + rng.normal(0, 0.2, n),
+        'd': d, 'd_noisy': d + rng.normal(0, 0.3, n), 'd_noisier': d + rng.normal(0, 0.5, n),
+        'e': rng.normal(size=n) + 0.3 * a,
+        'constant': np.ones(n)
+    })
+
+
+def test_vif_table_matches_statsmodels():
+    X = _features(np.random.default_rng(0))
+    vif = model.vif_table(X).set_index('feature')['VIF']
+    expected = _statsmodels_vif(X)
+
+    assert list(vif.index) == list(expected.index)
+    np.testing.assert_allclose(vif.to_numpy(), expected.to_numpy(), rtol=1e-8)
+
+
+def test_eliminate_high_vif_matches_statsmodels_elimination():
+    X = _features(np.random.default_rng(1))
+    vif, dropped = model.eliminate_high_vif(X, threshold=7)
+    expected_vif, expected_dropped = _statsmodels_elimination(X, threshold=7)
+
+    assert len(dropped) >= 2  # at least one rank-one downdate
+    assert dropped == expected_dropped
+    assert list(vif['feature']) == list(expected_vif.index)
+    np.testing.assert_allclose(vif['VIF'].to_numpy(), expected_vif.to_numpy(), rtol=1e-8)
+
+
+def test_eliminate_high_vif_with_an_exactly_collinear_column(monkeypatch):
+    X = _features(np.random.default_rng(2))
+    X.insert(2, 'a_twice', 2 * X['a'])
+
+    # The correlation matrix is singular: Cholesky fails, the ridge gives large but finite VIFs
+    cholesky_failures = []
+    cholesky = np.linalg.cholesky
+
+    def counting_cholesky(a):
+        try:
+            return cholesky(a)
+        except np.linalg.LinAlgError:
+            cholesky_failures.append(len(a))
+            raise
+
+    monkeypatch.setattr(np.linalg, 'cholesky', counting_cholesky)
+    vif = model.vif_table(X).set_index('feature')['VIF']
+    assert cholesky_failures
+    assert np.isfinite(vif).all()
+    assert (vif[['a', 'a_twice']] > 1 / np.sqrt(np.finfo(float).eps)).all()
+
+    # Dropping a collinear feature refactorizes the remaining block instead of the downdate
+    inversions = []
+    inverse_correlation = model._inverse_correlation
+
+    def counting_inverse(corr):
+        inversions.append(len(corr))
+        return inverse_correlation(corr)
+
+    monkeypatch.setattr(model, '_inverse_correlation', counting_inverse)
+    vif, dropped = model.eliminate_high_vif(X, threshold=7)
+    assert inversions == [len(X.columns) - 1, len(X.columns) - 2]
+
+    # The two collinear features tie; either may go first, the rest must match statsmodels
+    assert dropped[0] in ('a', 'a_twice')
+    expected_vif, expected_dropped = _statsmodels_elimination(X.drop(columns=dropped[0]), threshold=7)
+    assert dropped[1:] == expected_dropped
+    assert list(vif['feature']) == list(expected_vif.index)
+    np.testing.assert_allclose(vif['VIF'].to_numpy(), expected_vif.to_numpy(), rtol=1e-6)